@@ -0,0 +1,397 @@
+#!/usr/bin/env python3
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+#
+# BENCHMARK
+#
+# synthetic filesystem images are built by `mke2fs -d` from generated directory tree, so no root is needed
+# phases create, ls, recover and incremental create run each in its own process, that is measured by:
+#   wall        wall clock time in seconds
+#   cpu         user + system time in seconds, including worker processes
+#   max_rss     peak resident memory in KiB
+#   rchar       bytes read by read syscalls, from /proc/self/io (Linux only)
+#   read_bytes  bytes read from storage, without page cache (Linux only)
+#   syscr       number of read syscalls (Linux only)
+#
+# recovered files are compared with generated ones, run fails, when any of them differs
+#
+
+# root of repository, phases are run as `python -m src`
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# default results file, directory is ignored by git
+RESULTS_FILE = os.path.join(REPO_DIR, 'results', 'benchmark.json')
+
+# code run in process of each phase, it stores I/O counters of the process when it exits
+MEASURE_CODE = '''
+import os
+import sys
+from src.console import start
+io_file = sys.argv.pop(1)
+try:
+    start()
+finally:
+    if os.path.exists('/proc/self/io'):
+        with open('/proc/self/io') as src, open(io_file, 'w') as dst:
+            dst.write(src.read())
+'''
+
+# random data, that files are sliced from
+DATA_POOL_SIZE = 4 * 1024 * 1024
+
+# get name of directory at given index of one level
+def get_dir_name(index):
+    return 'd{:04}'.format(index)
+
+# get relative paths of leaf directories of tree with given depth and fan-out
+def get_leaf_dirs(depth, fanout):
+    dirs = ['']
+    for level in range(depth):
+        dirs = [os.path.join(parent, get_dir_name(i)) for parent in dirs for i in range(fanout)]
+    return dirs
+
+# write one file, sparse files have data only at start and end with hole of given size between them -> digest of content
+def write_file(path, data, hole=0):
+    digest = hashlib.sha256()
+    with open(path, 'wb') as fh:
+        if hole == 0:
+            fh.write(data)
+            digest.update(data)
+            return digest.hexdigest()
+
+        half = len(data) // 2
+        fh.write(data[:half])
+        fh.seek(hole, os.SEEK_CUR)
+        fh.write(data[half:])
+        digest.update(data[:half])
+        digest.update(bytes(hole))
+        digest.update(data[half:])
+        return digest.hexdigest()
+
+# get digest of content of file, None if it does not exist
+def get_file_digest(path):
+    if not os.path.isfile(path):
+        return None
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for data in iter(lambda: fh.read(1024 * 1024), b''):
+            digest.update(data)
+    return digest.hexdigest()
+
+# generate directory tree of given shape -> (files {path: (size, digest)}, fragmented [path, ...], pad blocks count)
+# fragmented files are not in tree, they are written to image later, into holes after removed pad files
+def build_tree(tree_dir, spool_dir, shape, rnd):
+    pool = os.urandom(DATA_POOL_SIZE)
+    leaves = get_leaf_dirs(shape['depth'], shape['fanout'])
+    block_size = shape['block_size']
+
+    for leaf in leaves:
+        os.makedirs(os.path.join(tree_dir, leaf), exist_ok=True)
+
+    files = {}
+    fragmented = []
+    pad_blocks = 0
+    for index in range(shape['files']):
+        path = os.path.join(leaves[index % len(leaves)], 'f{:08}'.format(index))
+
+        # sizes vary around given file size
+        size = max(1, int(rnd.uniform(0.5, 1.5) * shape['file_size']))
+        offset = rnd.randrange(0, DATA_POOL_SIZE - size) if size < DATA_POOL_SIZE else 0
+        data = (pool * (size // DATA_POOL_SIZE + 1))[offset:offset + size]
+        hole = shape['file_size'] * 4 if rnd.random() < shape['sparse'] else 0
+
+        if rnd.random() < shape['fragmentation']:
+            # written later by debugfs, each of its blocks needs one pad block
+            digest = write_file(os.path.join(spool_dir, str(len(fragmented))), data, hole)
+            fragmented.append(path)
+            pad_blocks += 2 * (size // block_size + 1)
+        else:
+            digest = write_file(os.path.join(tree_dir, path), data, hole)
+
+        files['/' + path] = size + hole, digest
+
+    # pad files, every other of them is removed later
+    if pad_blocks:
+        os.makedirs(os.path.join(tree_dir, 'pad'))
+        for index in range(pad_blocks):
+            write_file(os.path.join(tree_dir, 'pad', 'p{:08}'.format(index)), pool[index:index + block_size])
+
+    return files, fragmented, pad_blocks
+
+# run commands of debugfs on image, that is opened for writing
+def run_debugfs(image, commands):
+    if not commands:
+        return
+
+    with tempfile.NamedTemporaryFile('w', suffix='.debugfs') as fh:
+        fh.write('\n'.join(commands) + '\n')
+        fh.flush()
+        subprocess.run(['debugfs', '-w', '-f', fh.name, image], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+# build image of given shape -> (files {path: (size, digest)}, info about image)
+def build_image(work_dir, image, shape, rnd):
+    tree_dir = os.path.join(work_dir, 'tree')
+    spool_dir = os.path.join(work_dir, 'fragmented')
+    os.makedirs(tree_dir)
+    os.makedirs(spool_dir)
+
+    files, fragmented, pad_blocks = build_tree(tree_dir, spool_dir, shape, rnd)
+
+    # blocks for data, indirect blocks and directories with enough free space left
+    block_size = shape['block_size']
+    data_blocks = sum(size // block_size + 2 for size, digest in files.values()) + pad_blocks
+    dirs_count = sum(shape['fanout'] ** level for level in range(1, shape['depth'] + 1))
+    blocks = int((data_blocks + dirs_count * 4) * 1.5) + 16 * 1024 * 1024 // block_size
+    inodes = len(files) + pad_blocks + dirs_count + 1024
+
+    fs_type = 'ext3' if shape['layout'] == 'indirect' else 'ext4'
+    subprocess.run([
+        'mke2fs', '-q', '-F', '-t', fs_type, '-b', str(block_size), '-N', str(inodes), '-d', tree_dir, image, str(blocks)
+    ], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    # holes are made by removing every other pad file, fragmented files are written into them
+    commands = ['rm /pad/p{:08}'.format(index) for index in range(0, pad_blocks, 2)]
+    for index, path in enumerate(fragmented):
+        commands.append('cd /' + os.path.dirname(path))
+        commands.append('write {} {}'.format(os.path.join(spool_dir, str(index)), os.path.basename(path)))
+    run_debugfs(image, commands)
+
+    shutil.rmtree(tree_dir)
+    shutil.rmtree(spool_dir)
+
+    return files, {
+        'fs_type': fs_type,
+        'blocks': blocks,
+        'inodes': inodes,
+        'image_size': os.path.getsize(image),
+        'files': len(files),
+        'fragmented_files': len(fragmented),
+        'directories': dirs_count
+    }
+
+# drop image from page cache, so that phases read it from storage; needs no root for clean pages
+def drop_cache(path):
+    if not hasattr(os, 'posix_fadvise'):
+        return
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+# parse /proc/<pid>/io -> {counter: value}
+def parse_io(path):
+    if not os.path.exists(path):
+        return {}
+
+    with open(path) as fh:
+        counters = dict(line.split(': ') for line in fh.read().splitlines())
+
+    return {key: int(counters[key]) for key in ('rchar', 'read_bytes', 'syscr') if key in counters}
+
+# run one phase `python -m src <args>` in its own process -> measurements
+def run_phase(work_dir, args):
+    io_file = os.path.join(work_dir, 'io.txt')
+    if os.path.exists(io_file):
+        os.remove(io_file)
+
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, '-c', MEASURE_CODE, io_file] + args, cwd=REPO_DIR, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = proc.stdout.read()
+    proc.stdout.close()
+    _, status, rusage = os.wait4(proc.pid, 0)
+    wall = time.perf_counter() - start
+    proc.returncode = os.waitstatus_to_exitcode(status) if hasattr(os, 'waitstatus_to_exitcode') else status >> 8
+
+    result = {
+        'wall': round(wall, 4),
+        'cpu': round(rusage.ru_utime + rusage.ru_stime, 4),
+        'max_rss': rusage.ru_maxrss,
+        'exit_code': proc.returncode
+    }
+    result.update(parse_io(io_file))
+
+    if proc.returncode != 0:
+        result['output'] = output.decode('utf-8', 'replace')[-2000:]
+
+    return result, output.decode('utf-8', 'replace')
+
+# run all phases for one shape of image -> result of run
+def run_shape(shape, options):
+    rnd = random.Random(options.seed)
+    work_dir = tempfile.mkdtemp(prefix='e4bp-bench-', dir=options.work_dir)
+    image = os.path.join(work_dir, 'fs.img')
+    snapshot = os.path.join(work_dir, 'snapshot.out')
+
+    try:
+        start = time.perf_counter()
+        files, info = build_image(work_dir, image, shape, rnd)
+        info['build_wall'] = round(time.perf_counter() - start, 4)
+
+        phases = {}
+
+        def measure(name, args):
+            samples = []
+            for i in range(options.repeat):
+                if not options.warm:
+                    drop_cache(image)
+                result, output = run_phase(work_dir, args)
+                samples.append(result)
+            phases[name] = samples
+            return output
+
+        measure('create', ['create', '-i', image, '-o', snapshot, '-j', str(options.jobs), '-f', options.format])
+        info['snapshot_size'] = os.path.getsize(snapshot) if os.path.exists(snapshot) else None
+
+        # delete some files, that are listed and recovered
+        deleted = rnd.sample(sorted(files), min(options.deleted, len(files)))
+        run_debugfs(image, ['rm ' + path for path in deleted])
+        info['deleted_files'] = len(deleted)
+
+        output = measure('ls', ['ls', '-i', image, '-s', snapshot])
+        info['listed_files'] = sum(1 for line in output.splitlines() if line.startswith(('OK ', 'ERR ')))
+
+        recovered_dir = os.path.join(work_dir, 'recovered')
+        output = measure('recover', ['recover', '-i', image, '-s', snapshot, '-o', recovered_dir, '-j', str(options.jobs)] + deleted)
+        info['recovered_files'] = sum(1 for line in output.splitlines() if line.startswith('OK '))
+
+        # recovered files have to be same as generated ones
+        differing = [path for path in deleted if get_file_digest(os.path.join(recovered_dir, path.lstrip('/'))) != files[path][1]]
+        if differing:
+            raise Exception('{} of {} recovered files differ from generated ones, e.g. {}.'.format(len(differing), len(deleted), differing[0]))
+
+        measure('create_incremental', ['create', '-i', image, '-b', snapshot, '-o', snapshot + '.inc', '-j', str(options.jobs), '-f', options.format])
+
+        return {'shape': shape, 'image': info, 'phases': phases}
+    finally:
+        if not options.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+# get commit of repository, if it is git repository
+def get_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# best sample of each measurement, minimum of times, maximum of memory
+def summarize(samples):
+    return {
+        'wall': min(sample['wall'] for sample in samples),
+        'cpu': min(sample['cpu'] for sample in samples),
+        'max_rss': max(sample['max_rss'] for sample in samples),
+        'rchar': max(sample.get('rchar', 0) for sample in samples),
+        'read_bytes': max(sample.get('read_bytes', 0) for sample in samples)
+    }
+
+# print comparison of two results files, ratio new / old for each shape and phase
+def compare(old_file, new_file):
+    with open(old_file) as fh:
+        old = json.load(fh)
+    with open(new_file) as fh:
+        new = json.load(fh)
+
+    print('old: {} {}'.format(old.get('commit'), old.get('time')))
+    print('new: {} {}'.format(new.get('commit'), new.get('time')))
+
+    old_runs = {json.dumps(run['shape'], sort_keys=True): run for run in old['runs']}
+    for run in new['runs']:
+        old_run = old_runs.get(json.dumps(run['shape'], sort_keys=True))
+        if old_run is None:
+            continue
+
+        print()
+        print(', '.join('{}={}'.format(key, value) for key, value in sorted(run['shape'].items())))
+        print('{:<20}{:>10}{:>10}{:>10}{:>10}'.format('phase', 'wall', 'cpu', 'max_rss', 'rchar'))
+        for name, samples in run['phases'].items():
+            if name not in old_run['phases']:
+                continue
+
+            a, b = summarize(old_run['phases'][name]), summarize(samples)
+            print('{:<20}{:>10}{:>10}{:>10}{:>10}'.format(name, *(
+                '{:.2f}x'.format(b[key] / a[key]) if a[key] else '-' for key in ('wall', 'cpu', 'max_rss', 'rchar')
+            )))
+
+# print results of one run
+def print_run(run):
+    print(', '.join('{}={}'.format(key, value) for key, value in sorted(run['shape'].items())))
+    print('{:<20}{:>10}{:>10}{:>12}{:>14}'.format('phase', 'wall s', 'cpu s', 'max_rss KiB', 'rchar'))
+    for name, samples in run['phases'].items():
+        best = summarize(samples)
+        print('{:<20}{:>10.3f}{:>10.3f}{:>12}{:>14}'.format(name, best['wall'], best['cpu'], best['max_rss'], best['rchar']))
+    print()
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='benchmark of create, ls and recover on synthetic filesystem images built by "mke2fs -d"'
+    )
+    parser.add_argument('-n', '--files', type=int, nargs='+', help='numbers of files, one image for each', default=[1000, 10000])
+    parser.add_argument('--depth', type=int, help='depth of directory tree', default=3)
+    parser.add_argument('--fanout', type=int, help='subdirectories of each directory', default=4)
+    parser.add_argument('--file-size', type=int, help='average file size in bytes', default=16 * 1024)
+    parser.add_argument('--fragmentation', type=float, help='fraction of files written into holes of removed files', default=0.0)
+    parser.add_argument('--sparse', type=float, help='fraction of sparse files', default=0.0)
+    parser.add_argument('--layout', type=str, choices=['extent', 'indirect'], help='ext4 with extents or ext3 with indirect blocks', default='extent')
+    parser.add_argument('--block-size', type=int, choices=[1024, 2048, 4096], help='block size of filesystem', default=4096)
+    parser.add_argument('--deleted', type=int, help='number of files deleted before ls and recover', default=100)
+    parser.add_argument('-j', '--jobs', type=int, help='jobs of create and recover', default=1)
+    parser.add_argument('-f', '--format', type=str, choices=['binary', 'json'], help='format of snapshot', default='binary')
+    parser.add_argument('-r', '--repeat', type=int, help='number of runs of each phase', default=1)
+    parser.add_argument('--seed', type=int, help='seed of generated tree', default=0)
+    parser.add_argument('--warm', action='store_true', help='keep image in page cache between phases')
+    parser.add_argument('--work-dir', type=str, help='directory for images, temporary directory by default')
+    parser.add_argument('--keep', action='store_true', help='keep images and snapshots')
+    parser.add_argument('-o', '--output', type=str, help='results file (JSON), results/benchmark.json by default', default=RESULTS_FILE)
+    parser.add_argument('--compare', type=str, nargs=2, metavar=('OLD', 'NEW'), help='compare two results files instead of running')
+    options = parser.parse_args()
+
+    if options.compare:
+        compare(*options.compare)
+        return
+
+    results = {
+        'commit': get_commit(),
+        'time': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'runs': []
+    }
+
+    os.makedirs(os.path.dirname(os.path.abspath(options.output)), exist_ok=True)
+
+    for files in options.files:
+        shape = {
+            'files': files,
+            'depth': options.depth,
+            'fanout': options.fanout,
+            'file_size': options.file_size,
+            'fragmentation': options.fragmentation,
+            'sparse': options.sparse,
+            'layout': options.layout,
+            'block_size': options.block_size,
+            'jobs': options.jobs,
+            'format': options.format
+        }
+        run = run_shape(shape, options)
+        results['runs'].append(run)
+        print_run(run)
+
+        # results are saved after each image, large runs can be stopped
+        with open(options.output, 'w') as fh:
+            json.dump(results, fh, indent=2)
+
+if __name__ == '__main__':
+    main()
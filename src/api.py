@@ -0,0 +1,141 @@
+import json
+import os
+import socket
+import socketserver
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+#
+# API OF LONG RUNNING COMMANDS
+#
+# requests and responses are JSON objects, request has "command" and its arguments
+#
+# Unix socket
+#   one request and one response per line, more requests can be sent over one connection
+#
+# HTTP, only on localhost
+#   GET /<command>?name=value&...   arguments are strings
+#   POST /<command>                 arguments are JSON object in body
+#   only commands listed in `http_commands` of api object are accepted
+#
+# failed request gets {"error": message}, with HTTP status 400
+#
+# api object handles requests by `handle_request(request) -> response`, it is called from more threads
+#
+
+class UnixRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                response = self.server.api.handle_request(json.loads(line.decode('utf-8')))
+            except Exception as e:
+                response = {'error': str(e)}
+
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+
+class UnixAPIServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, api):
+        self.api = api
+        self.socket_path = socket_path
+        super().__init__(socket_path, UnixRequestHandler)
+
+class HTTPRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlsplit(self.path)
+        self.respond(url.path, dict(parse_qsl(url.query)))
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length) if length > 0 else b'{}'
+        try:
+            request = json.loads(body.decode('utf-8'))
+        except ValueError:
+            request = None
+        self.respond(urlsplit(self.path).path, request)
+
+    def respond(self, path, request):
+        try:
+            if not isinstance(request, dict):
+                raise Exception('Request must be JSON object.')
+            request['command'] = path.strip('/')
+            if request['command'] not in getattr(self.server.api, 'http_commands', ()):
+                raise Exception('Command {} is not available over HTTP.'.format(request['command']))
+            response = self.server.api.handle_request(request)
+            status = 200
+        except Exception as e:
+            response = {'error': str(e)}
+            status = 400
+
+        data = json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+class HTTPAPIServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port, api):
+        self.api = api
+        super().__init__(('127.0.0.1', port), HTTPRequestHandler)
+
+# send request to API listening on given Unix socket -> response
+def send_request(socket_path, request, timeout=None):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(socket_path)
+        with sock.makefile('rwb') as f:
+            f.write(json.dumps(request).encode('utf-8') + b'\n')
+            f.flush()
+            line = f.readline()
+
+    if not line:
+        raise Exception('Connection was closed without response.')
+
+    response = json.loads(line.decode('utf-8'))
+    if 'error' in response:
+        raise Exception(response['error'])
+
+    return response
+
+# serve API on Unix socket in background thread, stale socket of stopped process is replaced
+def start_unix_server(socket_path, api):
+    if os.path.exists(socket_path):
+        try:
+            send_request(socket_path, {'command': 'status'}, timeout=5)
+            in_use = True
+        except (OSError, ValueError):
+            in_use = False
+        except Exception:
+            # other process answers, even if with error
+            in_use = True
+
+        if in_use:
+            raise Exception('Socket {} is already in use.'.format(socket_path))
+        os.remove(socket_path)
+
+    # socket is created only for owner, it is not reachable by others even before server starts
+    umask = os.umask(0o177)
+    try:
+        server = UnixAPIServer(socket_path, api)
+    finally:
+        os.umask(umask)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# serve API on HTTP port of localhost in background thread
+def start_http_server(port, api):
+    server = HTTPAPIServer(port, api)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# stop server started in background thread, socket file is removed
+def stop_server(server):
+    server.shutdown()
+    server.server_close()
+    if isinstance(server, UnixAPIServer):
+        os.remove(server.socket_path)
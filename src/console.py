@@ -1,11 +1,32 @@
 import argparse
+import cProfile
+import json
+import pstats
 import textwrap
 import os
 import sys
 
-from src.utils import generate_snapshot, recover_file, list_deleted
+from src.api import send_request
+from src.daemon import SnapshotDaemon
+from src.server import QueryServer
+from src.stats import Stats
+from src.utils import generate_snapshot, generate_snapshot_to_store, find_path_in_store, recover_file, recover_files, iter_deleted, is_glob
 
 def create(args):
+    # new generation in snapshot store
+    if args.store is not None:
+        name = generate_snapshot_to_store(
+            fs=args.input,
+            store_path=args.store,
+            name=args.name,
+            dirs_max_depth=args.dirs_max_depth,
+            jobs=args.jobs,
+            trust_descriptors=args.trust_descriptors,
+            stats=args.stats
+        )
+        print("created generation {}".format(name))
+        return
+
     # Default output
     if args.output is None:
         snapshot_file = os.path.basename(args.input) + '.snapshot.out'
@@ -15,42 +36,231 @@ def create(args):
     snapshot = generate_snapshot(
         fs=args.input,
         snapshot_file=snapshot_file,
-        dirs_max_depth=args.dirs_max_depth
+        dirs_max_depth=args.dirs_max_depth,
+        jobs=args.jobs,
+        snapshot_format=args.format,
+        base_snapshot_file=args.base,
+        trust_descriptors=args.trust_descriptors,
+        memory_limit=args.memory_limit * 1024 * 1024,
+        stats=args.stats
     )
 
 def recover(args):
+    # more files or directories are recovered to output directory
+    if len(args.file_path) > 1 or args.file_path[0].endswith('/') or is_glob(args.file_path[0]):
+        recover_many(args)
+        return
+
     # Default output
     if args.output is None:
-        output_file = os.path.basename(args.file_path)
+        output_file = os.path.basename(args.file_path[0])
     else:
         output_file = args.output
 
     recover_file(
         fs=args.input,
         snapshot_file=args.snapshot,
-        file_path=args.file_path,
+        file_path=args.file_path[0],
         output_file=output_file,
-        verify_checksum=not args.force
+        verify_checksum=not args.force,
+        stats=args.stats
     )
 
-def ls(args):
-    deleted_files = list_deleted(
+def recover_many(args):
+    # Default output
+    if args.output is None:
+        output_dir = '.'
+    else:
+        output_dir = args.output
+
+    copy_stats = {}
+    results = recover_files(
         fs=args.input,
-        snapshot_file=args.snapshot
+        snapshot_file=args.snapshot,
+        patterns=args.file_path,
+        output_dir=output_dir,
+        verify_checksum=not args.force,
+        jobs=args.jobs,
+        stats=args.stats,
+        copy_stats=copy_stats
     )
 
-    print("total {}".format(len(deleted_files)))
-    for path, v in deleted_files.items():
-        print("{:5}{:<13}{}".format(
-            'OK' if v['can_be_recovered'] else 'ERR',
-            v['size'],
-            path
+    print_recover_results(results, copy_stats)
+
+# print results of recovering more files
+def print_recover_results(results, copy_stats):
+    failed = 0
+    for path, error in results.items():
+        if error is None:
+            print("{:5}{}".format('OK', path))
+        else:
+            print("{:5}{} ({})".format('ERR', path, error))
+            failed += 1
+
+    if 'bytes' in copy_stats:
+        print("recovered {} bytes in {:.2f}s ({:.1f} MiB/s)".format(
+            copy_stats['bytes'],
+            copy_stats['seconds'],
+            copy_stats['bytes'] / max(copy_stats['seconds'], 1e-6) / 1024 / 1024
         ))
 
+    if failed > 0:
+        raise Exception('{} of {} files could not be recovered.'.format(failed, len(results)))
+
+def history(args):
+    missing = 0
+    for file_path in args.file_path:
+        found = find_path_in_store(
+            store_path=args.store,
+            path=file_path,
+            latest_only=not args.all
+        )
+
+        if not found:
+            print("{:<20}{:<13}{}".format('-', '-', file_path))
+            missing += 1
+
+        for name, inode_id in found:
+            print("{:<20}{:<13}{}".format(name, inode_id, file_path))
+
+    if missing > 0:
+        raise Exception('{} of {} paths were not found in any generation.'.format(missing, len(args.file_path)))
+
+def ls(args):
+    deleted_files = iter_deleted(
+        fs=args.input,
+        snapshot_file=args.snapshot,
+        patterns=args.pattern,
+        min_size=args.min_size,
+        max_size=args.max_size,
+        can_be_recovered=None if args.status is None else args.status == 'ok',
+        stats=args.stats
+    )
+
+    print_deleted(deleted_files, args.ndjson)
+
+# print deleted files (path, {inode_id, size, can_be_recovered}) as they are listed, total is printed at the end
+def print_deleted(deleted_files, ndjson=False):
+    total = 0
+    for path, v in deleted_files:
+        if ndjson:
+            print(json.dumps({'path': path, 'inode_id': v['inode_id'], 'size': v['size'], 'can_be_recovered': v['can_be_recovered']}))
+        else:
+            print("{:5}{:<13}{}".format(
+                'OK' if v['can_be_recovered'] else 'ERR',
+                v['size'],
+                path
+            ))
+        total += 1
+
+    if not ndjson:
+        print("total {}".format(total))
+
+# add filters of deleted files to parser of command
+def add_ls_arguments(parser):
+    parser.add_argument('--min-size', type=int, help='list only files with at least given size in bytes', required=False)
+    parser.add_argument('--max-size', type=int, help='list only files with at most given size in bytes', required=False)
+    parser.add_argument('--status', type=str.lower, choices=['ok', 'err'], help='list only files, that can (OK) or cannot (ERR) be recovered', required=False)
+    parser.add_argument('--ndjson', action='store_true', help='print one JSON object per file, without total', required=False)
+
+def daemon(args):
+    SnapshotDaemon(
+        fs=args.input,
+        output_dir=args.output,
+        interval=args.interval,
+        keep=args.keep,
+        socket_path=args.socket,
+        dirs_max_depth=args.dirs_max_depth,
+        jobs=args.jobs,
+        snapshot_format=args.format,
+        trust_descriptors=args.trust_descriptors,
+        memory_limit=args.memory_limit * 1024 * 1024
+    ).run()
+
+def daemon_ctl(args):
+    request = {'command': args.command}
+    if args.command == 'snapshot':
+        request['wait'] = args.wait
+
+    response = send_request(args.socket, request)
+    print(json.dumps(response, indent=2))
+
+    last = response.get('last')
+    if args.command == 'snapshot' and args.wait and last is not None and last['error'] is not None:
+        raise Exception('Snapshot failed: {}'.format(last['error']))
+
+def serve(args):
+    # Default socket
+    socket_path = args.socket
+    if socket_path is None and args.http is None:
+        socket_path = os.path.normpath(args.snapshot) + '.sock'
+
+    QueryServer(args.input, args.snapshot).run(socket_path, args.http)
+
+def query(args):
+    request = {'command': args.command}
+    if args.command == 'ls':
+        request.update(patterns=args.args, min_size=args.min_size, max_size=args.max_size, status=args.status)
+    elif args.command == 'stat':
+        if len(args.args) != 1:
+            raise Exception('stat needs one path.')
+        request['path'] = args.args[0]
+    elif args.command == 'prefix':
+        request['prefix'] = args.args[0] if args.args else '/'
+        request['limit'] = args.limit
+    elif args.command == 'recover':
+        if not args.args:
+            raise Exception('recover needs at least one path.')
+        request.update(patterns=args.args, output_dir=os.path.abspath(args.output or '.'), force=args.force, jobs=args.jobs)
+
+    response = send_request(args.socket, request)
+
+    if args.command == 'ls':
+        print_deleted(response['files'].items(), args.ndjson)
+    elif args.command == 'prefix':
+        for path, inode_id in response['paths']:
+            print("{:<13}{}".format(inode_id, path))
+        if response['truncated']:
+            print("... more than {} paths".format(args.limit))
+    elif args.command == 'recover':
+        print_recover_results(response['results'], response)
+    else:
+        print(json.dumps(response, indent=2))
+
+# print statistics and profile of command to stderr
+def report(args, stats_format, profile):
+    if profile is not None:
+        profile.disable()
+        profile.dump_stats(args.profile)
+        pstats.Stats(profile, stream=sys.stderr).sort_stats('tottime').print_stats(20)
+
+    if args.stats is not None:
+        args.stats.finish()
+        if stats_format == 'json':
+            print(json.dumps(args.stats.to_dict(), indent=2), file=sys.stderr)
+        else:
+            print(args.stats.format(), file=sys.stderr)
+
+# add options of statistics and profile to parser of command
+def add_stats_arguments(parser):
+    parser.add_argument('--stats', action='store_true', help='print time, reads and counters of each phase to stderr', required=False)
+    parser.add_argument('--stats-format', type=str, choices=['text', 'json'], help='format of statistics', required=False, default='text')
+    parser.add_argument('--profile', type=str, help='save cProfile data to given file and print hot functions to stderr', required=False)
+
 """
 ext4-backup-pointers create -i data_fs.img [-o snapshot-2020-05-09.json]
+ext4-backup-pointers create -i data_fs.img -b snapshot-2020-05-09.json [-o snapshot-2020-05-10.json]
 ext4-backup-pointers recover -i data_fs.img -s snapshot-2020-05-09.json /some/file.jpg [-o file.jpg]
+ext4-backup-pointers recover -i data_fs.img -s snapshot-2020-05-09.json /some/dir/ '/photos/*.jpg' [-o output_dir]
 ext4-backup-pointers ls -i data_fs.img -s snapshot-2020-05-09.json
+ext4-backup-pointers ls -i data_fs.img -s snapshot-2020-05-09.json /home/alice/ '/photos/*.jpg' [--min-size 1024] [--max-size 1048576] [--status ok|err] [--ndjson]
+ext4-backup-pointers create -i data_fs.img --store snapshots/
+ext4-backup-pointers history --store snapshots/ /some/file.jpg [-a]
+ext4-backup-pointers create -i data_fs.img --stats [--stats-format json] [--profile create.prof]
+ext4-backup-pointers daemon -i /dev/vg/data-snap -o snapshots/ [--interval 3600] [--keep 24]
+ext4-backup-pointers daemon-ctl --socket snapshots/daemon.sock status|snapshot|stop [--wait]
+ext4-backup-pointers serve -i data_fs.img -s snapshot-2020-05-09.out [--socket query.sock] [--http 8080]
+ext4-backup-pointers query --socket query.sock ls|stat|prefix|recover|status [path ...] [-o output_dir]
 """
 def start():
     # create the top-level parser
@@ -66,15 +276,25 @@ def start():
     parser_create.add_argument('-i', '--input', type=str, help='image of file system', required=True)
     parser_create.add_argument('-o', '--output', type=str, help='metadata snapshot output file', required=False)
     parser_create.add_argument('-depth', '--dirs-max-depth', type=int, help='maximum depth of directory traversal', required=False, default=100)
+    parser_create.add_argument('-j', '--jobs', type=int, help='number of processes scanning inodes', required=False, default=1)
+    parser_create.add_argument('-f', '--format', type=str, choices=['binary', 'json'], help='format of metadata snapshot', required=False, default='binary')
+    parser_create.add_argument('-b', '--base', type=str, help='previous metadata snapshot, only changed block groups are scanned again', required=False)
+    parser_create.add_argument('--trust-descriptors', action='store_true', help='with --base, skip block groups with unchanged group descriptors without reading their inode tables (needs metadata_csum, can miss files grown to other block groups)', required=False)
+    parser_create.add_argument('-m', '--memory-limit', type=int, help='memory in MiB for buffered paths and records, then they are spilled to temporary files next to output file', required=False, default=256)
+    parser_create.add_argument('--store', type=str, help='snapshot store directory, snapshot is saved as new generation instead of output file', required=False)
+    parser_create.add_argument('--name', type=str, help='name of generation in snapshot store, current time by default', required=False)
+    add_stats_arguments(parser_create)
     parser_create.set_defaults(func=create) 
 
     # create the parser for the "recover" command
     parser_recover = subparsers.add_parser('recover', help='recover file from metadata snapshot')
     parser_recover.add_argument('-i', '--input', type=str, help='image of file system', required=True)
-    parser_recover.add_argument('-s', '--snapshot', type=str, help='metadata snapshot generated using "create"', required=True)
-    parser_recover.add_argument('file_path', type=str, help='absolute path of wanted file inside of supplied file system')
-    parser_recover.add_argument('-o', '--output', type=str, help='output file, where will be recovered file saved', required=False)
+    parser_recover.add_argument('-s', '--snapshot', type=str, help='metadata snapshot generated using "create", snapshot store (its latest generation) or manifest of generation in snapshot store', required=True)
+    parser_recover.add_argument('file_path', type=str, nargs='+', help='absolute path of wanted file inside of supplied file system, directory ending with "/" or glob pattern')
+    parser_recover.add_argument('-o', '--output', type=str, help='output file, where will be recovered file saved; output directory, when recovering more files', required=False)
+    parser_recover.add_argument('-j', '--jobs', type=int, help='number of threads copying data, when recovering more files', required=False, default=1)
     parser_recover.add_argument('-f', '--force', action='store_true', help='recover even if data blocks of file have been already allocated and file might be corrupted', required=False)
+    add_stats_arguments(parser_recover)
     parser_recover.set_defaults(func=recover)
 
     parser_ls = subparsers.add_parser('ls',
@@ -86,17 +306,80 @@ def start():
                  ERR - data blocks of file have already been allocated.
               2. Filesize in bytes.
               3. Absolute file path.
+            files are printed as they are found, in order of paths, total is printed at the end
         ''')
     )
     parser_ls.add_argument('-i', '--input', type=str, help='image of file system', required=True)
-    parser_ls.add_argument('-s', '--snapshot', type=str, help='metadata snapshot generated using "create"', required=True)
+    parser_ls.add_argument('-s', '--snapshot', type=str, help='metadata snapshot generated using "create", snapshot store (its latest generation) or manifest of generation in snapshot store', required=True)
+    parser_ls.add_argument('pattern', type=str, nargs='*', help='list only these absolute file paths, directories ending with "/" or glob patterns')
+    add_ls_arguments(parser_ls)
+    add_stats_arguments(parser_ls)
     parser_ls.set_defaults(func=ls)
 
+    parser_history = subparsers.add_parser('history',
+        help='find latest generation of snapshot store, that contains given path',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=textwrap.dedent('''\
+            columns:
+              1. Name of generation, "-" if path was not found.
+              2. Inode id of file in that generation.
+              3. Absolute file path.
+        ''')
+    )
+    parser_history.add_argument('--store', type=str, help='snapshot store directory', required=True)
+    parser_history.add_argument('file_path', type=str, nargs='+', help='absolute path of file, or directory ending with "/"')
+    parser_history.add_argument('-a', '--all', action='store_true', help='list all generations containing path, from latest', required=False)
+    parser_history.set_defaults(func=history)
+
+    parser_daemon = subparsers.add_parser('daemon', help='keep image opened and take incremental snapshots in interval')
+    parser_daemon.add_argument('-i', '--input', type=str, help='image of file system', required=True)
+    parser_daemon.add_argument('-o', '--output', type=str, help='directory of snapshots, latest one is base of next snapshot', required=True)
+    parser_daemon.add_argument('--interval', type=float, help='seconds between snapshots', required=False, default=3600)
+    parser_daemon.add_argument('--keep', type=int, help='number of latest snapshots kept in output directory', required=False, default=24)
+    parser_daemon.add_argument('--socket', type=str, help='Unix socket of API, daemon.sock in output directory by default', required=False)
+    parser_daemon.add_argument('-depth', '--dirs-max-depth', type=int, help='maximum depth of directory traversal', required=False, default=100)
+    parser_daemon.add_argument('-j', '--jobs', type=int, help='number of processes scanning inodes', required=False, default=1)
+    parser_daemon.add_argument('-f', '--format', type=str, choices=['binary', 'json'], help='format of metadata snapshots', required=False, default='binary')
+    parser_daemon.add_argument('--trust-descriptors', action='store_true', help='skip block groups with unchanged group descriptors without reading their inode tables (needs metadata_csum, can miss files grown to other block groups)', required=False)
+    parser_daemon.add_argument('-m', '--memory-limit', type=int, help='memory in MiB for buffered paths and records, then they are spilled to temporary files in output directory', required=False, default=256)
+    parser_daemon.set_defaults(func=daemon)
+
+    parser_daemon_ctl = subparsers.add_parser('daemon-ctl', help='ask running daemon for status or immediate snapshot')
+    parser_daemon_ctl.add_argument('--socket', type=str, help='Unix socket of daemon', required=True)
+    parser_daemon_ctl.add_argument('command', type=str, choices=['status', 'snapshot', 'stop'], help='status of daemon, take snapshot now or stop daemon')
+    parser_daemon_ctl.add_argument('-w', '--wait', action='store_true', help='with snapshot, wait until snapshot is written', required=False)
+    parser_daemon_ctl.set_defaults(func=daemon_ctl)
+
+    parser_serve = subparsers.add_parser('serve', help='keep snapshot and allocation bitmaps loaded and answer ls, stat and recover requests')
+    parser_serve.add_argument('-i', '--input', type=str, help='image of file system', required=True)
+    parser_serve.add_argument('-s', '--snapshot', type=str, help='metadata snapshot generated using "create", snapshot store (its latest generation) or manifest of generation in snapshot store', required=True)
+    parser_serve.add_argument('--socket', type=str, help='Unix socket of API, snapshot path with ".sock" by default, if --http is not given', required=False)
+    parser_serve.add_argument('--http', type=int, help='port of HTTP API on localhost, it does not accept recover requests', required=False)
+    parser_serve.set_defaults(func=serve)
+
+    parser_query = subparsers.add_parser('query', help='send request to running "serve"')
+    parser_query.add_argument('--socket', type=str, help='Unix socket of "serve"', required=True)
+    parser_query.add_argument('command', type=str, choices=['ls', 'stat', 'prefix', 'recover', 'status'], help='list deleted files (under optional prefix), show file, list paths with prefix, recover files or show status of server')
+    parser_query.add_argument('args', type=str, nargs='*', help='prefix, path, or paths to recover (files, directories ending with "/" or glob patterns)')
+    parser_query.add_argument('-o', '--output', type=str, help='output directory of recovered files', required=False)
+    parser_query.add_argument('-f', '--force', action='store_true', help='recover even if data blocks of file have been already allocated and file might be corrupted', required=False)
+    parser_query.add_argument('-j', '--jobs', type=int, help='number of threads copying data of recovered files', required=False, default=1)
+    parser_query.add_argument('--limit', type=int, help='maximum number of paths listed by prefix', required=False, default=1000)
+    add_ls_arguments(parser_query)
+    parser_query.set_defaults(func=query)
+
     # parse argument lists
     args = parser.parse_args()
 
+    # statistics and profile are collected only when asked for
+    stats_format = getattr(args, 'stats_format', 'text')
+    args.stats = Stats() if getattr(args, 'stats', False) else None
+    profile = cProfile.Profile() if getattr(args, 'profile', None) else None
+
     # run function
     try:
+        if profile is not None:
+            profile.enable()
         args.func(args)
         sys.exit(0)
     except AttributeError:
@@ -106,3 +389,5 @@ def start():
         print("*** ERROR! ***")
         print(e)
         sys.exit(1)
+    finally:
+        report(args, stats_format, profile)
@@ -0,0 +1,256 @@
+import os
+import signal
+import threading
+import time
+
+from src.api import start_unix_server, stop_server
+from src.snapshot import SNAPSHOT_MEMORY_LIMIT
+from src.stats import Stats
+from src.utils import Ext4Image, load_snapshot, save_snapshot_from_image
+
+#
+# SNAPSHOT DAEMON
+#
+# keeps fs image opened and latest snapshot loaded, snapshots are taken in interval and on request
+# each snapshot uses previous one as base snapshot, so only changed block groups are scanned again
+#
+# output_dir/
+#   snapshot-20200509-120000.out    snapshots, only `keep` latest ones are kept
+#   daemon.sock                     Unix socket of API
+#
+# API on Unix socket, see src/api.py
+#   {"command": "status"}                   state of daemon and result of last snapshot
+#   {"command": "snapshot", "wait": true}   take snapshot now, optionally wait until it is written
+#   {"command": "stop"}                     stop after running snapshot is written
+#
+
+SNAPSHOT_PREFIX = 'snapshot-'
+SNAPSHOT_TIME_FORMAT = '%Y%m%d-%H%M%S'
+SNAPSHOT_SUFFIXES = {'binary': '.out', 'json': '.json'}
+
+DAEMON_SOCKET_NAME = 'daemon.sock'
+
+# get snapshots in output directory -> [path, ...] from oldest
+def list_snapshots(output_dir):
+    paths = [
+        os.path.join(output_dir, name) for name in os.listdir(output_dir)
+        if name.startswith(SNAPSHOT_PREFIX) and name.endswith(tuple(SNAPSHOT_SUFFIXES.values()))
+    ]
+    return sorted(paths, key=lambda path: (os.path.getmtime(path), path))
+
+class SnapshotDaemon:
+    def __init__(self, fs, output_dir, interval=3600, keep=24, socket_path=None, dirs_max_depth=100, jobs=1, snapshot_format='binary', trust_descriptors=False, memory_limit=SNAPSHOT_MEMORY_LIMIT):
+        if keep < 1:
+            raise Exception('At least one snapshot has to be kept.')
+
+        self.fs = fs
+        self.output_dir = output_dir
+        self.interval = interval
+        self.keep = keep
+        self.socket_path = socket_path if socket_path is not None else os.path.join(output_dir, DAEMON_SOCKET_NAME)
+        self.dirs_max_depth = dirs_max_depth
+        self.jobs = jobs
+        self.snapshot_format = snapshot_format
+        self.trust_descriptors = trust_descriptors
+        self.memory_limit = memory_limit
+
+        # image stays opened, its superblock and descriptors are parsed again before each snapshot
+        self.img = None
+
+        # latest snapshot, base of next one
+        self.base = None
+        self.base_file = None
+
+        # state shared with API threads, guarded by condition
+        self.changed = threading.Condition()
+        self.requested = False
+        self.stopping = False
+        self.running = False
+        self.next_time = None
+        self.runs = 0
+        self.failures = 0
+        self.last = None
+
+        self.server = None
+
+    def log(self, message):
+        print('{} {}'.format(time.strftime('%Y-%m-%d %H:%M:%S'), message), flush=True)
+
+    # load latest snapshot as base of next one, previous base is closed
+    def set_base(self, snapshot_file):
+        base = load_snapshot(snapshot_file)
+        if hasattr(self.base, 'close'):
+            self.base.close()
+
+        self.base = base
+        self.base_file = snapshot_file
+
+    # get path of new snapshot, that does not overwrite any existing one
+    def get_snapshot_file(self, started):
+        name = SNAPSHOT_PREFIX + time.strftime(SNAPSHOT_TIME_FORMAT, time.localtime(started))
+        suffix = SNAPSHOT_SUFFIXES[self.snapshot_format]
+        path = os.path.join(self.output_dir, name + suffix)
+
+        i = 1
+        while os.path.exists(path):
+            i += 1
+            path = os.path.join(self.output_dir, '{}-{}{}'.format(name, i, suffix))
+
+        return path
+
+    # remove old snapshots over retention, base snapshot is always kept -> [path, ...] of removed ones
+    def rotate(self):
+        removed = []
+        for path in list_snapshots(self.output_dir)[:-self.keep]:
+            if path != self.base_file:
+                os.remove(path)
+                removed.append(path)
+
+        return removed
+
+    # write one snapshot, failure is reported in status and next snapshot is tried in next interval
+    def take_snapshot(self, started):
+        snapshot_file = self.get_snapshot_file(started)
+        result = {'started': started, 'file': None, 'error': None, 'removed': []}
+
+        stats = Stats()
+        try:
+            self.img.refresh()
+            self.img.stats = stats
+            save_snapshot_from_image(self.img, snapshot_file, self.dirs_max_depth, self.jobs, self.snapshot_format, self.base, self.trust_descriptors, self.memory_limit)
+
+            with stats.phase('base_snapshot'):
+                self.set_base(snapshot_file)
+
+            result['file'] = snapshot_file
+            result['removed'] = self.rotate()
+        except Exception as e:
+            result['error'] = str(e)
+        finally:
+            self.img.stats = None
+
+        data = stats.to_dict()
+        result['finished'] = time.time()
+        result['seconds'] = result['finished'] - started
+        result['counters'] = data['counters']
+        result['phases'] = {name: round(phase['wall'], 3) for name, phase in data['phases'].items()}
+
+        if result['error'] is None:
+            self.log('snapshot {} written in {:.2f}s, {} block groups scanned'.format(snapshot_file, result['seconds'], data['counters'].get('groups.scanned', 0)))
+        else:
+            self.log('snapshot {} failed: {}'.format(snapshot_file, result['error']))
+
+        with self.changed:
+            self.running = False
+            self.runs += 1
+            self.failures += result['error'] is not None
+            self.last = result
+            self.changed.notify_all()
+
+    # ask for snapshot now -> result of snapshot started after request, if waiting for it
+    def request_snapshot(self, wait=False):
+        with self.changed:
+            requested = time.time()
+            self.requested = True
+            self.changed.notify_all()
+
+            while wait and not self.stopping and (self.last is None or self.last['started'] < requested):
+                self.changed.wait()
+
+            return self.last if wait else None
+
+    # stop after running snapshot is written
+    def stop(self):
+        with self.changed:
+            self.stopping = True
+            self.changed.notify_all()
+
+    def get_status(self):
+        with self.changed:
+            return {
+                'image': self.fs,
+                'output_dir': self.output_dir,
+                'interval': self.interval,
+                'keep': self.keep,
+                'state': 'stopping' if self.stopping else 'running' if self.running else 'idle',
+                'next_snapshot': None if self.running else self.next_time,
+                'runs': self.runs,
+                'failures': self.failures,
+                'base': self.base_file,
+                'last': self.last,
+                'snapshots': list_snapshots(self.output_dir),
+            }
+
+    def handle_request(self, request):
+        command = request.get('command')
+        if command == 'status':
+            return self.get_status()
+
+        if command == 'snapshot':
+            return {'requested': True, 'last': self.request_snapshot(request.get('wait', False))}
+
+        if command == 'stop':
+            self.stop()
+            return {'stopping': True}
+
+        raise Exception('Unknown command {}.'.format(command))
+
+    # start from latest existing snapshot, next one is taken when its interval passes
+    def load_latest(self):
+        # snapshots left by killed daemon
+        for name in os.listdir(self.output_dir):
+            if name.startswith(SNAPSHOT_PREFIX) and name.endswith('.tmp'):
+                os.remove(os.path.join(self.output_dir, name))
+
+        snapshots = list_snapshots(self.output_dir)
+        if not snapshots:
+            self.next_time = time.time()
+            return
+
+        try:
+            self.set_base(snapshots[-1])
+            self.next_time = os.path.getmtime(snapshots[-1]) + self.interval
+            self.log('base snapshot {}'.format(snapshots[-1]))
+        except Exception as e:
+            self.next_time = time.time()
+            self.log('base snapshot {} can not be loaded: {}'.format(snapshots[-1], e))
+
+    # wait for interval or request and take snapshots, until stopped by API, SIGTERM or SIGINT
+    def run(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        self.img = Ext4Image(self.fs)
+
+        # running snapshot is aborted by signal, its temporary file is removed
+        def interrupt(signum, frame):
+            raise KeyboardInterrupt()
+        signal.signal(signal.SIGTERM, interrupt)
+
+        try:
+            self.load_latest()
+            self.server = start_unix_server(self.socket_path, self)
+            self.log('listening on {}'.format(self.socket_path))
+
+            while True:
+                with self.changed:
+                    while not self.stopping and not self.requested and time.time() < self.next_time:
+                        self.changed.wait(self.next_time - time.time())
+
+                    if self.stopping:
+                        break
+
+                    started = time.time()
+                    self.requested = False
+                    self.running = True
+                    self.next_time = started + self.interval
+
+                self.take_snapshot(started)
+        except KeyboardInterrupt:
+            self.log('interrupted')
+        finally:
+            self.stop()
+            if self.server is not None:
+                stop_server(self.server)
+            if hasattr(self.base, 'close'):
+                self.base.close()
+            self.img.close()
+            self.log('stopped')
@@ -0,0 +1,209 @@
+import os
+import signal
+import stat
+import threading
+import time
+
+from src.api import start_http_server, start_unix_server, stop_server
+from src.utils import (Ext4Image, FreeInodes, get_conflicting_chunks, get_descriptor_state, get_paths_with_prefix,
+    get_used_blocks, list_deleted_from_image, load_snapshot, recover_files_from_image)
+
+#
+# QUERY SERVER
+#
+# keeps snapshot loaded and allocation bitmaps of fs image in memory, so that many ls, stat and recover requests
+# do not load them again
+#
+# bitmaps are read again, when modification time of image or group descriptors change; mtime is checked
+# on each request, group descriptors are read again only when mtime changes, or always for block devices,
+# whose mtime does not change with writes
+#
+# API on Unix socket or HTTP on localhost, see src/api.py
+#   {"command": "status"}
+#   {"command": "ls", "patterns": ["/home/"], "min_size": 0, "max_size": 1024, "status": "ok"}
+#                                                             deleted files, all arguments are optional
+#   {"command": "stat", "path": "/my_file.jpg"}               record of file in snapshot and its state in image
+#   {"command": "prefix", "prefix": "/home/", "limit": 100}   paths in snapshot under prefix
+#   {"command": "recover", "patterns": ["/home/"], "output_dir": "/abs/dir", "force": false, "jobs": 1}
+#
+# recover writes files to directory given by client, so it is accepted only on Unix socket
+#
+
+# commands, that are accepted over HTTP
+HTTP_COMMANDS = ('status', 'ls', 'stat', 'prefix')
+
+class QueryServer:
+    def __init__(self, fs, snapshot_file):
+        self.fs = fs
+        self.snapshot_file = snapshot_file
+        self.http_commands = HTTP_COMMANDS
+
+        self.img = Ext4Image(fs)
+        self.snapshot = load_snapshot(snapshot_file)
+
+        # requests are handled one by one, they share opened image and memory mapped snapshot
+        self.lock = threading.Lock()
+
+        # state of image, when bitmaps were read
+        self.mtime = None
+        self.descriptors = None
+
+        # deleted inodes and used blocks, None until needed
+        self.free_inodes = None
+        self.used_blocks = None
+        self.bitmaps_time = None
+        self.bitmaps_loads = 0
+        self.requests = 0
+
+    # forget bitmaps, when image has changed
+    def check_image(self):
+        st = os.fstat(self.img.fd)
+        if self.free_inodes is not None and st.st_mtime_ns == self.mtime and not stat.S_ISBLK(st.st_mode):
+            return
+
+        self.img.refresh()
+        sb = self.img.sb
+        descriptors = [get_descriptor_state(bg) for bg in sb['Block groups']]
+
+        if descriptors != self.descriptors or st.st_mtime_ns != self.mtime:
+            self.free_inodes = None
+            self.used_blocks = None
+
+        self.mtime = st.st_mtime_ns
+        self.descriptors = descriptors
+
+    # get (free inodes, used blocks) of current image
+    def get_bitmaps(self):
+        self.check_image()
+
+        if self.free_inodes is None:
+            sb = self.img.sb
+            self.free_inodes = FreeInodes(self.img, sb)
+            self.used_blocks = get_used_blocks(self.img, sb)
+            self.bitmaps_time = time.time()
+            self.bitmaps_loads += 1
+
+        return self.free_inodes, self.used_blocks
+
+    def get_status(self):
+        return {
+            'image': self.fs,
+            'snapshot': self.snapshot_file,
+            'files': len(self.snapshot['inodes']),
+            'bitmaps_loaded': self.bitmaps_time,
+            'bitmaps_loads': self.bitmaps_loads,
+            'requests': self.requests,
+        }
+
+    def ls(self, patterns=None, min_size=None, max_size=None, status=None):
+        if isinstance(patterns, str):
+            patterns = [patterns]
+        if status not in (None, 'ok', 'err'):
+            raise Exception('Status must be ok or err.')
+
+        free_inodes, used_blocks = self.get_bitmaps()
+        files = list_deleted_from_image(self.img, self.snapshot, patterns, min_size, max_size, None if status is None else status == 'ok', free_inodes, used_blocks)
+        return {'total': len(files), 'files': files}
+
+    def stat(self, path):
+        inode_id = self.snapshot['dirs'].get(path)
+        if inode_id is None:
+            raise Exception('File {} was not found.'.format(path))
+
+        size, chunks = self.snapshot['inodes'][inode_id]
+        free_inodes, used_blocks = self.get_bitmaps()
+        conflicting = get_conflicting_chunks(self.img, self.img.sb, used_blocks, chunks)
+
+        return {
+            'path': path,
+            'inode_id': inode_id,
+            'size': size,
+            'chunks': chunks,
+            'deleted': inode_id in free_inodes,
+            'can_be_recovered': not conflicting,
+            'conflicting_chunks': conflicting,
+        }
+
+    def find_prefix(self, prefix, limit=None):
+        paths = []
+        for path, inode_id in get_paths_with_prefix(self.snapshot, prefix):
+            if limit is not None and len(paths) >= limit:
+                return {'paths': paths, 'truncated': True}
+            paths.append([path, inode_id])
+
+        return {'paths': paths, 'truncated': False}
+
+    def recover(self, patterns, output_dir, force=False, jobs=1):
+        if isinstance(patterns, str):
+            patterns = [patterns]
+        if not os.path.isabs(output_dir):
+            raise Exception('Output directory must be absolute path.')
+
+        copy_stats = {}
+        if force:
+            results = recover_files_from_image(self.img, self.snapshot, patterns, output_dir, False, jobs, copy_stats=copy_stats)
+        else:
+            free_inodes, used_blocks = self.get_bitmaps()
+            results = recover_files_from_image(self.img, self.snapshot, patterns, output_dir, True, jobs, free_inodes, used_blocks, copy_stats)
+
+        return {'results': results, 'bytes': copy_stats['bytes'], 'seconds': copy_stats['seconds']}
+
+    def handle_request(self, request):
+        command = request.get('command')
+
+        with self.lock:
+            self.requests += 1
+
+            if command == 'status':
+                return self.get_status()
+
+            if command == 'ls':
+                min_size = request.get('min_size')
+                max_size = request.get('max_size')
+                return self.ls(
+                    request.get('patterns'),
+                    int(min_size) if min_size is not None else None,
+                    int(max_size) if max_size is not None else None,
+                    request.get('status')
+                )
+
+            if command == 'stat':
+                return self.stat(request['path'])
+
+            if command == 'prefix':
+                limit = request.get('limit')
+                return self.find_prefix(request.get('prefix', '/'), int(limit) if limit is not None else None)
+
+            if command == 'recover':
+                return self.recover(request['patterns'], request['output_dir'], request.get('force', False), int(request.get('jobs', 1)))
+
+        raise Exception('Unknown command {}.'.format(command))
+
+    # serve requests, until stopped by SIGTERM or SIGINT
+    def run(self, socket_path=None, http_port=None):
+        def interrupt(signum, frame):
+            raise KeyboardInterrupt()
+        signal.signal(signal.SIGTERM, interrupt)
+
+        servers = []
+        try:
+            # bitmaps are ready for first request
+            with self.lock:
+                self.get_bitmaps()
+
+            if socket_path is not None:
+                servers.append(start_unix_server(socket_path, self))
+                print('listening on {}'.format(socket_path), flush=True)
+            if http_port is not None:
+                servers.append(start_http_server(http_port, self))
+                print('listening on http://127.0.0.1:{}/'.format(servers[-1].server_port), flush=True)
+
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for server in servers:
+                stop_server(server)
+            if hasattr(self.snapshot, 'close'):
+                self.snapshot.close()
+            self.img.close()
@@ -0,0 +1,713 @@
+import heapq
+import itertools
+import json
+import mmap
+import os
+import struct
+import tempfile
+import uuid
+from array import array
+from bisect import bisect_left, bisect_right
+from collections.abc import Mapping
+
+#
+# BINARY SNAPSHOT FORMAT
+#
+# header
+#   0x00   4 bytes   magic 'E4BP'
+#   0x04   __le16    version, other versions are not read
+#   0x06   __le16    (reserved)
+#   0x08   __le64    inodes count
+#   0x10   __le64    inodes table offset
+#   0x18   __le64    extents count
+#   0x20   __le64    extents table offset
+#   0x28   __le64    paths count
+#   0x30   __le64    paths table offset
+#   0x38   __le64    paths table size
+#   0x40   __le64    paths index count
+#   0x48   __le64    paths index offset
+#   0x50  16 bytes   filesystem uuid
+#   0x60   __le64    maximum depth of directory traversal
+#   0x68   __le64    groups count
+#   0x70   __le64    groups table offset
+#   0x78   __le64    directories count
+#   0x80   __le64    directories table offset
+#   0x88   __le64    directories table size
+#   0x90   __le64    directories index count
+#   0x98   __le64    directories index offset
+#
+# inodes table, sorted by inode id
+#   0x00   __le32    inode id
+#   0x04   __le32    extents count
+#   0x08   __le64    file size
+#   0x10   __le64    index of first extent in extents table
+#
+# extents table
+#   0x00   __le64    physical address in bytes
+#   0x08   __le64    length in bytes
+#   0x10   __le64    logical offset in file in bytes
+#   0x18   __le32    flags, 0x1 unwritten
+#
+# paths table, sorted by path
+#   0x00   __le32    inode id
+#   0x04   __le16    length of prefix shared with previous path
+#   0x06   __le16    length of rest of path
+#   0x08   n bytes   rest of path, utf-8
+#
+# paths index, offset of every n-th path in paths table
+#   0x00   __le64    offset relative to paths table
+#   indexed paths share no prefix with previous path
+#
+# groups table, state of each block group
+#   0x00   __le32    block bitmap checksum
+#   0x04   __le32    inode bitmap checksum
+#   0x08   __le32    free blocks count
+#   0x0C   __le32    free inodes count
+#   0x10   __le32    used directories count
+#   0x14   __le32    unused inodes count
+#   0x18  16 bytes   digest of used inodes
+#
+# directories table + directories index, same as paths table + paths index
+#
+
+SNAPSHOT_MAGIC = b'E4BP'
+SNAPSHOT_VERSION = 5
+
+HEADER_STRUCT = struct.Struct('<4sHH9Q16s8Q')
+INODE_STRUCT = struct.Struct('<IIQQ')
+EXTENT_STRUCT = struct.Struct('<QQQI')
+
+# extent flags
+EXTENT_UNWRITTEN = 0x1
+PATH_STRUCT = struct.Struct('<IHH')
+PATHS_INDEX_STRUCT = struct.Struct('<Q')
+GROUP_STRUCT = struct.Struct('<6I16s')
+
+# every n-th path is stored in paths index, lookup then reads at most n paths
+PATHS_INDEX_INTERVAL = 64
+
+# default limit of memory used by records buffered by snapshot writer, before they are spilled to temporary files
+SNAPSHOT_MEMORY_LIMIT = 256 * 1024 * 1024
+
+# estimated memory used by one buffered record besides its data
+RECORD_OVERHEAD = 64
+
+SPOOL_RECORD_STRUCT = struct.Struct('<I')
+CHUNKS_SIZE_STRUCT = struct.Struct('<Q')
+PATH_RECORD_INODE_STRUCT = struct.Struct('>I')
+
+# get logical offset of each chunk -> [(offset, chunk), ...]; older snapshots have continuous chunks without offsets
+def get_chunks_offsets(chunks):
+    offset = 0
+    for chunk in chunks:
+        offset = chunk.get('offset', offset)
+        yield offset, chunk
+        offset += chunk['len']
+
+# check whether file is binary snapshot
+def is_binary_snapshot(file_path):
+    with open(file_path, 'rb') as fh:
+        return fh.read(len(SNAPSHOT_MAGIC)) == SNAPSHOT_MAGIC
+
+# pack chunks to extents table records
+def pack_extents(chunks):
+    return b''.join(EXTENT_STRUCT.pack(
+        chunk['addr'], chunk['len'], offset, EXTENT_UNWRITTEN if chunk.get('unwritten') else 0
+    ) for offset, chunk in get_chunks_offsets(chunks))
+
+# unpack extents table records to chunks
+def unpack_extents(data):
+    return [{
+        'addr': addr,
+        'len': length,
+        'offset': file_offset,
+        'unwritten': bool(flags & EXTENT_UNWRITTEN)
+    } for addr, length, file_offset, flags in EXTENT_STRUCT.iter_unpack(data)]
+
+# pack size and chunks of inode to one record
+def pack_chunks(size, chunks):
+    return CHUNKS_SIZE_STRUCT.pack(size) + pack_extents(chunks)
+
+# unpack record of inode -> (size, chunks)
+def unpack_chunks(data):
+    return CHUNKS_SIZE_STRUCT.unpack_from(data)[0], unpack_extents(data[CHUNKS_SIZE_STRUCT.size:])
+
+# pack path and inode id to one record, records are sorted by path
+def pack_path_record(path, inode_id):
+    return path + b'\0' + PATH_RECORD_INODE_STRUCT.pack(inode_id)
+
+# unpack record of path -> (path, inode_id)
+def unpack_path_record(record):
+    return record[:-PATH_RECORD_INODE_STRUCT.size - 1], PATH_RECORD_INODE_STRUCT.unpack_from(record, len(record) - PATH_RECORD_INODE_STRUCT.size)[0]
+
+# get length of prefix shared by two paths, compared by halves of prefix
+def get_shared_length(a, b):
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[:mid] == b[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+
+    return lo
+
+# front coding of sorted (path, inode_id) -> (shared, rest, inode_id) for each path, where shared is length of prefix
+# shared with previous path; every n-th path is whole, so that it can be looked up from paths index
+def encode_paths(paths):
+    previous = None
+    for index, (path, inode_id) in enumerate(paths):
+        shared = 0 if index % PATHS_INDEX_INTERVAL == 0 else get_shared_length(previous, path)
+        yield shared, path[shared:], inode_id
+        previous = path
+
+# records kept in memory up to memory limit, then spilled to temporary files; they can be read only once
+# sorted spool sorts records of each spilled run, runs are merged when reading
+class Spool:
+    def __init__(self, memory_limit, tmp_dir=None, sort=False):
+        self.memory_limit = memory_limit
+        self.tmp_dir = tmp_dir
+        self.sort = sort
+        self.records = []
+        self.memory = 0
+        self.count = 0
+        self.runs = []
+
+    def add(self, record):
+        self.records.append(record)
+        self.memory += len(record) + RECORD_OVERHEAD
+        self.count += 1
+
+        if self.memory >= self.memory_limit:
+            self.spill()
+
+    # write buffered records to temporary file, unsorted spool has only one file
+    def spill(self):
+        if self.sort:
+            self.records.sort()
+
+        if self.sort or not self.runs:
+            self.runs.append(tempfile.TemporaryFile(dir=self.tmp_dir))
+
+        self.runs[-1].write(b''.join(SPOOL_RECORD_STRUCT.pack(len(record)) + record for record in self.records))
+        self.records = []
+        self.memory = 0
+
+    def iter_run(self, fh):
+        fh.seek(0)
+        while True:
+            header = fh.read(SPOOL_RECORD_STRUCT.size)
+            if not header:
+                break
+            yield fh.read(SPOOL_RECORD_STRUCT.unpack(header)[0])
+
+    def __iter__(self):
+        runs = [self.iter_run(fh) for fh in self.runs]
+        if self.sort:
+            self.records.sort()
+            return heapq.merge(*runs, self.records)
+
+        return itertools.chain(*runs, self.records)
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        for fh in self.runs:
+            fh.close()
+        self.runs = []
+        self.records = []
+
+# lists of records for ascending integer keys in temporary file, looked up by binary search of keys in memory
+class KeyedSpool:
+    def __init__(self, tmp_dir=None):
+        self.fh = tempfile.TemporaryFile(dir=tmp_dir)
+        self.keys = array('Q')
+        self.offsets = array('Q')
+        self.size = 0
+
+    def add(self, key, records):
+        assert not self.keys or key > self.keys[-1]
+
+        data = b''.join(SPOOL_RECORD_STRUCT.pack(len(record)) + record for record in records)
+        self.keys.append(key)
+        self.offsets.append(self.size)
+        self.fh.write(data)
+        self.size += len(data)
+
+    # get records of given key, or None
+    def get(self, key):
+        index = bisect_left(self.keys, key)
+        if index == len(self.keys) or self.keys[index] != key:
+            return None
+
+        start = self.offsets[index]
+        end = self.offsets[index + 1] if index + 1 < len(self.offsets) else self.size
+
+        self.fh.flush()
+        data = os.pread(self.fh.fileno(), end - start, start)
+
+        records = []
+        offset = 0
+        while offset < len(data):
+            length = SPOOL_RECORD_STRUCT.unpack_from(data, offset)[0]
+            offset += SPOOL_RECORD_STRUCT.size
+            records.append(data[offset:offset + length])
+            offset += length
+
+        return records
+
+    def __contains__(self, key):
+        index = bisect_left(self.keys, key)
+        return index < len(self.keys) and self.keys[index] == key
+
+    def close(self):
+        self.fh.close()
+
+# write paths table and its index from sorted (path, inode_id) -> (count, offset, size, index count, index offset)
+def write_paths(fh, paths):
+    paths_offset = fh.tell()
+    paths_index = []
+    count = 0
+    for shared, rest, inode_id in encode_paths(paths):
+        if count % PATHS_INDEX_INTERVAL == 0:
+            paths_index.append(fh.tell() - paths_offset)
+
+        fh.write(PATH_STRUCT.pack(inode_id, shared, len(rest)))
+        fh.write(rest)
+        count += 1
+    paths_size = fh.tell() - paths_offset
+
+    paths_index_offset = fh.tell()
+    fh.write(b''.join(PATHS_INDEX_STRUCT.pack(offset) for offset in paths_index))
+
+    return count, paths_offset, paths_size, len(paths_index), paths_index_offset
+
+# writer of binary snapshot, inodes must be added in order of inode ids
+# extents are written to file at once, inodes table and sorted paths are spooled until `finish`
+class BinarySnapshotWriter:
+    def __init__(self, file_path, memory_limit=SNAPSHOT_MEMORY_LIMIT, tmp_dir=None):
+        self.fh = open(file_path, 'wb')
+
+        # header is written at the end, when all offsets are known
+        self.fh.write(b'\0' * HEADER_STRUCT.size)
+
+        self.extents_offset = self.fh.tell()
+        self.extents_count = 0
+        self.last_inode_id = 0
+
+        # most of memory is used by paths, that must be sorted
+        self.inodes = Spool(memory_limit // 8, tmp_dir)
+        self.paths = Spool(memory_limit // 2, tmp_dir, sort=True)
+        self.directories = Spool(memory_limit // 8, tmp_dir, sort=True)
+
+    def add_inode(self, inode_id, size, chunks):
+        assert inode_id > self.last_inode_id
+        self.last_inode_id = inode_id
+
+        self.inodes.add(INODE_STRUCT.pack(inode_id, len(chunks), size, self.extents_count))
+        self.fh.write(pack_extents(chunks))
+        self.extents_count += len(chunks)
+
+    def add_path(self, path, inode_id):
+        self.paths.add(pack_path_record(path.encode('utf-8'), inode_id))
+
+    def add_directory(self, path, inode_id):
+        self.directories.add(pack_path_record(path.encode('utf-8'), inode_id))
+
+    # write remaining tables and header, state contains 'groups', 'uuid' and 'dirs_max_depth'
+    def finish(self, state):
+        fh = self.fh
+
+        # inodes table
+        inodes_offset = fh.tell()
+        for record in self.inodes:
+            fh.write(record)
+
+        # paths table + paths index
+        paths = write_paths(fh, map(unpack_path_record, self.paths))
+
+        # groups table
+        groups = state.get('groups') or []
+        groups_offset = fh.tell()
+        fh.write(b''.join(GROUP_STRUCT.pack(*group['descriptor'], bytes.fromhex(group['digest'])) for group in groups))
+
+        # directories table + directories index
+        directories = write_paths(fh, map(unpack_path_record, self.directories))
+
+        fh.seek(0)
+        fh.write(HEADER_STRUCT.pack(
+            SNAPSHOT_MAGIC, SNAPSHOT_VERSION, 0,
+            len(self.inodes), inodes_offset,
+            self.extents_count, self.extents_offset,
+            *paths,
+            uuid.UUID(state['uuid']).bytes if state.get('uuid') else bytes(16),
+            state.get('dirs_max_depth') or 0,
+            len(groups), groups_offset,
+            *directories
+        ))
+
+        self.abort()
+
+    def abort(self):
+        self.fh.close()
+        self.inodes.close()
+        self.paths.close()
+        self.directories.close()
+
+# writer of JSON snapshot, inodes are written to file at once, sorted paths are spooled until `finish`
+# paths are written with front coding as [[shared, rest, inode_id], ...], same as paths table of binary snapshot
+class JSONSnapshotWriter:
+    def __init__(self, file_path, memory_limit=SNAPSHOT_MEMORY_LIMIT, tmp_dir=None):
+        self.fh = open(file_path, 'w', encoding='utf-8')
+        self.fh.write('{"inodes": {')
+        self.count = 0
+        self.paths = Spool(memory_limit // 2, tmp_dir, sort=True)
+        self.directories = Spool(memory_limit // 8, tmp_dir, sort=True)
+
+    def add_inode(self, inode_id, size, chunks):
+        self.fh.write('{}{}: {}'.format(', ' if self.count else '', json.dumps(str(inode_id)), json.dumps([size, chunks])))
+        self.count += 1
+
+    def add_path(self, path, inode_id):
+        self.paths.add(pack_path_record(path.encode('utf-8'), inode_id))
+
+    def add_directory(self, path, inode_id):
+        self.directories.add(pack_path_record(path.encode('utf-8'), inode_id))
+
+    # write front coded paths from spool
+    def write_paths(self, key, spool):
+        self.fh.write(', {}: ['.format(json.dumps(key)))
+        paths = ((path.decode('utf-8'), inode_id) for path, inode_id in map(unpack_path_record, spool))
+        for index, entry in enumerate(encode_paths(paths)):
+            self.fh.write('{}{}'.format(', ' if index else '', json.dumps(entry)))
+        self.fh.write(']')
+
+    # write paths, directories and state, that contains 'groups', 'uuid' and 'dirs_max_depth'
+    def finish(self, state):
+        self.fh.write('}')
+        self.write_paths('dirs', self.paths)
+        self.write_paths('directories', self.directories)
+
+        for key, value in state.items():
+            self.fh.write(', {}: {}'.format(json.dumps(key), json.dumps(value)))
+        self.fh.write('}')
+
+        self.abort()
+
+    def abort(self):
+        self.fh.close()
+        self.paths.close()
+        self.directories.close()
+
+# writer of snapshot dict, that is kept in memory
+class DictSnapshotWriter:
+    def __init__(self):
+        self.snapshot = {
+            'dirs': {},
+            'inodes': {},
+            'directories': {}
+        }
+
+    def add_inode(self, inode_id, size, chunks):
+        self.snapshot['inodes'][inode_id] = size, chunks
+
+    def add_path(self, path, inode_id):
+        self.snapshot['dirs'][path] = inode_id
+
+    def add_directory(self, path, inode_id):
+        self.snapshot['directories'][path] = inode_id
+
+    # get whole snapshot with state, that contains 'groups', 'uuid' and 'dirs_max_depth'
+    def finish(self, state):
+        self.snapshot.update(state)
+        return self.snapshot
+
+    def abort(self):
+        pass
+
+# save snapshot {'dirs': {path: inode_id}, 'inodes': {inode_id: (size, chunks)}, ...} to binary file
+def save_binary_snapshot(file_path, snapshot):
+    writer = BinarySnapshotWriter(file_path)
+
+    for inode_id in sorted(snapshot['inodes']):
+        size, chunks = snapshot['inodes'][inode_id]
+        writer.add_inode(inode_id, size, chunks)
+
+    for path, inode_id in snapshot['dirs'].items():
+        writer.add_path(path, inode_id)
+
+    for path, inode_id in (snapshot.get('directories') or {}).items():
+        writer.add_directory(path, inode_id)
+
+    writer.finish({key: snapshot.get(key) for key in ('groups', 'uuid', 'dirs_max_depth')})
+
+# inodes of binary snapshot {inode_id: (size, chunks)}, looked up by binary search
+class SnapshotInodes(Mapping):
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+    # get position of inode in inodes table, or None
+    def find(self, inode_id):
+        s = self.snapshot
+        lo, hi = 0, s.inodes_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_id = INODE_STRUCT.unpack_from(s.mm, s.inodes_offset + mid * INODE_STRUCT.size)[0]
+            if mid_id < inode_id:
+                lo = mid + 1
+            elif mid_id > inode_id:
+                hi = mid
+            else:
+                return mid
+
+        return None
+
+    # read inode at given position of inodes table
+    def read(self, index):
+        s = self.snapshot
+        inode_id, extents_count, size, first_extent = INODE_STRUCT.unpack_from(s.mm, s.inodes_offset + index * INODE_STRUCT.size)
+
+        offset = s.extents_offset + first_extent * EXTENT_STRUCT.size
+        data = s.mm[offset:offset + extents_count * EXTENT_STRUCT.size]
+
+        return inode_id, (size, unpack_extents(data))
+
+    def __getitem__(self, inode_id):
+        index = self.find(inode_id)
+        if index is None:
+            raise KeyError(inode_id)
+
+        return self.read(index)[1]
+
+    def __contains__(self, inode_id):
+        return self.find(inode_id) is not None
+
+    def __iter__(self):
+        s = self.snapshot
+        for index in range(s.inodes_count):
+            yield INODE_STRUCT.unpack_from(s.mm, s.inodes_offset + index * INODE_STRUCT.size)[0]
+
+    def __len__(self):
+        return self.snapshot.inodes_count
+
+    # iterate (inode_id, (size, chunks)), without looking up every inode
+    def items(self):
+        for index in range(self.snapshot.inodes_count):
+            yield self.read(index)
+
+    # iterate (inode_id, (size, chunks)) of inodes with first <= inode_id < end
+    def items_in_range(self, first, end):
+        s = self.snapshot
+
+        # find first inode >= first
+        lo, hi = 0, s.inodes_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if INODE_STRUCT.unpack_from(s.mm, s.inodes_offset + mid * INODE_STRUCT.size)[0] < first:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        for index in range(lo, s.inodes_count):
+            inode_id, value = self.read(index)
+            if inode_id >= end:
+                break
+            yield inode_id, value
+
+# paths of binary snapshot {path: inode_id}, looked up by binary search in sparse paths index
+class SnapshotPaths(Mapping):
+    def __init__(self, snapshot, count, offset, size, index_count, index_offset):
+        self.snapshot = snapshot
+        self.count = count
+        self.offset = offset
+        self.size = size
+        self.index_count = index_count
+        self.index_offset = index_offset
+
+    # read path record at given offset, following given previous path -> (path, inode_id, next_offset)
+    def read(self, offset, previous=b''):
+        mm = self.snapshot.mm
+        inode_id, shared, length = PATH_STRUCT.unpack_from(mm, offset)
+        offset += PATH_STRUCT.size
+
+        return previous[:shared] + mm[offset:offset + length], inode_id, offset + length
+
+    # iterate raw (path, inode_id) from given offset of indexed path until end of paths table
+    def iter_raw(self, offset):
+        end = self.offset + self.size
+        path = b''
+        while offset < end:
+            path, inode_id, offset = self.read(offset, path)
+            yield path, inode_id
+
+    # get offset of indexed path, after which given path would be stored
+    def find(self, path):
+        mm = self.snapshot.mm
+
+        # find last indexed path, that is <= given path
+        lo, hi = 0, self.index_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset = PATHS_INDEX_STRUCT.unpack_from(mm, self.index_offset + mid * PATHS_INDEX_STRUCT.size)[0]
+            if self.read(self.offset + offset)[0] <= path:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        if lo == 0:
+            return self.offset
+
+        offset = PATHS_INDEX_STRUCT.unpack_from(mm, self.index_offset + (lo - 1) * PATHS_INDEX_STRUCT.size)[0]
+        return self.offset + offset
+
+    # iterate (path, inode_id) of whole paths table
+    def items(self):
+        for path, inode_id in self.iter_raw(self.offset):
+            yield path.decode('utf-8'), inode_id
+
+    # iterate (path, inode_id) of paths, that start with given prefix, e.g. '/var/lib/db/'
+    def items_with_prefix(self, prefix):
+        prefix = prefix.encode('utf-8')
+        for path, inode_id in self.iter_raw(self.find(prefix)):
+            if path.startswith(prefix):
+                yield path.decode('utf-8'), inode_id
+            elif path > prefix:
+                break
+
+    def values(self):
+        for path, inode_id in self.items():
+            yield inode_id
+
+    def __iter__(self):
+        for path, inode_id in self.items():
+            yield path
+
+    def __getitem__(self, path):
+        key = path.encode('utf-8')
+        for entry_path, inode_id in self.iter_raw(self.find(key)):
+            if entry_path == key:
+                return inode_id
+            if entry_path > key:
+                break
+
+        raise KeyError(path)
+
+    def __len__(self):
+        return self.count
+
+# paths of JSON snapshot {path: inode_id}, front coded as [[shared, rest, inode_id], ...]
+# looked up by binary search in whole paths, that are kept for every n-th path
+class EncodedPaths(Mapping):
+    def __init__(self, entries):
+        self.entries = entries
+        self.index = [entries[i][1] for i in range(0, len(entries), PATHS_INDEX_INTERVAL)]
+
+    # iterate (path, inode_id) from given indexed path until end of paths
+    def iter_from(self, index):
+        entries = self.entries
+        path = ''
+        for i in range(index * PATHS_INDEX_INTERVAL, len(entries)):
+            shared, rest, inode_id = entries[i]
+            path = path[:shared] + rest
+            yield path, inode_id
+
+    # get last indexed path, that is <= given path
+    def find(self, path):
+        return max(bisect_right(self.index, path) - 1, 0)
+
+    def items(self):
+        return self.iter_from(0)
+
+    # iterate (path, inode_id) of paths, that start with given prefix, e.g. '/var/lib/db/'
+    def items_with_prefix(self, prefix):
+        for path, inode_id in self.iter_from(self.find(prefix)):
+            if path.startswith(prefix):
+                yield path, inode_id
+            elif path > prefix:
+                break
+
+    def values(self):
+        return (inode_id for shared, rest, inode_id in self.entries)
+
+    def __iter__(self):
+        for path, inode_id in self.items():
+            yield path
+
+    def __getitem__(self, path):
+        for entry_path, inode_id in self.iter_from(self.find(path)):
+            if entry_path == path:
+                return inode_id
+            if entry_path > path:
+                break
+
+        raise KeyError(path)
+
+    def __len__(self):
+        return len(self.entries)
+
+# binary snapshot file, memory mapped so that only needed records are read
+class BinarySnapshot:
+    def __init__(self, file_path):
+        self.fh = open(file_path, 'rb')
+        self.mm = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version = struct.unpack_from('<4sH', self.mm)
+        if magic != SNAPSHOT_MAGIC:
+            raise Exception('Not a binary snapshot.')
+
+        if version != SNAPSHOT_VERSION:
+            raise Exception('Unsupported snapshot version {}.'.format(version))
+
+        header = HEADER_STRUCT.unpack_from(self.mm)
+        (_, self.version, _,
+            self.inodes_count, self.inodes_offset,
+            self.extents_count, self.extents_offset) = header[:7]
+        paths = header[7:12]
+        uuid_bytes, self.dirs_max_depth, self.groups_count, self.groups_offset = header[12:16]
+        directories = header[16:21]
+
+        self.uuid = str(uuid.UUID(bytes=uuid_bytes)) if any(uuid_bytes) else None
+        self.inodes = SnapshotInodes(self)
+        self.dirs = SnapshotPaths(self, *paths)
+        self.directories = SnapshotPaths(self, *directories)
+
+    # read state of block groups -> [{'descriptor': [...], 'digest': hex}, ...]
+    def read_groups(self):
+        data = self.mm[self.groups_offset:self.groups_offset + self.groups_count * GROUP_STRUCT.size]
+        return [{
+            'descriptor': list(group[:6]),
+            'digest': group[6].hex()
+        } for group in GROUP_STRUCT.iter_unpack(data)]
+
+    # snapshot can be used as dict {'dirs': ..., 'inodes': ..., ...}
+    def __getitem__(self, key):
+        if key == 'dirs':
+            return self.dirs
+        if key == 'inodes':
+            return self.inodes
+        if key == 'directories':
+            return self.directories
+        if key == 'groups':
+            return self.read_groups()
+        if key == 'uuid':
+            return self.uuid
+        if key == 'dirs_max_depth':
+            return self.dirs_max_depth
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def close(self):
+        self.mm.close()
+        self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
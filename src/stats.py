@@ -0,0 +1,170 @@
+import time
+from collections import Counter
+
+#
+# STATISTICS
+#
+# statistics of one run, it is dict that can be saved as JSON
+#
+# {
+#   'phases': {name: {'wall': s, 'cpu': s, 'reads': n, 'bytes': n, 'seek': n}, ...},
+#   'counters': {name: n, ...},
+#   'histograms': {name: {value: n, ...}, ...}
+# }
+#
+# time and reads are counted to innermost running phase, time outside of all phases to 'other'
+# seek distance is sum of distances between end of previous read and start of next read
+# phases of worker processes are added, so their wall time is sum of wall times of all workers
+#
+
+# phase of statistics, that can be entered repeatedly
+class StatsPhase:
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.stats.enter(self.name)
+
+    def __exit__(self, *args):
+        self.stats.leave()
+
+class Stats(dict):
+    def __init__(self):
+        super().__init__(phases={}, counters=Counter(), histograms={})
+        self.stack = ['other']
+        self.phase_objects = {}
+        self.last_wall = time.perf_counter()
+        self.last_cpu = time.process_time()
+        self.last_offset = None
+
+    # get statistics of phase, it is created when needed
+    def get_phase(self, name):
+        phase = self['phases'].get(name)
+        if phase is None:
+            phase = self['phases'][name] = {'wall': 0.0, 'cpu': 0.0, 'reads': 0, 'bytes': 0, 'seek': 0}
+        return phase
+
+    # add time from last mark to running phase
+    def mark(self):
+        wall, cpu = time.perf_counter(), time.process_time()
+        phase = self.get_phase(self.stack[-1])
+        phase['wall'] += wall - self.last_wall
+        phase['cpu'] += cpu - self.last_cpu
+        self.last_wall, self.last_cpu = wall, cpu
+
+    def enter(self, name):
+        self.mark()
+        self.stack.append(name)
+
+    def leave(self):
+        self.mark()
+        self.stack.pop()
+
+    # context manager of phase, e.g. `with stats.phase('inode_tables'): ...`
+    def phase(self, name):
+        phase = self.phase_objects.get(name)
+        if phase is None:
+            phase = self.phase_objects[name] = StatsPhase(self, name)
+        return phase
+
+    # count one read of given length at given offset to running phase
+    def add_read(self, offset, length):
+        phase = self.get_phase(self.stack[-1])
+        phase['reads'] += 1
+        phase['bytes'] += length
+        if self.last_offset is not None:
+            phase['seek'] += abs(offset - self.last_offset)
+        self.last_offset = offset + length
+
+    def count(self, name, value=1):
+        self['counters'][name] += value
+
+    # count values of histogram, e.g. depths of extent trees {depth: count}
+    def count_histogram(self, name, values):
+        histogram = self['histograms'].get(name)
+        if histogram is None:
+            histogram = self['histograms'][name] = Counter()
+        histogram.update(values)
+
+    # stop counting time, e.g. before output
+    def finish(self):
+        self.mark()
+
+    # get plain dict, that can be sent from worker process or saved as JSON
+    def to_dict(self):
+        self.mark()
+        result = dict(self)
+        result['phases'] = {name: dict(phase) for name, phase in self['phases'].items()}
+        result['counters'] = dict(self['counters'])
+        result['histograms'] = {name: {str(k): v for k, v in sorted(histogram.items())} for name, histogram in self['histograms'].items() if histogram}
+        return result
+
+    # add statistics from worker process, given by `to_dict`
+    def merge(self, other):
+        for name, other_phase in other['phases'].items():
+            phase = self.get_phase(name)
+            for key, value in other_phase.items():
+                phase[key] += value
+
+        self['counters'].update(other['counters'])
+        for name, histogram in other['histograms'].items():
+            # keys were converted to strings, numeric ones are converted back
+            self.count_histogram(name, {int(k) if k.isdigit() else k: v for k, v in histogram.items()})
+
+    # get readable text of statistics
+    def format(self):
+        data = self.to_dict()
+        lines = ['{:<20}{:>10}{:>10}{:>10}{:>14}{:>16}'.format('phase', 'wall s', 'cpu s', 'reads', 'bytes read', 'seek distance')]
+
+        total = Counter()
+        for name, phase in data['phases'].items():
+            lines.append('{:<20}{:>10.3f}{:>10.3f}{:>10}{:>14}{:>16}'.format(name, phase['wall'], phase['cpu'], phase['reads'], phase['bytes'], phase['seek']))
+            total.update(phase)
+        lines.append('{:<20}{:>10.3f}{:>10.3f}{:>10}{:>14}{:>16}'.format('total', total['wall'], total['cpu'], total['reads'], total['bytes'], total['seek']))
+
+        if data['counters']:
+            lines.append('')
+            for name, value in sorted(data['counters'].items()):
+                lines.append('{:<40}{:>14}'.format(name, value))
+
+        for name, histogram in sorted(data['histograms'].items()):
+            lines.append('')
+            lines.append('{}:'.format(name))
+            for key, value in histogram.items():
+                lines.append('  {:<38}{:>14}'.format(key, value))
+
+        # other values, e.g. copied bytes
+        other = {key: value for key, value in data.items() if key not in ('phases', 'counters', 'histograms')}
+        if other:
+            lines.append('')
+            for key, value in other.items():
+                lines.append('{:<40}{:>14}'.format(key, round(value, 3) if isinstance(value, float) else value))
+
+        return '\n'.join(lines)
+
+# statistics, that are not collected
+class NoStats:
+    def phase(self, name):
+        return NO_PHASE
+
+    def count(self, name, value=1):
+        pass
+
+    def count_histogram(self, name, values):
+        pass
+
+class NoStatsPhase:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *args):
+        pass
+
+NO_STATS = NoStats()
+NO_PHASE = NoStatsPhase()
+
+# get statistics of opened fs image, or statistics that are not collected
+def get_stats(fs):
+    stats = getattr(fs, 'stats', None)
+    return NO_STATS if stats is None else stats
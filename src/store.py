@@ -0,0 +1,557 @@
+import hashlib
+import json
+import os
+import struct
+import time
+from collections import OrderedDict
+from collections.abc import Mapping
+
+from src.snapshot import EXTENT_STRUCT, pack_extents, unpack_extents
+
+#
+# SNAPSHOT STORE
+#
+# directory with many generations of snapshots of one filesystem, their data are deduplicated by content hash
+#
+# store/
+#   objects.pack             objects appended one after another
+#   objects.idx              index of objects in pack, records appended after each object
+#   generations/<name>       manifest of generation, JSON
+#
+# objects.idx record
+#   0x00  16 bytes   digest of object (blake2b)
+#   0x10   __le64    offset in pack
+#   0x18   __le32    length
+#
+# group object, regular files of one block group sorted by inode id
+#   0x00   __le32    inode id
+#   0x04   __le64    file size
+#   0x0C   __le32    extents count
+#   0x10   n * extent, same as in binary snapshot
+#
+# page object, state of GROUPS_PER_PAGE block groups
+#   0x00  6 __le32   bitmap checksums and counts from group descriptor
+#   0x18  16 bytes   digest of used inodes
+#   0x28  16 bytes   digest of group object
+#
+# directory object, entries sorted by name
+#   0x00   __u8      entry type, 1 regular file, 2 directory
+#   0x01   __le32    inode id
+#   0x05   __le16    name length
+#   0x07   n bytes   name, utf-8
+#   ...   16 bytes   digest of directory object, only directories; zero if directory was not listed
+#
+# unchanged block groups and directories produce same objects, so each generation stores only changed ones
+#
+
+INDEX_STRUCT = struct.Struct('<16sQI')
+INODE_RECORD_STRUCT = struct.Struct('<IQI')
+GROUP_ENTRY_STRUCT = struct.Struct('<6I16s16s')
+DIR_ENTRY_STRUCT = struct.Struct('<BIH')
+
+# types of directory entries
+DIR_ENTRY_FILE = 1
+DIR_ENTRY_DIR = 2
+
+# block groups in one page object, manifest then lists only digests of pages
+GROUPS_PER_PAGE = 64
+
+# digest of directory, that was found but not listed
+NO_DIGEST = bytes(16)
+
+# number of decoded objects kept in memory
+OBJECTS_CACHE_SIZE = 1024
+
+# get digest of object data
+def get_digest(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+# encode regular files of one block group [(inode_id, size, chunks), ...] to group object
+def encode_group(files):
+    parts = []
+    for inode_id, size, chunks in sorted(files, key=lambda item: item[0]):
+        parts.append(INODE_RECORD_STRUCT.pack(inode_id, size, len(chunks)))
+        parts.append(pack_extents(chunks))
+
+    return b''.join(parts)
+
+# decode group object -> {inode_id: (size, chunks)}
+def decode_group(data):
+    files = {}
+    offset = 0
+    while offset < len(data):
+        inode_id, size, extents_count = INODE_RECORD_STRUCT.unpack_from(data, offset)
+        offset += INODE_RECORD_STRUCT.size
+
+        end = offset + extents_count * EXTENT_STRUCT.size
+        files[inode_id] = size, unpack_extents(data[offset:end])
+        offset = end
+
+    return files
+
+# encode directory listing to directory object, files are [(name, inode_id)], subdirs [(name, inode_id, digest)]
+def encode_directory(files, subdirs):
+    entries = [(name.encode('utf-8'), DIR_ENTRY_FILE, inode_id, b'') for name, inode_id in files]
+    entries.extend((name.encode('utf-8'), DIR_ENTRY_DIR, inode_id, digest) for name, inode_id, digest in subdirs)
+
+    parts = []
+    for name, entry_type, inode_id, digest in sorted(entries):
+        parts.append(DIR_ENTRY_STRUCT.pack(entry_type, inode_id, len(name)))
+        parts.append(name)
+        parts.append(digest)
+
+    return b''.join(parts)
+
+# decode directory object -> ({name: inode_id} of files, {name: (inode_id, digest)} of subdirs)
+def decode_directory(data):
+    files = {}
+    subdirs = {}
+    offset = 0
+    while offset < len(data):
+        entry_type, inode_id, length = DIR_ENTRY_STRUCT.unpack_from(data, offset)
+        offset += DIR_ENTRY_STRUCT.size
+
+        name = data[offset:offset + length].decode('utf-8')
+        offset += length
+
+        if entry_type == DIR_ENTRY_DIR:
+            subdirs[name] = inode_id, data[offset:offset + 16]
+            offset += 16
+        else:
+            files[name] = inode_id
+
+    return files, subdirs
+
+# store of snapshot generations, it is opened for writing only when it can be created
+class SnapshotStore:
+    def __init__(self, path, create=False):
+        self.path = path
+        self.generations_path = os.path.join(path, 'generations')
+
+        if create:
+            os.makedirs(self.generations_path, exist_ok=True)
+        elif not os.path.isdir(self.generations_path):
+            raise Exception('Not a snapshot store: {}.'.format(path))
+
+        pack_path = os.path.join(path, 'objects.pack')
+        index_path = os.path.join(path, 'objects.idx')
+        if create:
+            self.pack = open(pack_path, 'a+b')
+            self.index = open(index_path, 'ab')
+        else:
+            self.pack = open(pack_path, 'rb')
+            self.index = None
+        self.pack_size = self.pack.seek(0, os.SEEK_END)
+
+        # objects appended to index, but missing in pack (e.g. after crash) are ignored
+        self.objects = {}
+        with open(index_path, 'rb') as fh:
+            data = fh.read()
+        for digest, offset, length in INDEX_STRUCT.iter_unpack(data[:len(data) - len(data) % INDEX_STRUCT.size]):
+            if offset + length <= self.pack_size:
+                self.objects[digest] = offset, length
+
+        self.cache = OrderedDict()
+
+    # save object -> digest, object is written only once
+    def put(self, data):
+        digest = get_digest(data)
+        if digest in self.objects:
+            return digest
+
+        if self.index is None:
+            raise Exception('Snapshot store is opened read-only.')
+
+        self.pack.seek(0, os.SEEK_END)
+        self.pack.write(data)
+        self.objects[digest] = self.pack_size, len(data)
+        self.index.write(INDEX_STRUCT.pack(digest, self.pack_size, len(data)))
+        self.pack_size += len(data)
+
+        return digest
+
+    # read raw object
+    def get(self, digest):
+        if digest not in self.objects:
+            raise Exception('Object {} is missing in snapshot store.'.format(digest.hex()))
+
+        offset, length = self.objects[digest]
+        if self.index is not None:
+            self.pack.flush()
+        return os.pread(self.pack.fileno(), length, offset)
+
+    # read decoded object, recently used objects are cached
+    def get_decoded(self, digest, decode):
+        key = digest, decode
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+        value = decode(self.get(digest))
+        self.cache[key] = value
+        if len(self.cache) > OBJECTS_CACHE_SIZE:
+            self.cache.popitem(last=False)
+
+        return value
+
+    # get manifests of all generations, sorted from oldest
+    def get_manifests(self):
+        manifests = []
+        for name in os.listdir(self.generations_path):
+            if name.startswith('.'):
+                continue
+
+            with open(os.path.join(self.generations_path, name), 'r', encoding='utf-8') as fh:
+                manifests.append(json.load(fh))
+
+        return sorted(manifests, key=lambda manifest: (manifest['created'], manifest['name']))
+
+    # get names of all generations, sorted from oldest
+    def get_generations(self):
+        return [manifest['name'] for manifest in self.get_manifests()]
+
+    # open generation by its name, or latest one -> StoreGeneration or None, when store is empty
+    def load_generation(self, name=None):
+        if name is None:
+            manifests = self.get_manifests()
+            return StoreGeneration(self, manifests[-1]) if manifests else None
+
+        manifest_path = os.path.join(self.generations_path, name)
+        if not os.path.isfile(manifest_path):
+            raise Exception('Generation {} was not found.'.format(name))
+
+        with open(manifest_path, 'r', encoding='utf-8') as fh:
+            return StoreGeneration(self, json.load(fh))
+
+    # save snapshot as new generation -> name of generation
+    # snapshot must contain state of block groups and found directories, as generated by `generate_snapshot_from_image`
+    def add_generation(self, snapshot, inodes_per_group, name=None):
+        created = time.time()
+        if name is None:
+            name = time.strftime('%Y%m%d-%H%M%S', time.gmtime(created))
+
+        manifest_path = os.path.join(self.generations_path, name)
+        if name.startswith('.') or os.sep in name or os.path.exists(manifest_path):
+            raise Exception('Generation {} cannot be created.'.format(name))
+
+        # block groups with same digest of used inodes have same files as in latest generation
+        latest = self.load_generation()
+        if latest is not None and latest.manifest['inodes_per_group'] != inodes_per_group:
+            latest = None
+        latest_groups = latest.get_group_entries() if latest is not None else []
+
+        # regular files split by block groups
+        groups_files = {}
+        for inode_id, (size, chunks) in snapshot['inodes'].items():
+            groups_files.setdefault((inode_id - 1) // inodes_per_group, []).append((inode_id, size, chunks))
+
+        pages = []
+        entries = []
+        for group, state in enumerate(snapshot['groups']):
+            inodes_digest = bytes.fromhex(state['digest'])
+            if group < len(latest_groups) and latest_groups[group][1] == inodes_digest:
+                group_digest = latest_groups[group][2]
+            else:
+                group_digest = self.put(encode_group(groups_files.get(group, [])))
+
+            entries.append(GROUP_ENTRY_STRUCT.pack(*state['descriptor'], inodes_digest, group_digest))
+            if len(entries) == GROUPS_PER_PAGE:
+                pages.append(self.put(b''.join(entries)).hex())
+                entries = []
+
+        if entries:
+            pages.append(self.put(b''.join(entries)).hex())
+
+        root = self.put_directories(snapshot['dirs'], snapshot['directories'], snapshot['dirs_max_depth'])
+
+        # objects must be written before manifest, which references them
+        self.flush()
+
+        manifest = {
+            'name': name,
+            'created': created,
+            'uuid': snapshot['uuid'],
+            'dirs_max_depth': snapshot['dirs_max_depth'],
+            'inodes_per_group': inodes_per_group,
+            'groups_count': len(snapshot['groups']),
+            'inodes_count': len(snapshot['inodes']),
+            'paths_count': len(snapshot['dirs']),
+            'root': root.hex(),
+            'pages': pages,
+        }
+
+        tmp_path = os.path.join(self.generations_path, '.' + name + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as fh:
+            fh.write(json.dumps(manifest))
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp_path, manifest_path)
+
+        return name
+
+    # save directory objects from leafs up to root -> digest of root directory
+    def put_directories(self, paths, directories, dirs_max_depth):
+        # directories in last level of traversal were found, but not listed
+        listings = {
+            path: ([], []) for path in directories
+            if path.count('/') - 1 < dirs_max_depth
+        }
+
+        for path, inode_id in paths.items():
+            parent, name = path.rsplit('/', 1)
+            listings[parent + '/'][0].append((name, inode_id))
+
+        # deepest directories first, so that digests of subdirs are known
+        digests = {}
+        for path in sorted(directories, key=lambda path: path.count('/'), reverse=True):
+            if path in listings:
+                files, subdirs = listings[path]
+                digests[path] = self.put(encode_directory(files, subdirs))
+            else:
+                digests[path] = NO_DIGEST
+
+            if path != '/':
+                parent, name = path[:-1].rsplit('/', 1)
+                listings[parent + '/'][1].append((name, directories[path], digests[path]))
+
+        return digests['/']
+
+    # find generations, that contain given file or directory ending with '/' -> [(name, inode_id), ...] from latest generation
+    def find_path(self, path, latest_only=False):
+        found = []
+        results = {}
+        for manifest in reversed(self.get_manifests()):
+            # generations with same root directory have same result
+            if manifest['root'] not in results:
+                generation = StoreGeneration(self, manifest)
+                paths = generation.directories if path.endswith('/') else generation.dirs
+                results[manifest['root']] = paths.get(path)
+
+            inode_id = results[manifest['root']]
+            if inode_id is not None:
+                found.append((manifest['name'], inode_id))
+                if latest_only:
+                    break
+
+        return found
+
+    def flush(self):
+        if self.index is None:
+            return
+
+        self.pack.flush()
+        os.fsync(self.pack.fileno())
+        self.index.flush()
+        os.fsync(self.index.fileno())
+
+    def close(self):
+        self.pack.close()
+        if self.index is not None:
+            self.index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+# regular files of generation {inode_id: (size, chunks)}, looked up by block group
+class StoreInodes(Mapping):
+    def __init__(self, generation):
+        self.generation = generation
+
+    def get_group(self, group):
+        entries = self.generation.get_group_entries()
+        if group >= len(entries):
+            return {}
+
+        return self.generation.store.get_decoded(entries[group][2], decode_group)
+
+    def __getitem__(self, inode_id):
+        group = (inode_id - 1) // self.generation.manifest['inodes_per_group']
+        return self.get_group(group)[inode_id]
+
+    def __contains__(self, inode_id):
+        group = (inode_id - 1) // self.generation.manifest['inodes_per_group']
+        return inode_id in self.get_group(group)
+
+    def items(self):
+        for group in range(self.generation.manifest['groups_count']):
+            yield from self.get_group(group).items()
+
+    # iterate (inode_id, (size, chunks)) of inodes with first <= inode_id < end
+    def items_in_range(self, first, end):
+        inodes_per_group = self.generation.manifest['inodes_per_group']
+        for group in range((first - 1) // inodes_per_group, (end - 2) // inodes_per_group + 1):
+            for inode_id, value in self.get_group(group).items():
+                if first <= inode_id < end:
+                    yield inode_id, value
+
+    def __iter__(self):
+        for inode_id, value in self.items():
+            yield inode_id
+
+    def __len__(self):
+        return self.generation.manifest['inodes_count']
+
+# paths of generation {path: inode_id}, looked up by walking directory objects
+class StorePaths(Mapping):
+    def __init__(self, generation, directories=False):
+        self.generation = generation
+        self.directories = directories
+
+    def get_directory(self, digest):
+        return self.generation.store.get_decoded(digest, decode_directory)
+
+    # find digest of directory with given path ending with '/' -> (inode_id, digest) or None
+    def find_directory(self, path):
+        inode_id, digest = 2, self.generation.root
+        for name in path.split('/')[1:-1]:
+            if digest == NO_DIGEST:
+                return None
+
+            subdirs = self.get_directory(digest)[1]
+            if name not in subdirs:
+                return None
+            inode_id, digest = subdirs[name]
+
+        return inode_id, digest
+
+    # get (path, inode_id, digest) of entries of directory with names starting with `rest`, in order of paths
+    # digest is None for files; subdirectory is sorted by name + '/', because all paths under it start with it
+    def get_entries(self, prefix, digest, rest=''):
+        if digest == NO_DIGEST:
+            return []
+
+        files, subdirs = self.get_directory(digest)
+        entries = []
+        if not self.directories:
+            entries.extend((name, inode_id, None) for name, inode_id in files.items() if name.startswith(rest))
+        entries.extend((name + '/', inode_id, subdir_digest) for name, (inode_id, subdir_digest) in subdirs.items() if name.startswith(rest))
+        entries.sort(key=lambda entry: entry[0])
+
+        return [(prefix + name, inode_id, subdir_digest) for name, inode_id, subdir_digest in entries]
+
+    # iterate (path, inode_id) of all files or directories under directory with given path, in order of paths
+    def iter_directory(self, prefix, digest, rest=''):
+        stack = [iter(self.get_entries(prefix, digest, rest))]
+        while stack:
+            entry = next(stack[-1], None)
+            if entry is None:
+                stack.pop()
+                continue
+
+            path, inode_id, subdir_digest = entry
+            if subdir_digest is None or self.directories:
+                yield path, inode_id
+            if subdir_digest is not None:
+                stack.append(iter(self.get_entries(path, subdir_digest)))
+
+    # iterate (path, inode_id) of paths, that start with given prefix, only matching subdirs are traversed
+    def items_with_prefix(self, prefix):
+        # all paths start with '/', so empty prefix is root directory and other prefixes without '/' match nothing
+        if '/' not in prefix:
+            if prefix:
+                return
+            prefix = '/'
+
+        dir_path, rest = prefix.rsplit('/', 1)
+        dir_path += '/'
+
+        directory = self.find_directory(dir_path)
+        if directory is None or directory[1] == NO_DIGEST:
+            return
+
+        if self.directories and dir_path.startswith(prefix):
+            yield dir_path, directory[0]
+
+        yield from self.iter_directory(dir_path, directory[1], rest)
+
+    def items(self):
+        return self.items_with_prefix('/')
+
+    def values(self):
+        for path, inode_id in self.items():
+            yield inode_id
+
+    def __iter__(self):
+        for path, inode_id in self.items():
+            yield path
+
+    def __getitem__(self, path):
+        if self.directories:
+            directory = self.find_directory(path)
+            if directory is None:
+                raise KeyError(path)
+            return directory[0]
+
+        dir_path, name = path.rsplit('/', 1)
+        directory = self.find_directory(dir_path + '/')
+        if directory is None or directory[1] == NO_DIGEST:
+            raise KeyError(path)
+
+        files = self.get_directory(directory[1])[0]
+        if name not in files:
+            raise KeyError(path)
+
+        return files[name]
+
+    def __len__(self):
+        if self.directories:
+            return sum(1 for path in self)
+
+        return self.generation.manifest['paths_count']
+
+# one generation of snapshot store, it can be used as snapshot dict {'dirs': ..., 'inodes': ..., ...}
+class StoreGeneration:
+    def __init__(self, store, manifest):
+        self.store = store
+        self.manifest = manifest
+        self.name = manifest['name']
+        self.root = bytes.fromhex(manifest['root'])
+        self.group_entries = None
+
+        self.inodes = StoreInodes(self)
+        self.dirs = StorePaths(self)
+        self.directories = StorePaths(self, directories=True)
+
+    # get entries of all block groups -> [(descriptor, inodes digest, group digest), ...]
+    def get_group_entries(self):
+        if self.group_entries is None:
+            self.group_entries = []
+            for page in self.manifest['pages']:
+                for entry in GROUP_ENTRY_STRUCT.iter_unpack(self.store.get(bytes.fromhex(page))):
+                    self.group_entries.append((list(entry[:6]), entry[6], entry[7]))
+
+        return self.group_entries
+
+    def __getitem__(self, key):
+        if key == 'dirs':
+            return self.dirs
+        if key == 'inodes':
+            return self.inodes
+        if key == 'directories':
+            return self.directories
+        if key == 'groups':
+            return [{
+                'descriptor': descriptor,
+                'digest': inodes_digest.hex()
+            } for descriptor, inodes_digest, group_digest in self.get_group_entries()]
+        if key in ('uuid', 'dirs_max_depth'):
+            return self.manifest[key]
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def close(self):
+        self.store.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
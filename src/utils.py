@@ -1,11 +1,25 @@
-import subprocess
+import errno
+import fnmatch
+import hashlib
+import itertools
+import os
 import re
 import struct
-
-# make from 5-9 list of integers
-def split_range(numstr):
-    num1, num2 = numstr.split('-')
-    return list(range(int(num1), int(num2)+1))
+import threading
+import time
+import uuid
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+from src.snapshot import (
+    SNAPSHOT_MEMORY_LIMIT, BinarySnapshot, BinarySnapshotWriter, DictSnapshotWriter, EncodedPaths, JSONSnapshotWriter,
+    KeyedSpool, Spool, get_chunks_offsets, is_binary_snapshot, pack_chunks, pack_path_record, save_binary_snapshot, unpack_chunks, unpack_path_record
+)
+from src.stats import NO_STATS, Stats, get_stats
+from src.store import SnapshotStore, StoreGeneration
 
 # join continuous data in array -> [1, 2, 4, 5] --> ({first:1, total:2}, {first:4, total:2})
 def join_ranges(arr):
@@ -40,92 +54,423 @@ def join_ranges(arr):
     })
     return data
 
-# read superblock
-def get_super(fs):
-    process = subprocess.Popen(
-        ['dumpe2fs', fs],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE
-    )
-    stdout, stderr = process.communicate()
+#
+# SUPERBLOCK
+#
 
-    data = stdout.decode("utf-8")
-    if process.returncode != 0:
-        raise Exception(data)
+# names of feature flags, as they are printed by dumpe2fs
+FEATURES_COMPAT = {
+    0x1: 'dir_prealloc',
+    0x2: 'imagic_inodes',
+    0x4: 'has_journal',
+    0x8: 'ext_attr',
+    0x10: 'resize_inode',
+    0x20: 'dir_index',
+    0x200: 'sparse_super2',
+}
+
+FEATURES_INCOMPAT = {
+    0x1: 'compression',
+    0x2: 'filetype',
+    0x4: 'needs_recovery',
+    0x8: 'journal_dev',
+    0x10: 'meta_bg',
+    0x40: 'extent',
+    0x80: '64bit',
+    0x100: 'mmp',
+    0x200: 'flex_bg',
+    0x400: 'ea_inode',
+    0x1000: 'dirdata',
+    0x2000: 'metadata_csum_seed',
+    0x4000: 'large_dir',
+    0x8000: 'inline_data',
+    0x10000: 'encrypt',
+    0x20000: 'casefold',
+}
+
+FEATURES_RO_COMPAT = {
+    0x1: 'sparse_super',
+    0x2: 'large_file',
+    0x8: 'huge_file',
+    0x10: 'uninit_bg',
+    0x20: 'dir_nlink',
+    0x40: 'extra_isize',
+    0x100: 'quota',
+    0x200: 'bigalloc',
+    0x400: 'metadata_csum',
+    0x1000: 'read-only',
+    0x2000: 'project',
+}
+
+# names of block group flags, as they are printed by dumpe2fs
+BLOCK_GROUP_FLAGS = {
+    0x1: 'INODE_UNINIT',
+    0x2: 'BLOCK_UNINIT',
+    0x4: 'ITABLE_ZEROED',
+}
+
+# get list of names of set flags
+def get_flag_names(value, names):
+    return [name for flag, name in names.items() if value & flag]
+
+# superblock is always 1024 bytes from start of the fs, and has 1024 bytes
+def superblock_parse(data):
+    assert len(data) >= 1024
+
+    # 0x38   __le16   s_magic
+    s_magic = struct.unpack('<H', data[0x38:0x3A])[0]
+    if s_magic != 0xEF53:
+        raise Exception('Not an ext2/3/4 filesystem, bad magic number 0x{:04X}.'.format(s_magic))
+
+    # 0x00   __le32   s_inodes_count
+    # 0x04   __le32   s_blocks_count_lo
+    # 0x08   __le32   s_r_blocks_count_lo
+    # 0x0C   __le32   s_free_blocks_count_lo
+    # 0x10   __le32   s_free_inodes_count
+    # 0x14   __le32   s_first_data_block
+    # 0x18   __le32   s_log_block_size
+    # 0x1C   __le32   s_log_cluster_size
+    # 0x20   __le32   s_blocks_per_group
+    # 0x24   __le32   s_clusters_per_group
+    # 0x28   __le32   s_inodes_per_group
+    (s_inodes_count, s_blocks_count_lo, s_r_blocks_count_lo, s_free_blocks_count_lo,
+        s_free_inodes_count, s_first_data_block, s_log_block_size, s_log_cluster_size,
+        s_blocks_per_group, s_clusters_per_group, s_inodes_per_group) = struct.unpack('<11I', data[0:44])
+    # 0x4C   __le32   s_rev_level
+    s_rev_level = struct.unpack('<I', data[0x4C:0x50])[0]
+    # 0x54   __le32   s_first_ino
+    # 0x58   __le16   s_inode_size
+    s_first_ino, s_inode_size = struct.unpack('<IH', data[0x54:0x5A])
+    # 0x5C   __le32   s_feature_compat
+    # 0x60   __le32   s_feature_incompat
+    # 0x64   __le32   s_feature_ro_compat
+    s_feature_compat, s_feature_incompat, s_feature_ro_compat = struct.unpack('<3I', data[0x5C:0x68])
+    # 0x68  16 bytes  s_uuid
+    s_uuid = uuid.UUID(bytes=data[0x68:0x78])
+    # 0xCE   __le16   s_reserved_gdt_blocks
+    s_reserved_gdt_blocks = struct.unpack('<H', data[0xCE:0xD0])[0]
+    # 0xFE   __le16   s_desc_size
+    s_desc_size = struct.unpack('<H', data[0xFE:0x100])[0]
+    # 0x104  __le32   s_first_meta_bg
+    s_first_meta_bg = struct.unpack('<I', data[0x104:0x108])[0]
+    # 0x150  __le32   s_blocks_count_hi
+    s_blocks_count_hi = struct.unpack('<I', data[0x150:0x154])[0]
+    # 0x174  __u8     s_log_groups_per_flex
+    s_log_groups_per_flex = data[0x174]
+    # 0x24C  __le32   s_backup_bgs[2]
+    s_backup_bgs = list(struct.unpack('<2I', data[0x24C:0x254]))
+
+    features = get_flag_names(s_feature_compat, FEATURES_COMPAT) + \
+        get_flag_names(s_feature_incompat, FEATURES_INCOMPAT) + \
+        get_flag_names(s_feature_ro_compat, FEATURES_RO_COMPAT)
+
+    # revision 0 has fixed inode size
+    if s_rev_level == 0:
+        s_first_ino = 11
+        s_inode_size = 128
+
+    # group descriptor is 32 bytes, unless 64bit feature is set
+    if '64bit' in features:
+        desc_size = s_desc_size
+    else:
+        desc_size = 32
 
-    sb, blocks = data.split('\n\n')
+    # block count is 64bit only with 64bit feature
+    block_count = s_blocks_count_lo
+    if '64bit' in features:
+        block_count = join_int32(s_blocks_count_hi, s_blocks_count_lo)
 
-    data = {}
+    groups_count = -(-(block_count - s_first_data_block) // s_blocks_per_group)
 
-    rows = sb.strip().split('\n')
-    for row in rows:
-        # prop:  value
-        prop, val = re.compile(":\s+").split(row)
+    return {
+        'Filesystem magic number': s_magic,
+        'Filesystem revision #': s_rev_level,
+        'Filesystem UUID': str(s_uuid),
+        'Filesystem features': features,
+        'Inode count': s_inodes_count,
+        'Block count': block_count,
+        'Free inodes': s_free_inodes_count,
+        'First block': s_first_data_block,
+        'Block size': 1024 << s_log_block_size,
+        'Cluster size': 1024 << s_log_cluster_size,
+        'Group descriptor size': desc_size,
+        'Reserved GDT blocks': s_reserved_gdt_blocks,
+        'Blocks per group': s_blocks_per_group,
+        'Clusters per group': s_clusters_per_group,
+        'Inodes per group': s_inodes_per_group,
+        'Inode blocks per group': -(-(s_inodes_per_group * s_inode_size) // (1024 << s_log_block_size)),
+        'Flex block group size': 1 << s_log_groups_per_flex if 'flex_bg' in features else None,
+        'First meta block group': s_first_meta_bg,
+        'Backup block groups': s_backup_bgs,
+        'First inode': s_first_ino,
+        'Inode size': s_inode_size,
+        'Block groups count': groups_count,
+    }
 
-        # parse integers
-        if re.match("^-?\d+$", val):
-            data[prop] = int(val)
-        else:
-            data[prop] = val
+# check if block group contains superblock (and group descriptors) backup
+def has_super(sb, group):
+    if group == 0:
+        return True
 
-    # split
-    data['Filesystem features'] = data['Filesystem features'].split(' ')
+    if 'sparse_super2' in sb['Filesystem features']:
+        return group in sb['Backup block groups']
 
-    data['Blocks Groups Flags'] = []
-    rows = blocks.strip().split('\n')
-    for row in rows:
-        # must start with group
-        match = re.match("^Group.*\[(.*?)\]$", row)
-        if not match:
-            continue
+    if group <= 1 or 'sparse_super' not in sb['Filesystem features']:
+        return True
 
-        flags = match.group(1).split(", ")
-        data['Blocks Groups Flags'].append(flags)
+    # only powers of 3, 5 and 7
+    if group % 2 == 0:
+        return False
 
-    return data
+    for base in (3, 5, 7):
+        num = base
+        while num < group:
+            num *= base
+        if num == group:
+            return True
+
+    return False
+
+# get block address of superblock (or its backup) in given group
+def get_super_block(sb, group):
+    if not has_super(sb, group):
+        return None
+
+    # primary superblock is always 1024 bytes from start of the fs
+    if group == 0:
+        return 1024 // sb['Block size']
+
+    return sb['First block'] + group * sb['Blocks per group']
+
+# get block address of group descriptors block with given index
+def get_descriptor_block(sb, index):
+    descs_per_block = sb['Block size'] // sb['Group descriptor size']
+
+    if 'meta_bg' not in sb['Filesystem features'] or index < sb['First meta block group']:
+        return get_super_block(sb, 0) + 1 + index
+
+    # with meta_bg, descriptors block is stored in first group of its meta group
+    group = index * descs_per_block
+    super_block = get_super_block(sb, group)
+    if super_block is not None:
+        return super_block + 1
+
+    return sb['First block'] + group * sb['Blocks per group']
+
+# get blocks containing group descriptors within given group
+def get_descriptor_blocks_in_group(sb, group):
+    descs_per_block = sb['Block size'] // sb['Group descriptor size']
+    gdt_blocks = -(-sb['Block groups count'] // descs_per_block)
+    super_block = get_super_block(sb, group)
+
+    if 'meta_bg' not in sb['Filesystem features']:
+        if super_block is None:
+            return None
+        return list(range(super_block + 1, super_block + 1 + gdt_blocks))
+
+    # old style descriptors, before first meta_bg
+    first_meta = min(sb['First meta block group'], gdt_blocks)
+    if super_block is not None and first_meta > 0:
+        return list(range(super_block + 1, super_block + 1 + first_meta))
+
+    # meta_bg stores its descriptors in first, second and last group of meta group
+    index, offset = divmod(group, descs_per_block)
+    if index < sb['First meta block group'] or offset not in (0, 1, descs_per_block - 1):
+        return None
+
+    if super_block is not None:
+        return [super_block + 1]
+
+    return [sb['First block'] + group * sb['Blocks per group']]
+
+# get block groups from group descriptors table
+def group_descriptors_parse(sb, data):
+    desc_size = sb['Group descriptor size']
+
+    bgs = []
+    for group in range(sb['Block groups count']):
+        offset = group * desc_size
+        desc = data[offset:offset + desc_size]
+
+        # 0x00   __le32   bg_block_bitmap_lo
+        # 0x04   __le32   bg_inode_bitmap_lo
+        # 0x08   __le32   bg_inode_table_lo
+        # 0x0C   __le16   bg_free_blocks_count_lo
+        # 0x0E   __le16   bg_free_inodes_count_lo
+        # 0x10   __le16   bg_used_dirs_count_lo
+        # 0x12   __le16   bg_flags
+        # 0x14   __le32   bg_exclude_bitmap_lo
+        # 0x18   __le16   bg_block_bitmap_csum_lo
+        # 0x1A   __le16   bg_inode_bitmap_csum_lo
+        # 0x1C   __le16   bg_itable_unused_lo
+        # 0x1E   __le16   bg_checksum
+        (bbitmap, ibitmap, itable, free_blocks, free_inodes, used_dirs, flags, _,
+            bbitmap_csum, ibitmap_csum, itable_unused, checksum) = struct.unpack('<3I4HI4H', desc[0:32])
+
+        if desc_size >= 64:
+            # 0x20   __le32   bg_block_bitmap_hi
+            # 0x24   __le32   bg_inode_bitmap_hi
+            # 0x28   __le32   bg_inode_table_hi
+            # 0x2C   __le16   bg_free_blocks_count_hi
+            # 0x2E   __le16   bg_free_inodes_count_hi
+            # 0x30   __le16   bg_used_dirs_count_hi
+            # 0x32   __le16   bg_itable_unused_hi
+            # 0x34   __le32   bg_exclude_bitmap_hi
+            # 0x38   __le16   bg_block_bitmap_csum_hi
+            # 0x3A   __le16   bg_inode_bitmap_csum_hi
+            (bbitmap_hi, ibitmap_hi, itable_hi, free_blocks_hi, free_inodes_hi, used_dirs_hi,
+                itable_unused_hi, _, bbitmap_csum_hi, ibitmap_csum_hi) = struct.unpack('<3I4HI2H', desc[32:60])
+
+            bbitmap = join_int32(bbitmap_hi, bbitmap)
+            ibitmap = join_int32(ibitmap_hi, ibitmap)
+            itable = join_int32(itable_hi, itable)
+            free_blocks += free_blocks_hi << 16
+            free_inodes += free_inodes_hi << 16
+            used_dirs += used_dirs_hi << 16
+            itable_unused += itable_unused_hi << 16
+            bbitmap_csum += bbitmap_csum_hi << 16
+            ibitmap_csum += ibitmap_csum_hi << 16
+
+        block = sb['First block'] + group * sb['Blocks per group']
+        bgs.append({
+            'group': group,
+            'block': block,
+            'super': get_super_block(sb, group),
+            'gdt': get_descriptor_blocks_in_group(sb, group),
+            'bbitmap': bbitmap,
+            'ibitmap': ibitmap,
+            'itable': itable,
+            'flags': get_flag_names(flags, BLOCK_GROUP_FLAGS),
+            'free_blocks': free_blocks,
+            'free_inodes': free_inodes,
+            'used_dirs': used_dirs,
+            'itable_unused': itable_unused,
+            'bbitmap_csum': bbitmap_csum,
+            'ibitmap_csum': ibitmap_csum,
+            'checksum': checksum,
+        })
+
+    return bgs
+
+# read group descriptors table, it can be split into more places with meta_bg
+def read_group_descriptors(fs, sb):
+    descs_per_block = sb['Block size'] // sb['Group descriptor size']
+    gdt_blocks = -(-sb['Block groups count'] // descs_per_block)
+
+    if 'meta_bg' not in sb['Filesystem features']:
+        data = read_blocks(fs, sb['Block size'], get_descriptor_block(sb, 0), gdt_blocks)
+    else:
+        data = b''.join(read_blocks(fs, sb['Block size'], get_descriptor_block(sb, i)) for i in range(gdt_blocks))
+
+    return group_descriptors_parse(sb, data)
+
+# read superblock along with block groups
+def get_super(fs):
+    data = read_blocks(fs, 1, 1024, 1024)
+    sb = superblock_parse(data)
+
+    bgs = read_group_descriptors(fs, sb)
+    sb['Block groups'] = bgs
+    sb['Blocks Groups Flags'] = [bg['flags'] for bg in bgs]
+
+    return sb
 
 # test if is flag in block group
 def test_block_groups_flag(sb, flag_name, group_index):
-    return group_index in sb['Blocks Groups Flags'] and flag_name in sb['Blocks Groups Flags'][group_index]
+    return group_index < len(sb['Blocks Groups Flags']) and flag_name in sb['Blocks Groups Flags'][group_index]
 
-# get infos about block groups
-def get_block_groups(fs):
-    process = subprocess.Popen(
-        ['dumpe2fs', '-g', fs],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE
-    )
-    stdout, stderr = process.communicate()
+# get infos about block groups, reuse already parsed ones from superblock
+def get_block_groups(fs, sb=None):
+    if sb is None:
+        sb = get_super(fs)
 
-    data = stdout.decode("utf-8").strip()
-    if process.returncode != 0:
-        raise Exception(data)
+    return sb['Block groups']
 
-    rows = data.split('\n')
+#
+# IMAGE
+#
 
-    # remove header
-    rows.pop(0)
+# opened filesystem image, that keeps one file handle, parsed superblock and cache of metadata blocks
+class Ext4Image:
+    def __init__(self, path, cache_size=4096, stats=None):
+        self.path = path
+        self.fh = open(path, 'rb')
+        self.fd = self.fh.fileno()
 
-    # group:block:super:gdt:bbitmap:ibitmap:itable
+        # LRU cache of single blocks: {block_addr: data}
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.cache_hits = 0
+        self.cache_misses = 0
 
-    data = []
-    for row in rows:
-        col = row.split(':')
+        # statistics of reads and phases, if they are collected
+        self.stats = stats
 
-        data.append({
-            'group': int(col[0]),
-            'block': int(col[1]),
-            'super': None if col[2] == '-1' else int(col[2]),
-            'gdt': None if col[3] == '-1' else split_range(col[3]),
-            'bbitmap': int(col[4]),
-            'ibitmap': int(col[5]),
-            'itable': int(col[6])
-        })
+        self._sb = None
 
-    return data
+    # superblock along with block groups is parsed only once
+    @property
+    def sb(self):
+        if self._sb is None:
+            self._sb = get_super(self)
+        return self._sb
+
+    # read any number of bytes from given offset
+    def read(self, offset, length):
+        if self.stats is not None:
+            self.stats.add_read(offset, length)
+
+        return os.pread(self.fd, length, offset)
+
+    # read one block, through the cache
+    def read_block(self, block_size, addr):
+        key = (block_size, addr)
+        if key in self.cache:
+            self.cache_hits += 1
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+        self.cache_misses += 1
+        data = self.read(addr * block_size, block_size)
+
+        self.cache[key] = data
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+        return data
+
+    # tell kernel, that given range will be read soon
+    def advise(self, offset, length):
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(self.fd, offset, length, os.POSIX_FADV_WILLNEED)
+
+    # read any given number of blocks, only single metadata blocks are cached
+    def read_blocks(self, block_size, addr, total=1):
+        if total == 1 and self._sb is not None and block_size == self._sb['Block size']:
+            return self.read_block(block_size, addr)
+
+        return self.read(addr * block_size, total * block_size)
+
+    # forget parsed superblock and cached blocks, when fs in opened image or device has changed
+    def refresh(self):
+        self.cache.clear()
+        self._sb = None
+
+    def close(self):
+        self.cache.clear()
+        self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
 # read any given number of blocks from fs
 def read_blocks(fs, block_size, addr, total=1):
+    if isinstance(fs, Ext4Image):
+        return fs.read_blocks(block_size, addr, total)
+
     with open(fs, "rb") as fh:
         fh.seek(addr * block_size)
         return fh.read(total * block_size)
@@ -136,53 +481,202 @@ def access_bit(data, num):
     shift = int(num % 8)
     return (data[base] & (1<<shift)) >> shift
 
+# set bits of every possible byte: [(0, 2, ...), ...]
+BITMAP_BYTE_INDEXES = [tuple(i for i in range(8) if byte & (1 << i)) for byte in range(256)]
+
+# runs of set bits of every possible byte, as [start, end): [((0, 1), (2, 3)), ...]
+BITMAP_BYTE_RUNS = [tuple(
+    (i, i + len(run)) for i, run in ((m.start(), m.group()) for m in re.finditer('1+', '{:08b}'.format(byte)[::-1]))
+) for byte in range(256)]
+
+# bitmap is scanned by whole bytes: zero bytes are skipped, full bytes are taken as runs and only the rest is decoded
+BITMAP_PATTERN = re.compile(rb'\xff+|[^\x00\xff]')
+
+# cut bitmap to bytes, that can contain items
+def trim_bitmap(data, total_items=None):
+    if total_items is None:
+        return data
+    return data[:-(-total_items // 8)]
+
 # get array of indexes, that are set to 1 in bitmp. If total_items is set, only indexes < total_items are counted.
 def parse_bitmap(data, total_items=None):
+    data = trim_bitmap(data, total_items)
+
     indexes = []
-    for i in range(len(data)*8):
-        if total_items is not None and i >= total_items:
-            break
+    for match in BITMAP_PATTERN.finditer(data):
+        start, end = match.span()
+        if data[start] == 0xFF:
+            indexes.extend(range(start * 8, end * 8))
+        else:
+            base = start * 8
+            indexes.extend(base + i for i in BITMAP_BYTE_INDEXES[data[start]])
 
-        if access_bit(data, i):
-            indexes.append(i)
+    # remove indexes, that overflow
+    if total_items is not None:
+        while indexes and indexes[-1] >= total_items:
+            indexes.pop()
 
     return indexes
 
+# get ranges of bits, that are set to 1 in bitmap -> [{first:1, total:2}, ...]. Indexes are shifted by base.
+def parse_bitmap_runs(data, total_items=None, base=0):
+    data = trim_bitmap(data, total_items)
+
+    runs = []
+    run_first = None
+    run_end = None
+    for match in BITMAP_PATTERN.finditer(data):
+        start, end = match.span()
+        if data[start] == 0xFF:
+            pieces = ((start * 8, end * 8),)
+        else:
+            pieces = ((start * 8 + l, start * 8 + r) for l, r in BITMAP_BYTE_RUNS[data[start]])
+
+        for first, last in pieces:
+            # remove bits, that overflow
+            if total_items is not None and last > total_items:
+                last = total_items
+                if first >= last:
+                    break
+
+            # continue in current run
+            if first == run_end:
+                run_end = last
+                continue
+
+            # commit
+            if run_first is not None:
+                runs.append({
+                    'first': base + run_first,
+                    'total': run_end - run_first
+                })
+            run_first = first
+            run_end = last
+
+    if run_first is None:
+        return runs
+
+    runs.append({
+        'first': base + run_first,
+        'total': run_end - run_first
+    })
+    return runs
+
+# read bitmaps of given block groups, neighbouring bitmaps (e.g. with flex_bg) are read at once
+def read_bitmaps(fs, sb, bgs, bitmap_type):
+    block_size = sb['Block size']
+
+    i = 0
+    while i < len(bgs):
+        # find how many bitmaps are stored one after another
+        j = i + 1
+        while j < len(bgs) and bgs[j][bitmap_type] == bgs[j - 1][bitmap_type] + 1:
+            j += 1
+
+        data = read_blocks(fs, block_size, bgs[i][bitmap_type], j - i)
+        for k in range(i, j):
+            offset = (k - i) * block_size
+            yield bgs[k], data[offset:offset + block_size]
+
+        i = j
+
 # [ 'inode_id': 'physical_addr', ... ]
 def get_inodes_addresses(fs, sb=None):
-    # get blocks
-    bgs = get_block_groups(fs)
+    # get blocks, only with initialized inodes
+    bgs = [bg for bg in get_block_groups(fs, sb) if not test_block_groups_flag(sb, 'INODE_UNINIT', bg['group'])]
 
     # get inodes with their physical address
     inodes = {}
-    for bg in bgs:
-        # only initialized inodes
-        if test_block_groups_flag(sb, 'INODE_UNINIT', bg['group']):
-            continue
-
-        # get & parse bitmap
-        bitmap = read_blocks(fs, sb['Block size'], bg['ibitmap'])
+    for bg, bitmap in read_bitmaps(fs, sb, bgs, 'ibitmap'):
+        # parse bitmap
         indexes = parse_bitmap(bitmap, sb['Inodes per group'])
 
         # get base address for inode table in this bg
         base_address = bg['itable'] * sb['Block size']
+        base_id = (sb['Inodes per group'] * bg['group']) + 1
 
         # loop through used inodes in this bg
-        for index in indexes:
-            inode_id = index + (sb['Inodes per group'] * bg['group']) + 1
-            raw_address = (index * sb['Inode size']) + base_address
-
-            inodes[inode_id] = raw_address
+        inodes.update((index + base_id, (index * sb['Inode size']) + base_address) for index in indexes)
 
     return inodes
 
+# maximum size of one read, when reading more inode tables at once
+INODE_TABLES_READ_SIZE = 16 * 1024 * 1024
+
+# read inode tables of all used inodes -> (data, bg, inode_ids, offsets) for each block group with used inodes,
+# inode tables are read in large sequential reads, so that more block groups can share same data
+def iter_inode_tables(fs, sb, bgs=None):
+    if bgs is None:
+        bgs = get_block_groups(fs, sb)
+
+    stats = get_stats(fs)
+
+    # get blocks, only with initialized inodes
+    bgs = [bg for bg in bgs if not test_block_groups_flag(sb, 'INODE_UNINIT', bg['group'])]
+
+    # get used indexes from bitmaps
+    groups = []
+    with stats.phase('bitmaps'):
+        for bg, bitmap in read_bitmaps(fs, sb, bgs, 'ibitmap'):
+            indexes = parse_bitmap(bitmap, sb['Inodes per group'])
+            if indexes:
+                groups.append((bg, indexes))
+
+    inode_size = sb['Inode size']
+    table_size = sb['Inode blocks per group'] * sb['Block size']
+
+    i = 0
+    while i < len(groups):
+        # join neighbouring inode tables (e.g. with flex_bg) to one stream, unused tail of previous table is read too
+        start = groups[i][0]['itable'] * sb['Block size']
+        end = start + (groups[i][1][-1] + 1) * inode_size
+
+        j = i + 1
+        while j < len(groups) and end - start < INODE_TABLES_READ_SIZE:
+            bg, indexes = groups[j]
+            table_start = bg['itable'] * sb['Block size']
+
+            # this table must follow previous one
+            if table_start != groups[j - 1][0]['itable'] * sb['Block size'] + table_size:
+                break
+
+            end = table_start + (indexes[-1] + 1) * inode_size
+            j += 1
+
+        with stats.phase('inode_tables'):
+            data = read_blocks(fs, 1, start, end - start)
+
+        # used inodes in these bgs
+        for k in range(i, j):
+            bg, indexes = groups[k]
+            base_offset = bg['itable'] * sb['Block size'] - start
+            base_id = (sb['Inodes per group'] * bg['group']) + 1
+
+            inode_ids = [index + base_id for index in indexes]
+            offsets = [base_offset + index * inode_size for index in indexes]
+
+            yield data, bg, inode_ids, offsets
+
+        i = j
+
 #
 # INODE
 #
 
+# filetype mask of `i_mode`
+S_IFMT = 0xF000
+S_IFDIR = 0x4000
+S_IFREG = 0x8000
+
+# relevant flags of `i_flags`
+EXT4_INDEX_FL = 0x1000
+EXT4_HUGE_FILE_FL = 0x40000
+EXT4_EXTENTS_FL = 0x80000
+EXT4_INLINE_DATA_FL = 0x10000000
+
 # get filetype from `i_mode`
 def get_filetype(i_mode):
-    filetype_flag = (i_mode & 0xF000)
+    filetype_flag = (i_mode & S_IFMT)
 
     if filetype_flag == 0x1000: # S_IFIFO (FIFO)
         return 'S_IFIFO'
@@ -204,46 +698,39 @@ def get_flags(i_flags):
     flags = []
 
     # Directory has hashed indexes
-    if i_flags & 0x1000:
+    if i_flags & EXT4_INDEX_FL:
         flags.append('EXT4_INDEX_FL')
     # This is a huge file
-    if i_flags & 0x40000:
+    if i_flags & EXT4_HUGE_FILE_FL:
         flags.append('EXT4_HUGE_FILE_FL')
     # Inode uses extents
-    if i_flags & 0x80000:
+    if i_flags & EXT4_EXTENTS_FL:
         flags.append('EXT4_EXTENTS_FL')
     # Inode has inline data
-    if i_flags & 0x10000000:
+    if i_flags & EXT4_INLINE_DATA_FL:
         flags.append('EXT4_INLINE_DATA_FL')
 
     return flags
 
 # join int32 with (int32, int16 or int8)
 def join_int32(hi, lo):
-    # join hi + lo
-    num = (hi << 32) +  lo
+    assert 0 <= lo < 1 << 32
 
-    # test
-    src_bits = "{0:032b}".format(hi) + "{0:032b}".format(lo)
-    dst_bits = "{0:064b}".format(num)
-    assert src_bits == dst_bits
+    # join hi + lo
+    return (hi << 32) | lo
 
-    return num
+# relevant fields of inode
+# 0x00   __le16   i_mode
+# 0x04   __le32   i_size_lo
+# 0x1A   __le16   i_links_count
+# 0x20   __le32   i_flags
+# 0x28  60 bytes  i_block
+# 0x6C   __le32   i_size_high
+INODE_STRUCT = struct.Struct('<H2xI18xH4xI4x60s8xI')
 
 # get relevant data from inode
 def inode_parse(data):
-    # 0x00   __le16   i_mode
-    i_mode = struct.unpack('<H', data[0:2])[0]
-    # 0x04   __le32   i_size_lo
-    i_size_lo = struct.unpack('<I', data[4:8])[0]
-    # 0x1A   __le16   i_links_count
-    i_links_count = struct.unpack('<H', data[26:26+2])[0]
-    # 0x20   __le32   i_flags
-    i_flags = struct.unpack('<I', data[32:32+4])[0]
-    # 0x28  60 bytes  i_block
-    i_block = data[40:100]
-    # 0x6C   __le32   i_size_high
-    i_size_high = struct.unpack('<I', data[108:112])[0]
+    i_mode, i_size_lo, i_links_count, i_flags, i_block, i_size_high = INODE_STRUCT.unpack_from(data)
 
     return {
         'filetype': get_filetype(i_mode),
@@ -253,6 +740,41 @@ def inode_parse(data):
         'size': join_int32(i_size_high, i_size_lo)
     }
 
+# get relevant data from inodes at given offsets of inode table -> [(i_mode, i_size, i_links_count, i_flags, i_block), ...]
+def inode_table_parse(data, offsets):
+    return [
+        (i_mode, (i_size_high << 32) | i_size_lo, i_links_count, i_flags, i_block)
+        for i_mode, i_size_lo, i_links_count, i_flags, i_block, i_size_high
+        in map(partial(INODE_STRUCT.unpack_from, data), offsets)
+    ]
+
+# get relevant data of one inode -> (i_mode, i_size, i_links_count, i_flags, i_block)
+def read_inode(fs, sb, inode_id):
+    group, index = divmod(inode_id - 1, sb['Inodes per group'])
+    bg = get_block_groups(fs, sb)[group]
+
+    # inodes never cross block boundary, block of inode table is cached
+    block, offset = divmod(index * sb['Inode size'], sb['Block size'])
+    data = read_blocks(fs, sb['Block size'], bg['itable'] + block)
+
+    return inode_table_parse(data, [offset])[0]
+
+# digest of used inodes in block group, it changes with inode bitmap and with any change of these inodes (e.g. ctime)
+def get_inodes_digest(data, inode_ids, offsets, inode_size):
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(array('I', inode_ids).tobytes())
+    for offset in offsets:
+        digest.update(data[offset:offset + inode_size])
+
+    return digest.hexdigest()
+
+# digest of block group without used inodes
+EMPTY_INODES_DIGEST = hashlib.blake2b(digest_size=16).hexdigest()
+
+# fields of group descriptor, that change with allocation of inodes or blocks in block group
+def get_descriptor_state(bg):
+    return [bg['bbitmap_csum'], bg['ibitmap_csum'], bg['free_blocks'], bg['free_inodes'], bg['used_dirs'], bg['itable_unused']]
+
 #
 # EXTENT TREE STRUCTS
 #
@@ -332,18 +854,17 @@ def parse_extent_data(block):
 
     return hdr['eh_depth'], entries
 
-# traverse whole extent tree and get all leaves
-def parse_extent_tree(fs, sb, root):
+# walk whole extent tree, yields block addresses of each level and gets their data -> entries of all leaves
+def walk_extent_tree(root):
     # parse extent tree root
     depth, entries = parse_extent_data(root)
 
     for i in range(depth):
-        # empty entries but keep for later
-        last_entries, entries = entries, []
+        # all blocks of this level at once
+        blocks = yield [entry['ei_leaf'] for entry in entries]
 
-        # loop through last entries
-        for entry in last_entries:
-            leaf_data = read_blocks(fs, sb['Block size'], entry['ei_leaf'], 1)
+        entries = []
+        for leaf_data in blocks:
             leaf_depth, leaf_entries = parse_extent_data(leaf_data)
 
             # fill in new entries
@@ -351,89 +872,172 @@ def parse_extent_tree(fs, sb, root):
 
     return entries
 
-# get data chunks from extent tree
-def parse_extent_tree_chunks(fs, sb, root):
-    entries = parse_extent_tree(fs, sb, root)
+# traverse whole extent tree and get all leaves
+def parse_extent_tree(fs, sb, root):
+    return run_tree_walk(fs, sb, walk_extent_tree(root))
 
+# maximum length of initialized extent
+EXT_INIT_MAX_LEN = 32768
+
+# get data chunks from entries of extent tree leaves
+def extent_entries_to_chunks(sb, entries):
     # sort entries by block
     entries = sorted(entries, key=lambda k: k['ee_block'])
 
-    block = 0
     chunks = []
     for entry in entries:
-        assert entry['ee_block'] == block
+        # extent longer than 32768 blocks is not initialized (allocated, but reads as zeros)
+        length = entry['ee_len']
+        unwritten = length > EXT_INIT_MAX_LEN
+        if unwritten:
+            length -= EXT_INIT_MAX_LEN
 
-        block += entry['ee_len']
+        # files can be sparse, so logical offset of each chunk is kept
         chunks.append({
             'addr': entry['ee_start'] * sb['Block size'],
-            'len': entry['ee_len'] * sb['Block size']
+            'len': length * sb['Block size'],
+            'offset': entry['ee_block'] * sb['Block size'],
+            'unwritten': unwritten
         })
 
     return chunks
 
+# get data chunks from extent tree
+def parse_extent_tree_chunks(fs, sb, root):
+    return extent_entries_to_chunks(sb, parse_extent_tree(fs, sb, root))
+
 #
 # (IN) DIRECT BLOCK ADDRESSING
 #
 
-# unpack array of 32bit pointers
-def unpack_pointers(fs, data):
-    pointers = []
-    for i in range(len(data) // 4):
-        offset = i * 4
-        pointer = struct.unpack('<I', data[offset:offset+4])[0]
+# unpack array of 32bit pointers along with logical block, that each of them starts -> [(logical_block, pointer), ...]
+def unpack_logical_pointers(data, logical, span=1):
+    pointers = struct.unpack('<{}I'.format(len(data) // 4), data)
+    return [(logical + i * span, pointer) for i, pointer in enumerate(pointers) if pointer != 0]
+
+# walk indirect addressing scheme, yields block addresses of each level and gets their data -> data chunks
+def walk_indirect_blocks_chunks(sb, inode_data):
+    assert len(inode_data) == 60
+
+    # pointers in one block
+    per_block = sb['Block size'] // 4
 
-        if pointer != 0:
-            pointers.append(pointer)
+    # pointers 0 - 11: direct to data
+    inode_pointers = struct.unpack('<15I', inode_data)
+    data_blocks = [(logical, pointer) for logical, pointer in enumerate(inode_pointers[:12]) if pointer != 0]
+
+    # pointers [12], [13], [14] to single, double and tripple pointer arrays
+    # -> [(logical_block, pointer, blocks spanned by each pointer in array), ...]
+    pointers = [(logical, pointer, span) for logical, pointer, span in zip(
+        (12, 12 + per_block, 12 + per_block + per_block ** 2), inode_pointers[12:], (1, per_block, per_block ** 2)
+    ) if pointer != 0]
+
+    # arrays of one level are read at once, data blocks stay in order of logical blocks
+    while pointers:
+        blocks = yield [pointer for logical, pointer, span in pointers]
 
-    return pointers
+        last_pointers, pointers = pointers, []
+        for (logical, pointer, span), data in zip(last_pointers, blocks):
+            if span == 1:
+                data_blocks += unpack_logical_pointers(data, logical)
+            else:
+                pointers += [(logical_2, pointer_2, span // per_block) for logical_2, pointer_2 in unpack_logical_pointers(data, logical, span)]
+
+    return logical_blocks_to_chunks(sb, data_blocks)
 
 # get data chunks from indirect addressing scheme
 def parse_indirect_blocks_chunks(fs, sb, inode_data):
-    assert len(inode_data) == 60
+    return run_tree_walk(fs, sb, walk_indirect_blocks_chunks(sb, inode_data))
+
+# create chunks from plain blocks array [(logical_block, physical_block), ...], blocks continuous in both are joined
+def logical_blocks_to_chunks(sb, data_blocks):
+    ranges = []
+    for logical, physical in data_blocks:
+        if ranges and ranges[-1][0] + ranges[-1][2] == logical and ranges[-1][1] + ranges[-1][2] == physical:
+            ranges[-1][2] += 1
+        else:
+            ranges.append([logical, physical, 1])
 
-    # pointers 0 - 11: direct to data
-    data_blocks = unpack_pointers(fs, inode_data[0:12*4])
-
-    # pointer [12] to pointer array
-    pointer = struct.unpack('<I', inode_data[48:52])[0]
-    if pointer != 0:
-        # 1 level
-        data = read_blocks(fs, sb['Block size'], pointer, 1)
-        data_blocks += unpack_pointers(fs, data)
-
-    # double pointer [13] to pointer array
-    pointer = struct.unpack('<I', inode_data[52:56])[0]
-    if pointer != 0:
-        # 1 level
-        data = read_blocks(fs, sb['Block size'], pointer, 1)
-
-        # 2 level
-        for pointer in unpack_pointers(fs, data):
-            data = read_blocks(fs, sb['Block size'], pointer, 1)
-            data_blocks += unpack_pointers(fs, data)
-
-    # tripple pointer [14] to pointer array
-    pointer = struct.unpack('<I', inode_data[56:60])[0]
-    if pointer != 0:
-        # 1 level
-        data = read_blocks(fs, sb['Block size'], pointer, 1)
-
-        # 2 level
-        for pointer in unpack_pointers(fs, data):
-            data = read_blocks(fs, sb['Block size'], pointer, 1)
-
-            # 3 level
-            for pointer in unpack_pointers(fs, data):
-                data = read_blocks(fs, sb['Block size'], pointer, 1)
-                data_blocks += unpack_pointers(fs, data)
+    return [{
+        'addr': physical * sb['Block size'],
+        'len': total * sb['Block size'],
+        'offset': logical * sb['Block size'],
+        'unwritten': False
+    } for logical, physical, total in ranges]
 
-    # create chunks from plain blocks array
-    chunks = [{
-        'addr': i['first'] * sb['Block size'],
-        'len': i['total'] * sb['Block size']
-    } for i in join_ranges(data_blocks)]
+#
+# TREE BLOCKS FETCHING
+#
 
-    return chunks
+# maximum size of one read of neighbouring metadata blocks
+METADATA_READ_SIZE = 1024 * 1024
+
+# metadata blocks, that are closer than this, are read by one read along with the gap
+METADATA_READ_GAP = 64 * 1024
+
+# read given metadata blocks, sorted and joined to larger reads -> {addr: data}
+# kernel is told about all reads first, so that it can read them ahead, while they are processed one by one
+def read_metadata_blocks(fs, sb, addrs):
+    block_size = sb['Block size']
+    addrs = sorted(set(addrs))
+
+    # [first, end] of each read
+    reads = []
+    for addr in addrs:
+        if reads and (addr - reads[-1][1]) * block_size <= METADATA_READ_GAP and (addr + 1 - reads[-1][0]) * block_size <= METADATA_READ_SIZE:
+            reads[-1][1] = addr + 1
+        else:
+            reads.append([addr, addr + 1])
+
+    if isinstance(fs, Ext4Image) and len(reads) > 1:
+        for first, end in reads:
+            fs.advise(first * block_size, (end - first) * block_size)
+
+    blocks = {}
+    i = 0
+    for first, end in reads:
+        data = read_blocks(fs, block_size, first, end - first)
+        while i < len(addrs) and addrs[i] < end:
+            offset = (addrs[i] - first) * block_size
+            blocks[addrs[i]] = data[offset:offset + block_size]
+            i += 1
+
+    return blocks
+
+# run walk of one tree, its blocks are read one by one -> result of walk
+def run_tree_walk(fs, sb, walk):
+    try:
+        addrs = next(walk)
+        while True:
+            addrs = walk.send([read_blocks(fs, sb['Block size'], addr, 1) for addr in addrs])
+    except StopIteration as e:
+        return e.value
+
+# run walks of many trees {key: walk} at once -> {key: result of walk}
+# blocks needed by all walks at the same level are read together by `read_metadata_blocks`
+def run_tree_walks(fs, sb, walks):
+    results = {}
+
+    # walks waiting for blocks {key: (walk, addrs)}
+    pending = {}
+
+    def advance(key, walk, blocks):
+        try:
+            pending[key] = walk, walk.send(blocks)
+        except StopIteration as e:
+            results[key] = e.value
+
+    for key, walk in walks.items():
+        advance(key, walk, None)
+
+    while pending:
+        blocks = read_metadata_blocks(fs, sb, (addr for walk, addrs in pending.values() for addr in addrs))
+
+        last_pending, pending = pending, {}
+        for key, (walk, addrs) in last_pending.items():
+            advance(key, walk, [blocks[addr] for addr in addrs])
+
+    return results
 
 #
 # CHUNKS
@@ -441,416 +1045,1402 @@ def parse_indirect_blocks_chunks(fs, sb, inode_data):
 
 # get size + chunks from inode_data
 def inode_to_chunks(fs, sb, inode):
-    # TODO: Support inlnie data
-    assert 'EXT4_INLINE_DATA_FL' not in inode['flags']
-
+    i_flags = 0
     if 'EXT4_EXTENTS_FL' in inode['flags']:
-        chunks = parse_extent_tree_chunks(fs, sb, inode['data'])
-    else:
-        chunks = parse_indirect_blocks_chunks(fs, sb, inode['data'])
+        i_flags |= EXT4_EXTENTS_FL
+    if 'EXT4_INLINE_DATA_FL' in inode['flags']:
+        i_flags |= EXT4_INLINE_DATA_FL
 
-    size = inode['size']
-    return size, chunks
+    return inode['size'], i_block_to_chunks(fs, sb, i_flags, inode['data'])
 
-# chunk [{'addr': 8706, 'len': 1}]
-def get_file_from_chunks(src_fs, chunks, dst_fs, size=None):
-    dst_fh = open(dst_fs, 'wb')
-    src_fh = open(src_fs, 'r+b')
+# walk tree of raw `i_flags` and `i_block`, yields block addresses of each level and gets their data -> chunks
+def walk_i_block_chunks(sb, i_flags, i_block):
+    if i_flags & EXT4_INLINE_DATA_FL:
+        raise Exception('Inline data is not supported.')
 
-    chunks_size = 0
-    for chunk in chunks:
-        chunks_size += chunk['len']
+    if i_flags & EXT4_EXTENTS_FL:
+        entries = yield from walk_extent_tree(i_block)
+        return extent_entries_to_chunks(sb, entries)
+
+    return (yield from walk_indirect_blocks_chunks(sb, i_block))
+
+# get chunks from raw `i_flags` and `i_block`
+def i_block_to_chunks(fs, sb, i_flags, i_block):
+    return run_tree_walk(fs, sb, walk_i_block_chunks(sb, i_flags, i_block))
+
+# get chunks of many inodes {inode_id: (i_flags, i_block)} -> {inode_id: chunks}
+# tree blocks of all inodes are fetched level by level, in order of their addresses
+def i_blocks_to_chunks(fs, sb, inodes):
+    return run_tree_walks(fs, sb, {
+        inode_id: walk_i_block_chunks(sb, i_flags, i_block) for inode_id, (i_flags, i_block) in inodes.items()
+    })
+
+# size of buffer, when data cannot be copied by kernel
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# errors meaning, that given way of copying is not supported between these files
+COPY_UNSUPPORTED_ERRORS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF)
+
+# copy data between files by kernel using `copy_file_range`, then `sendfile`, otherwise through fixed buffer
+class ChunkCopier:
+    def __init__(self, src_fd, dst_fd):
+        self.src_fd = src_fd
+        self.dst_fd = dst_fd
+
+        self.methods = [self.copy_buffer]
+        if hasattr(os, 'sendfile'):
+            self.methods.insert(0, self.copy_sendfile)
+        if hasattr(os, 'copy_file_range'):
+            self.methods.insert(0, self.copy_file_range)
+
+        self.buffer = None
+
+    def copy_file_range(self, offset, length):
+        return os.copy_file_range(self.src_fd, self.dst_fd, length, offset)
+
+    def copy_sendfile(self, offset, length):
+        return os.sendfile(self.dst_fd, self.src_fd, offset, length)
+
+    def copy_buffer(self, offset, length):
+        if self.buffer is None:
+            self.buffer = bytearray(COPY_BUFFER_SIZE)
+
+        view = memoryview(self.buffer)[:min(length, COPY_BUFFER_SIZE)]
+        copied = os.preadv(self.src_fd, [view], offset)
+
+        written = 0
+        while written < copied:
+            written += os.write(self.dst_fd, view[written:copied])
 
-        src_fh.seek(chunk['addr'])
+        return copied
+
+    # copy `length` bytes from `offset` of source to current position of destination
+    def copy(self, offset, length):
+        while length > 0:
+            try:
+                copied = self.methods[0](offset, length)
+            except OSError as e:
+                # fallback to next method
+                if e.errno not in COPY_UNSUPPORTED_ERRORS or len(self.methods) == 1:
+                    raise
+                self.methods.pop(0)
+                continue
+
+            if copied == 0:
+                raise Exception('Unexpected end of filesystem image.')
+
+            offset += copied
+            length -= copied
+
+# get parts of file, that need to be copied -> ([(offset, addr, length), ...], file_size)
+def get_copy_ranges(chunks, size=None):
+    ranges = []
+    end = 0
+    for offset, chunk in get_chunks_offsets(chunks):
+        length = chunk['len']
 
         # if size is set, remove oveflowing zeros
-        if size is not None and size < chunks_size:
-            data = src_fh.read(chunk['len'])
-            diff = chunks_size - size
-            dst_fh.write(data[0:chunk['len'] - diff])
-        else:
-            dst_fh.write(src_fh.read(chunk['len']))
+        if size is not None:
+            length = min(length, size - offset)
 
-    src_fh.close()
-    dst_fh.close()
+        # unwritten chunks are left as holes
+        if length <= 0 or chunk.get('unwritten'):
+            continue
 
-# chunk [{'addr': 8706, 'len': 1}]
-def get_from_chunks(src_fs, chunks, size=None):
-    dst = b''
-    src_fh = open(src_fs, 'r+b')
+        ranges.append((offset, chunk['addr'], length))
+        end = max(end, offset + length)
 
-    chunks_size = 0
-    for chunk in chunks:
-        chunks_size += chunk['len']
+    return ranges, end if size is None else size
 
-        src_fh.seek(chunk['addr'])
-        data = src_fh.read(chunk['len'])
+# chunk [{'addr': 8706, 'len': 1, 'offset': 0, 'unwritten': False}]
+def get_file_from_chunks(src_fs, chunks, dst_fs, size=None):
+    src_fh = src_fs.fh if isinstance(src_fs, Ext4Image) else open(src_fs, 'rb')
+
+    try:
+        with open(dst_fs, 'wb') as dst_fh:
+            dst_fd = dst_fh.fileno()
+            copier = ChunkCopier(src_fh.fileno(), dst_fd)
+
+            ranges, file_size = get_copy_ranges(chunks, size)
+            for offset, addr, length in ranges:
+                # skipped parts of file are left as holes
+                os.lseek(dst_fd, offset, os.SEEK_SET)
+                copier.copy(addr, length)
+
+            # file can end with hole
+            os.ftruncate(dst_fd, file_size)
+    finally:
+        if not isinstance(src_fs, Ext4Image):
+            src_fh.close()
+
+# maximum number of output files opened at once, when recovering more files
+MAX_OPEN_FILES = 256
+
+# size of one piece of data, that is copied by worker thread
+PARALLEL_COPY_SIZE = 4 * 1024 * 1024
+
+# maximum size of data, that is read but not yet written by worker threads
+MAX_IN_FLIGHT_BYTES = 64 * 1024 * 1024
+
+# limit of bytes in flight, shared between worker threads
+class InFlightLimit:
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.cond = threading.Condition()
+
+    # wait until there is space for given bytes, one piece is always allowed
+    def acquire(self, length):
+        with self.cond:
+            self.cond.wait_for(lambda: self.used == 0 or self.used + length <= self.limit)
+            self.used += length
+
+    def release(self, length):
+        with self.cond:
+            self.used -= length
+            self.cond.notify_all()
+
+# copy one piece of data at explicit offsets, so that more threads can share file descriptors
+def copy_piece(src_fd, dst_path, addr, offset, length):
+    data = os.pread(src_fd, length, addr)
+    if len(data) != length:
+        raise Exception('Unexpected end of filesystem image.')
+
+    fd = os.open(dst_path, os.O_WRONLY)
+    try:
+        view = memoryview(data)
+        written = 0
+        while written < length:
+            written += os.pwrite(fd, view[written:], offset + written)
+    finally:
+        os.close(fd)
+
+    return length
+
+# copy [(addr, offset, length, dst_path), ...] by more threads
+def copy_ops_parallel(src_fd, ops, jobs, max_in_flight=MAX_IN_FLIGHT_BYTES):
+    limit = InFlightLimit(max_in_flight)
+    errors = []
+
+    def done(future, length):
+        limit.release(length)
+        if future.exception() is not None:
+            errors.append(future.exception())
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for addr, offset, length, dst_path in ops:
+            # split long chunks, so that more threads can read them
+            for piece in range(0, length, PARALLEL_COPY_SIZE):
+                if errors:
+                    break
+
+                piece_length = min(PARALLEL_COPY_SIZE, length - piece)
+                limit.acquire(piece_length)
+
+                future = executor.submit(copy_piece, src_fd, dst_path, addr + piece, offset + piece, piece_length)
+                future.add_done_callback(partial(done, length=piece_length))
+
+    if errors:
+        raise errors[0]
+
+# recover more files at once {dst_path: (size, chunks)}, all chunks are read in order of their physical address
+# returns number of copied bytes
+def get_files_from_chunks(src_fs, files, jobs=1):
+    # create all files, they can end with hole
+    ops = []
+    for dst_path, (size, chunks) in files.items():
+        ranges, file_size = get_copy_ranges(chunks, size)
+
+        with open(dst_path, 'wb') as dst_fh:
+            os.ftruncate(dst_fh.fileno(), file_size)
+
+        ops += [(addr, offset, length, dst_path) for offset, addr, length in ranges]
+
+    ops.sort(key=lambda op: op[0])
+
+    if jobs > 1:
+        copy_ops_parallel(src_fs.fh.fileno(), ops, jobs)
+        return sum(op[2] for op in ops)
+
+    copier = ChunkCopier(src_fs.fh.fileno(), None)
+
+    # opened output files {dst_path: fd}, least recently used are closed
+    fds = OrderedDict()
+    try:
+        for addr, offset, length, dst_path in ops:
+            if dst_path in fds:
+                fds.move_to_end(dst_path)
+            else:
+                fds[dst_path] = os.open(dst_path, os.O_WRONLY)
+                if len(fds) > MAX_OPEN_FILES:
+                    os.close(fds.popitem(last=False)[1])
+
+            copier.dst_fd = fds[dst_path]
+            os.lseek(copier.dst_fd, offset, os.SEEK_SET)
+            copier.copy(addr, length)
+    finally:
+        for fd in fds.values():
+            os.close(fd)
+
+    return sum(op[2] for op in ops)
+
+# chunk [{'addr': 8706, 'len': 1, 'offset': 0, 'unwritten': False}]
+def get_from_chunks(src_fs, chunks, size=None):
+    dst = bytearray()
+
+    for offset, chunk in get_chunks_offsets(chunks):
+        length = chunk['len']
 
         # if size is set, remove oveflowing zeros
-        if size is not None and size < chunks_size:
-            dst += data[0:chunk['len'] - diff]
+        if size is not None:
+            length = min(length, size - offset)
+
+        if length <= 0:
+            continue
+
+        # holes are filled with zeros
+        if len(dst) < offset:
+            dst += bytes(offset - len(dst))
+
+        if chunk.get('unwritten'):
+            dst[offset:offset + length] = bytes(length)
         else:
-            dst += data
+            dst[offset:offset + length] = read_blocks(src_fs, 1, chunk['addr'], length)
 
-    src_fh.close()
+    if size is not None and len(dst) < size:
+        dst += bytes(size - len(dst))
 
-    return data
+    return bytes(dst)
 
 #
 # DIRS
 #
 
-# read one block of directory
-def readdir_block(sb, data):
-    length = len(data)
-    offset = 0
-    entries = []
-    while True:
-        assert offset <= length
-
-        res = {}
-        # 0x00   __le32   inode
-        inode = struct.unpack('<I', data[offset:offset+4])[0]
-        # 0x04   __le16   rec_len
-        rec_len = struct.unpack('<H', data[offset+4:offset+6])[0]
-
-        if 'filetype' in sb['Filesystem features']:
-            # 0x06   __u8     name_len
-            name_len = struct.unpack('<B', data[offset+6:offset+7])[0]
-            # 0x07   __u8     file_type
-            file_type = struct.unpack('<B', data[offset+7:offset+8])[0]
-        else:
-             # 0x06   __le16  name_len
-            name_len = struct.unpack('<H', data[offset+4:offset+8])[0]
-            file_type = 0x0
-
-        # 0x08   char     name[EXT4_NAME_LEN]
-        assert name_len <= 0xFF
-        name = data[offset+8:offset+8+name_len].decode("utf-8")
-
-        # Parse file_type
-        if file_type == 0x0: # S_IFSOCK (Socket)
-            file_type = None
-        elif file_type == 0x5: # S_IFIFO (FIFO)
-            file_type = 'S_IFIFO'
-        elif file_type == 0x3: # S_IFCHR (Character device)
-            file_type = 'S_IFCHR'
-        elif file_type == 0x2: # S_IFDIR (Directory)
-            file_type = 'S_IFDIR'
-        elif file_type == 0x4: # S_IFBLK (Block device)
-            file_type = 'S_IFBLK'
-        elif file_type == 0x1: # S_IFREG (Regular file)
-            file_type = 'S_IFREG'
-        elif file_type == 0x7: # S_IFLNK (Symbolic link)
-            file_type = 'S_IFLNK'
-        elif file_type == 0x6: # S_IFSOCK (Socket)
-            file_type = 'S_IFSOCK'
-
-        # inode with id 0 is removed entry
-        if inode != 0:
-            entries.append({
-                'inode': inode,
-                'filetype': file_type,
-                'name': name
-            })
+# 0x00   __le32   inode
+# 0x04   __le16   rec_len
+# 0x06   __u8     name_len
+# 0x07   __u8     file_type (without filetype feature, high byte of __le16 name_len)
+# 0x08   char     name[EXT4_NAME_LEN]
+DIR_ENTRY_STRUCT = struct.Struct('<IHBB')
+
+# file_type of directory entry
+DIR_FILETYPE_REG = 0x1
+DIR_FILETYPE_DIR = 0x2
+DIR_FILETYPES = {
+    0x1: 'S_IFREG',
+    0x2: 'S_IFDIR',
+    0x3: 'S_IFCHR',
+    0x4: 'S_IFBLK',
+    0x5: 'S_IFIFO',
+    0x6: 'S_IFSOCK',
+    0x7: 'S_IFLNK',
+}
+
+# block numbers in dx entries have 28 bits
+DX_BLOCK_MASK = 0x0FFFFFFF
+
+# get logical blocks of htree directory, that hold index (dx_root, dx_node) instead of entries
+def get_dx_blocks(sb, data):
+    block_size = sb['Block size']
+
+    # dx_root: '.' entry (12 bytes), '..' entry header (12 bytes), then dx_root_info
+    # 0x18   __le32   reserved_zero
+    # 0x1C   __u8     hash_version
+    # 0x1D   __u8     info_length
+    # 0x1E   __u8     indirect_levels
+    # 0x1F   __u8     unused_flags
+    if len(data) < 0x20:
+        return {0}
+
+    reserved_zero, hash_version, info_length, indirect_levels, unused_flags = struct.unpack_from('<I4B', data, 0x18)
+    if reserved_zero != 0 or info_length != 8:
+        return {0}
+
+    # dx_countlimit (__le16 limit, __le16 count) overlays hash of first dx_entry (__le32 hash, __le32 block)
+    dx_blocks = {0}
+    level = [0x18 + info_length]
+    for depth in range(indirect_levels):
+        next_level = []
+        for offset in level:
+            if offset + 8 > len(data):
+                continue
 
-        offset += rec_len
+            limit, count = struct.unpack_from('<HH', data, offset)
+            count = min(count, limit, (len(data) - offset) // 8)
+            for i in range(count):
+                block = struct.unpack_from('<I', data, offset + i * 8 + 4)[0] & DX_BLOCK_MASK
+                if block not in dx_blocks and (block + 1) * block_size <= len(data):
+                    dx_blocks.add(block)
+
+                    # dx_node starts with fake entry of 8 bytes, that covers whole block
+                    next_level.append(block * block_size + 8)
+        level = next_level
+
+    return dx_blocks
+
+# iterate entries of directory data -> (inode, file_type, name), removed entries and checksum tails are skipped
+# with EXT4_INDEX_FL, index blocks of htree are skipped; corrupted entry skips rest of its block
+def iter_dir_entries(sb, data, i_flags=0):
+    block_size = sb['Block size']
+    has_filetype = 'filetype' in sb['Filesystem features']
+    dx_blocks = get_dx_blocks(sb, data) if i_flags & EXT4_INDEX_FL else ()
+    unpack_from = DIR_ENTRY_STRUCT.unpack_from
+
+    for block, block_start in enumerate(range(0, len(data), block_size)):
+        if block in dx_blocks:
+            continue
 
-        # if entry lasts to te end of the block, list ended
-        if offset == length:
-            break
+        block_end = min(block_start + block_size, len(data))
+        offset = block_start
+        while offset + 8 <= block_end:
+            inode, rec_len, name_len, file_type = unpack_from(data, offset)
+            if rec_len < 8 or offset + rec_len > block_end:
+                break
 
-    return entries
+            if not has_filetype:
+                name_len |= file_type << 8
+                file_type = 0
 
-# chunk [{'addr': 8706, 'len': 1}]
-def readdir_from_chunks(fs, sb, chunks, size=None):
-    fh = open(fs, 'r+b')
+            # inode with id 0 is removed entry, empty block or checksum tail
+            if inode != 0 and 8 + name_len <= rec_len:
+                yield inode, file_type, bytes(data[offset + 8:offset + 8 + name_len]).decode('utf-8', 'replace')
 
-    chunks_size = 0
-    entries = []
-    for chunk in chunks:
-        chunks_size += chunk['len']
+            offset += rec_len
 
-        fh.seek(chunk['addr'])
-        block = fh.read(chunk['len'])
+# read one block of directory
+def readdir_block(sb, data):
+    return [{
+        'inode': inode,
+        'filetype': DIR_FILETYPES.get(file_type),
+        'name': name
+    } for inode, file_type, name in iter_dir_entries(sb, data)]
+
+# get data of directory from its chunks in logical order, holes are filled with zeros
+# chunks are sliced from window, when it is given and contains them
+def read_directory_data(fs, sb, chunks, size=None, window=None, window_start=0):
+    data = bytearray()
+    for offset, chunk in get_chunks_offsets(chunks):
+        if chunk.get('unwritten'):
+            continue
 
-        # if size is set, remove oveflowing zeros
-        if size is not None and size < chunks_size:
-            block = data[0:chunk['len'] - diff]
+        if offset > len(data):
+            data += bytes(offset - len(data))
 
-        entries += readdir_block(sb, block)
+        addr = chunk['addr'] - window_start
+        if window is not None and 0 <= addr and addr + chunk['len'] <= len(window):
+            data += window[addr:addr + chunk['len']]
+        else:
+            data += read_blocks(fs, 1, chunk['addr'], chunk['len'])
 
-    fh.close()
-    return entries
+    # if size is set, remove oveflowing zeros
+    if size is not None:
+        del data[size:]
+
+    return data
+
+# chunk [{'addr': 8706, 'len': 1}]
+def readdir_from_chunks(fs, sb, chunks, size=None, i_flags=0):
+    return [{
+        'inode': inode,
+        'filetype': DIR_FILETYPES.get(file_type),
+        'name': name
+    } for inode, file_type, name in iter_dir_entries(sb, read_directory_data(fs, sb, chunks, size), i_flags)]
+
+# maximum size of one read, when reading blocks of more directories at once
+DIRS_READ_SIZE = 4 * 1024 * 1024
+
+# maximum gap between blocks of directories, that are read at once
+DIRS_READ_GAP = 256 * 1024
+
+# read entries of directories in batch, blocks within window [start, end) are read at once -> (key, entries)
+def read_dirs_batch(fs, sb, batch, start, end):
+    window = None
+    if start is not None and end - start <= DIRS_READ_SIZE:
+        window = memoryview(read_blocks(fs, 1, start, end - start))
+
+    for key, size, chunks, i_flags in batch:
+        data = read_directory_data(fs, sb, chunks, size, window, start)
+        yield key, iter_dir_entries(sb, data, i_flags)
+
+# read entries of more directories (key, size, chunks, i_flags) sorted by physical address of their first block
+# -> (key, entries) in same order; blocks of neighbouring directories are read at once, in physical order
+def iter_dirs_entries(fs, sb, dirs):
+    batch = []
+    start = end = None
+    for key, size, chunks, i_flags in dirs:
+        written = [chunk for chunk in chunks if not chunk.get('unwritten') and chunk['len'] > 0]
+        if written:
+            first = min(chunk['addr'] for chunk in written)
+            last = max(chunk['addr'] + chunk['len'] for chunk in written)
+
+            if batch and start is not None and (first - end > DIRS_READ_GAP or max(end, last) - start > DIRS_READ_SIZE):
+                yield from read_dirs_batch(fs, sb, batch, start, end)
+                batch = []
+                start = end = None
+
+            if start is None:
+                start, end = first, last
+            else:
+                end = max(end, last)
+
+        batch.append((key, size, chunks, i_flags))
+
+    if batch:
+        yield from read_dirs_batch(fs, sb, batch, start, end)
 
 #
 # CHECKSUM
 #
 
+# sorted ranges of used blocks, searchable by bisection
+class UsedBlocks:
+    def __init__(self, ranges=()):
+        # [first, end) of each range
+        self.starts = array('Q')
+        self.ends = array('Q')
+
+        for entry in ranges:
+            self.append(entry['first'], entry['first'] + entry['total'])
+
+    # append range, it must be after all other ranges
+    def append(self, first, end):
+        assert not self.ends or first >= self.ends[-1]
+
+        # join continuous ranges
+        if self.ends and self.ends[-1] == first:
+            self.ends[-1] = end
+        else:
+            self.starts.append(first)
+            self.ends.append(end)
+
+    # check whether any block from [first, end) is used
+    def overlaps(self, first, end):
+        if first >= end:
+            return False
+
+        # first range, that ends after first block
+        i = bisect_right(self.ends, first)
+        return i < len(self.starts) and self.starts[i] < end
+
+    # get [first, end) of used blocks within [first, end)
+    def overlapping(self, first, end):
+        ranges = []
+
+        if first >= end:
+            return ranges
+
+        # loop through ranges, that end after first block and start before end
+        i = bisect_right(self.ends, first)
+        while i < len(self.starts) and self.starts[i] < end:
+            ranges.append([max(first, self.starts[i]), min(end, self.ends[i])])
+            i += 1
+
+        return ranges
+
+    # iterate as ranges {first:1, total:2}
+    def __iter__(self):
+        for first, end in zip(self.starts, self.ends):
+            yield {
+                'first': first,
+                'total': end - first
+            }
+
+    def __len__(self):
+        return len(self.starts)
+
 # get ranges of blocks used, from bbitmap
 def get_used_blocks(fs, sb):
+    # get blocks, only with initialized bitmap
+    bgs = [bg for bg in get_block_groups(fs, sb) if not test_block_groups_flag(sb, 'BLOCK_UNINIT', bg['group'])]
+
     # get used blocks from bbitmap
-    bgs = get_block_groups(fs)
-    used_blocks = []
-    for bg in bgs:
-        # only initialized blocks
-        if test_block_groups_flag(sb, 'BLOCK_UNINIT', bg['group']):
-            continue
+    used_blocks = UsedBlocks()
+    for bg, bitmap in read_bitmaps(fs, sb, bgs, 'bbitmap'):
+        append_used_blocks(used_blocks, sb, bg, bitmap)
 
-        # get & parse bitmap
-        bitmap = read_blocks(fs, sb['Block size'], bg['bbitmap'])
-        indexes = parse_bitmap(bitmap, sb['Blocks per group'])
+    return used_blocks
 
-        # loop through used blocks in this bg
-        for index in indexes:
-            # block ID
-            block_index = index + (sb['Blocks per group'] * bg['group']) + 1
-            used_blocks.append(block_index)
+# append used blocks of one block group from its bbitmap
+def append_used_blocks(used_blocks, sb, bg, bitmap):
+    # last group can be shorter
+    total = min(sb['Blocks per group'], sb['Block count'] - bg['block'])
 
-            # physical block addess
-            #block_addr = (index * sb['Block size']) + bg['block']
+    # block IDs, joined with previous group
+    for entry in parse_bitmap_runs(bitmap, total, bg['block']):
+        used_blocks.append(entry['first'], entry['first'] + entry['total'])
 
-    return join_ranges(used_blocks)
+# used blocks, whose bbitmaps are read on demand, only for block groups of checked blocks
+class LazyUsedBlocks:
+    def __init__(self, fs, sb):
+        self.fs = fs
+        self.sb = sb
 
-# check if it has chunks, that are still used whithin fs
-def has_conflicting_chunks(fs, sb, used_blocks, chunks):
-    for chunk in chunks:
-        # get blocks from physical address
-        file_l = chunk["addr"] // sb["Block size"]
-        file_r = file_l + (chunk["len"] // sb["Block size"])
+        # {group: UsedBlocks}
+        self.groups = {}
 
-        for used_block in used_blocks:
-            used_l = used_block['first']
-            used_r = used_l + used_block['total']
+    def get_group(self, group):
+        used_blocks = self.groups.get(group)
+        if used_blocks is None:
+            used_blocks = self.groups[group] = UsedBlocks()
 
-            # check whether is range on the left or on the right
-            # left is inclusive and right is exclusive, so therefore <= and >= where they meet
-            is_left = file_l < used_l and file_r <= used_l
-            is_right = file_l >= used_r and file_r > used_r
+            # blocks of not initialized bbitmap are free
+            if not test_block_groups_flag(self.sb, 'BLOCK_UNINIT', group):
+                for bg, bitmap in read_bitmaps(self.fs, self.sb, [self.sb['Block groups'][group]], 'bbitmap'):
+                    append_used_blocks(used_blocks, self.sb, bg, bitmap)
 
-            # check whether overlapping
-            if not (is_left or is_right):
-                return True
+        return used_blocks
 
-    return False
+    # block groups of blocks [first, end)
+    def get_groups(self, first, end):
+        first_group = (first - self.sb['First block']) // self.sb['Blocks per group']
+        last_group = (end - 1 - self.sb['First block']) // self.sb['Blocks per group']
+        return range(max(first_group, 0), min(last_group + 1, self.sb['Block groups count']))
 
-# get chunks, that are still used whithin fs
-def get_conflicting_chunks(fs, sb, used_blocks, chunks):
-    conflicting = []
-    for chunk in chunks:
-        # get blocks from physical address
-        file_l = chunk["addr"] // sb["Block size"]
-        file_r = file_l + (chunk["len"] // sb["Block size"])
+    def overlaps(self, first, end):
+        return first < end and any(self.get_group(group).overlaps(first, end) for group in self.get_groups(first, end))
+
+    def overlapping(self, first, end):
+        if first >= end:
+            return []
+
+        return [entry for group in self.get_groups(first, end) for entry in self.get_group(group).overlapping(first, end)]
+
+# get blocks [first, end) from physical address of chunk
+def get_chunk_blocks(sb, chunk):
+    file_l = chunk['addr'] // sb['Block size']
+    file_r = -(-(chunk['addr'] + chunk['len']) // sb['Block size'])
+    return file_l, file_r
 
-        for used_block in used_blocks:
-            used_l = used_block['first']
-            used_r = used_l + used_block['total']
+# check if it has chunks, that are still used whithin fs
+def has_conflicting_chunks(fs, sb, used_blocks, chunks):
+    if not isinstance(used_blocks, (UsedBlocks, LazyUsedBlocks)):
+        used_blocks = UsedBlocks(used_blocks)
 
-            # check whether is range on the left or on the right
-            # left is inclusive and right is exclusive, so therefore <= and >= where they meet
-            is_left = file_l < used_l and file_r <= used_l
-            is_right = file_l >= used_r and file_r > used_r
+    for chunk in chunks:
+        # unwritten chunks are not read
+        if chunk.get('unwritten'):
+            continue
 
-            # check whether overlapping
-            if not (is_left or is_right):
+        if used_blocks.overlaps(*get_chunk_blocks(sb, chunk)):
+            return True
 
-                # check wherher range starts or ends here
-                starts_here = file_l >= used_l and file_l <= used_r
-                ends_here = file_r <= used_r and used_r >= used_l
+    return False
 
-                # if is whithin range, put whole file as conflicting
-                if starts_here and ends_here:
-                    conflicting.append([file_l, file_r])
+# get chunks, that are still used whithin fs
+def get_conflicting_chunks(fs, sb, used_blocks, chunks):
+    if not isinstance(used_blocks, (UsedBlocks, LazyUsedBlocks)):
+        used_blocks = UsedBlocks(used_blocks)
 
-                # if starts here but ends somewhere else, put only start of file and end of used
-                elif starts_here:
-                    conflicting.append([file_l, used_r])
+    conflicting = []
+    for chunk in chunks:
+        # unwritten chunks are not read
+        if chunk.get('unwritten'):
+            continue
 
-                # if ends here but starts somewhere else, put only start of used and end of file
-                elif ends_here:
-                    conflicting.append([used_l, file_r])
+        conflicting += used_blocks.overlapping(*get_chunk_blocks(sb, chunk))
 
     # create chunks from plain blocks array
     return [{
         'addr': i[0] * sb['Block size'],
-        'len': i[1] * sb['Block size']
+        'len': (i[1] - i[0]) * sb['Block size']
     } for i in conflicting]
 
-# check whether inode is deleted, from ibitmap
-def is_inode_deleted(fs, sb, inode_id):
-    bg_index = (inode_id - 1) // sb['Inodes per group']
-    bitmap_index = (inode_id - 1) % sb['Inodes per group']
-
-    # get used blocks from bbitmap
-    bgs = get_block_groups(fs)
-    bg = bgs[bg_index]
+# get set of given inodes, that are not allocated; only bitmaps of their block groups are read
+def get_deleted_inodes(fs, sb, inode_ids):
+    # group inode indexes by block groups
+    groups = {}
+    for inode_id in set(inode_ids):
+        bg_index, bitmap_index = divmod(inode_id - 1, sb['Inodes per group'])
+        groups.setdefault(bg_index, []).append((bitmap_index, inode_id))
+
+    bgs = get_block_groups(fs, sb)
+
+    deleted = set()
+    needed_bgs = []
+    for bg_index in sorted(groups):
+        # not initialized inodes are all free
+        if test_block_groups_flag(sb, 'INODE_UNINIT', bg_index):
+            deleted.update(inode_id for bitmap_index, inode_id in groups[bg_index])
+        else:
+            needed_bgs.append(bgs[bg_index])
+
+    for bg, bitmap in read_bitmaps(fs, sb, needed_bgs, 'ibitmap'):
+        deleted.update(
+            inode_id for bitmap_index, inode_id in groups[bg['group']]
+            if not bitmap[bitmap_index >> 3] & (1 << (bitmap_index & 7))
+        )
+
+    return deleted
+
+# inodes, that are not allocated, from inode bitmaps kept in memory
+# bitmaps of all block groups are read at once, or with preload=False only bitmaps of checked inodes on demand
+class FreeInodes:
+    def __init__(self, fs, sb, preload=True):
+        self.fs = fs
+        self.sb = sb
+        self.inodes_per_group = sb['Inodes per group']
+
+        # {group: bitmap or None}, all inodes of block groups with not initialized inodes are free
+        self.bitmaps = {}
+        if preload:
+            self.load(get_block_groups(fs, sb))
+
+    def load(self, bgs):
+        needed_bgs = []
+        for bg in bgs:
+            if test_block_groups_flag(self.sb, 'INODE_UNINIT', bg['group']):
+                self.bitmaps[bg['group']] = None
+            else:
+                needed_bgs.append(bg)
+
+        for bg, bitmap in read_bitmaps(self.fs, self.sb, needed_bgs, 'ibitmap'):
+            self.bitmaps[bg['group']] = bitmap
+
+    def __contains__(self, inode_id):
+        bg_index, bitmap_index = divmod(inode_id - 1, self.inodes_per_group)
+        if bg_index not in self.bitmaps:
+            if bg_index >= self.sb['Block groups count']:
+                return True
+            self.load([self.sb['Block groups'][bg_index]])
 
-    if test_block_groups_flag(sb, 'INODE_UNINIT', bg['group']):
-        return True
+        bitmap = self.bitmaps[bg_index]
+        return bitmap is None or not bitmap[bitmap_index >> 3] & (1 << (bitmap_index & 7))
 
-    bitmap = read_blocks(fs, sb['Block size'], bg['ibitmap'])
-    return access_bit(bitmap, bitmap_index) == 0
+# check whether inode is deleted, from ibitmap
+def is_inode_deleted(fs, sb, inode_id):
+    return inode_id in get_deleted_inodes(fs, sb, [inode_id])
 
 # check if given inodes have been deleted; return list of inodes, that have been deleted
 def check_if_deleted_inodes(fs, sb, inode_ids):
-    bgs = get_block_groups(fs)
-
-    available_inode_ids = list(inode_ids)
-    for bg in bgs:
-        # only initialized inodes
-        if test_block_groups_flag(sb, 'INODE_UNINIT', bg['group']):
-            continue
-
-        # get & parse bitmap
-        bitmap = read_blocks(fs, sb['Block size'], bg['ibitmap'])
-        indexes = parse_bitmap(bitmap, sb['Inodes per group'])
-
-        # get inode ids
-        for index in indexes:
-            inode_id = index + (sb['Inodes per group'] * bg['group']) + 1
-            if inode_id in available_inode_ids:
-                available_inode_ids.remove(inode_id)
+    inode_ids = list(inode_ids)
+    deleted = get_deleted_inodes(fs, sb, inode_ids)
 
-        if len(available_inode_ids) == 0:
-            break
-
-    return available_inode_ids
+    return [inode_id for inode_id in inode_ids if inode_id in deleted]
 
 #
 # SNAPSHOT
 #
 
 import json
-def save_snapshot(file_path, snapshot):
+def save_snapshot(file_path, snapshot, snapshot_format='binary'):
+    if snapshot_format == 'binary':
+        save_binary_snapshot(file_path, snapshot)
+        return
+
     with open(file_path, 'w', encoding='utf-8') as file:
         file.write(json.dumps(snapshot))
 
 def load_snapshot(file_path):
+    # latest generation of snapshot store
+    if os.path.isdir(file_path):
+        generation = SnapshotStore(file_path).load_generation()
+        if generation is None:
+            raise Exception('Snapshot store is empty.')
+        return generation
+
+    # binary snapshot is memory mapped, records are read when needed
+    if is_binary_snapshot(file_path):
+        return BinarySnapshot(file_path)
+
     with open(file_path, 'r', encoding='utf-8') as file:
         snapshot = json.load(file)
 
+    # manifest of generation in snapshot store, store is two levels up
+    if 'pages' in snapshot:
+        store_path = os.path.dirname(os.path.dirname(os.path.abspath(file_path)))
+        return StoreGeneration(SnapshotStore(store_path), snapshot)
+
     # JSON stores keys only as strings
     snapshot['inodes'] = {int(k):v for k,v in snapshot['inodes'].items()}
+
+    # paths are front coded, snapshots of first version have only 'dirs' as {path: inode_id}
+    if isinstance(snapshot['dirs'], list):
+        snapshot['dirs'] = EncodedPaths(snapshot['dirs'])
+    if 'directories' in snapshot:
+        snapshot['directories'] = EncodedPaths(snapshot['directories'])
+
     return snapshot
 
-# generate snapshot from fs
-def generate_snapshot(fs, snapshot_file, dirs_max_depth=100):
-    sb = get_super(fs)
-    inodes = get_inodes_addresses(fs, sb)
-
-    files_chunks = {}
-    dirs_chunks = {}
-    for inode_id, inode_addr in inodes.items():
-        inode_data = read_blocks(fs, 1, inode_addr, sb['Inode size'])
-        inode = inode_parse(inode_data)
-
-        # only regular files
-        if inode['filetype'] == 'S_IFREG' and inode_id > 11:
-            size, chunks = inode_to_chunks(fs, sb, inode)
-            files_chunks[inode_id] = size, chunks
+# get (path, inode_id) of snapshot paths, that start with given prefix
+def get_paths_with_prefix(snapshot, prefix):
+    dirs = snapshot['dirs']
+
+    # binary snapshot has sorted paths with index, snapshot store has directory tree
+    if hasattr(dirs, 'items_with_prefix'):
+        return dirs.items_with_prefix(prefix)
+
+    return ((path, inode_id) for path, inode_id in dirs.items() if path.startswith(prefix))
+
+# check whether path is glob pattern
+def is_glob(path):
+    return any(c in path for c in '*?[')
+
+# get (path, inode_id) of snapshot paths matching one pattern: exact path, directory prefix ending with '/' or glob pattern
+def get_paths_with_pattern(snapshot, pattern):
+    if is_glob(pattern):
+        # only paths starting with part before first wildcard can match
+        prefix = re.split(r'[*?\[]', pattern, 1)[0]
+        return (
+            (path, inode_id) for path, inode_id in get_paths_with_prefix(snapshot, prefix)
+            if fnmatch.fnmatchcase(path, pattern)
+        )
+
+    if pattern.endswith('/'):
+        return get_paths_with_prefix(snapshot, pattern)
+
+    inode_id = snapshot['dirs'].get(pattern)
+    return [(pattern, inode_id)] if inode_id is not None else []
+
+# find (path, inode_id) in snapshot, by exact paths, directory prefixes ending with '/' or glob patterns
+def find_snapshot_paths(snapshot, patterns):
+    found = {}
+    for pattern in patterns:
+        paths = get_paths_with_pattern(snapshot, pattern)
+        if not is_glob(pattern) and not pattern.endswith('/') and not paths:
+            raise Exception('File {} was not found.'.format(pattern))
+        found.update(paths)
+
+    return found
+
+# iterate (path, inode_id) of snapshot paths matching any of patterns, all paths without patterns
+# paths of each pattern are in sorted order, missing exact paths are skipped
+def iter_snapshot_paths(snapshot, patterns=None):
+    if not patterns:
+        yield from snapshot['dirs'].items()
+        return
+
+    # more patterns can match the same path
+    seen = set() if len(patterns) > 1 else None
+    for pattern in patterns:
+        for path, inode_id in get_paths_with_pattern(snapshot, pattern):
+            if seen is not None:
+                if path in seen:
+                    continue
+                seen.add(path)
+
+            yield path, inode_id
+
+# generate snapshot from fs; with base snapshot of same fs, only changed block groups are scanned again
+# records are written to snapshot file while scanning, memory limit bounds records buffered before they are spilled to
+# temporary files next to snapshot file; phases and reads are counted to `Stats`, if it is given
+def generate_snapshot(fs, snapshot_file, dirs_max_depth=100, jobs=1, snapshot_format='binary', base_snapshot_file=None, trust_descriptors=False, memory_limit=SNAPSHOT_MEMORY_LIMIT, stats=None):
+    with Ext4Image(fs, stats=stats) as img:
+        with get_stats(img).phase('base_snapshot'):
+            base = load_snapshot(base_snapshot_file) if base_snapshot_file is not None else None
+
+        try:
+            save_snapshot_from_image(img, snapshot_file, dirs_max_depth, jobs, snapshot_format, base, trust_descriptors, memory_limit)
+        finally:
+            if hasattr(base, 'close'):
+                base.close()
+
+# write snapshot of already opened fs image to snapshot file, with already loaded base snapshot
+def save_snapshot_from_image(fs, snapshot_file, dirs_max_depth=100, jobs=1, snapshot_format='binary', base=None, trust_descriptors=False, memory_limit=SNAPSHOT_MEMORY_LIMIT):
+    # snapshot is written to temporary file first, base snapshot might be the same file
+    tmp_dir = os.path.dirname(os.path.abspath(snapshot_file))
+    tmp_file = snapshot_file + '.tmp'
+
+    if snapshot_format == 'binary':
+        writer = BinarySnapshotWriter(tmp_file, memory_limit, tmp_dir)
+    else:
+        writer = JSONSnapshotWriter(tmp_file, memory_limit, tmp_dir)
+
+    try:
+        write_snapshot_from_image(fs, writer, dirs_max_depth, jobs, base, trust_descriptors, memory_limit, tmp_dir)
+    except BaseException:
+        writer.abort()
+        os.remove(tmp_file)
+        raise
+
+    os.replace(tmp_file, snapshot_file)
+
+# generate snapshot from fs and save it as new generation of snapshot store -> name of generation
+# latest generation is used as base snapshot, so only changed block groups are scanned again
+def generate_snapshot_to_store(fs, store_path, name=None, dirs_max_depth=100, jobs=1, trust_descriptors=False, stats=None):
+    with SnapshotStore(store_path, create=True) as store, Ext4Image(fs, stats=stats) as img:
+        with get_stats(img).phase('base_snapshot'):
+            base = store.load_generation()
+
+        snapshot = generate_snapshot_from_image(img, dirs_max_depth, jobs, base, trust_descriptors)
+
+        with get_stats(img).phase('store_write'):
+            return store.add_generation(snapshot, img.sb['Inodes per group'], name)
+
+# find generations of snapshot store, that contain given path -> [(name, inode_id), ...] from latest generation
+def find_path_in_store(store_path, path, latest_only=True):
+    with SnapshotStore(store_path) as store:
+        return store.find_path(path, latest_only)
+
+# flags of directory spooled along with its chunks
+DIR_FLAGS_STRUCT = struct.Struct('<I')
+
+# directory to be read in traversal: physical address of first block, inode id, flags, path length + path + chunks;
+# big endian, so that records are sorted by physical address
+DIR_READ_STRUCT = struct.Struct('>QIIH')
+
+# get chunks of regular files and directories from inodes in given block groups
+# -> (group, files_chunks, dirs_chunks, digest) for each block group, in order of block groups
+# block groups, whose digest of used inodes is same as in base_digests {group: digest}, are not parsed
+def iter_scan_groups(fs, sb, bgs=None, base_digests=None):
+    if bgs is None:
+        bgs = get_block_groups(fs, sb)
+
+    inode_size = sb['Inode size']
+    stats = get_stats(fs)
+    tables = iter_inode_tables(fs, sb, bgs)
+    table = next(tables, None)
+
+    for bg in bgs:
+        files_chunks = {}
+        dirs_chunks = {}
+
+        # block groups without used inodes are not read
+        if table is None or table[1]['group'] != bg['group']:
+            stats.count('groups.empty')
+            yield bg['group'], files_chunks, dirs_chunks, EMPTY_INODES_DIGEST
+            continue
+
+        data, bg, inode_ids, offsets = table
+        table = next(tables, None)
+
+        with stats.phase('inode_tables'):
+            digest = get_inodes_digest(data, inode_ids, offsets, inode_size)
+
+        # unchanged block group is reused from base snapshot
+        if base_digests is not None and base_digests.get(bg['group']) == digest:
+            stats.count('groups.unchanged')
+            yield bg['group'], files_chunks, dirs_chunks, digest
             continue
 
-        # save directories
-        if inode['filetype'] == 'S_IFDIR':
-            size, chunks = inode_to_chunks(fs, sb, inode)
-            dirs_chunks[inode_id] = size, chunks
+        # trees of all regular files and directories of block group are walked together
+        files = {}
+        dirs = {}
+        with stats.phase('inode_tables'):
+            filetypes = []
+            for inode_id, (i_mode, i_size, i_links_count, i_flags, i_block) in zip(inode_ids, inode_table_parse(data, offsets)):
+                filetype = i_mode & S_IFMT
+                filetypes.append(filetype)
+
+                # only regular files
+                if filetype == S_IFREG and inode_id > 11:
+                    files[inode_id] = i_size, i_flags, i_block
+                    continue
+
+                # save directories, flags tell whether they have htree index
+                if filetype == S_IFDIR:
+                    dirs[inode_id] = i_size, i_flags, i_block
+                    continue
+
+        with stats.phase('extent_trees'):
+            chunks = i_blocks_to_chunks(fs, sb, {
+                inode_id: (i_flags, i_block) for inodes in (files, dirs) for inode_id, (i_size, i_flags, i_block) in inodes.items()
+            })
+
+        if stats is not NO_STATS:
+            count_scan_stats(stats, filetypes, itertools.chain(files.values(), dirs.values()))
+
+        for inode_id, (i_size, i_flags, i_block) in files.items():
+            files_chunks[inode_id] = i_size, chunks[inode_id]
+
+        for inode_id, (i_size, i_flags, i_block) in dirs.items():
+            dirs_chunks[inode_id] = i_size, chunks[inode_id], i_flags
+
+        yield bg['group'], files_chunks, dirs_chunks, digest
+
+# count types of inodes and depths of their trees in one scanned block group
+def count_scan_stats(stats, filetypes, inodes):
+    stats.count('groups.scanned')
+    stats.count_histogram('inode types', (get_filetype(filetype) or 'unknown' for filetype in filetypes))
+
+    extent_depths = []
+    indirect_levels = []
+    for i_size, i_flags, i_block in inodes:
+        if i_flags & EXT4_EXTENTS_FL:
+            extent_depths.append(struct.unpack_from('<H', i_block, 6)[0])
+        elif not i_flags & EXT4_INLINE_DATA_FL:
+            # deepest used pointer of i_block, 0 for direct pointers only
+            pointers = struct.unpack_from('<3I', i_block, 48)
+            indirect_levels.append(max((level + 1 for level, pointer in enumerate(pointers) if pointer != 0), default=0))
+
+    stats.count_histogram('extent tree depth', extent_depths)
+    stats.count_histogram('indirect levels', indirect_levels)
+
+# scan inodes of given block groups in worker process, it opens its own fs image
+# -> (results, statistics as dict or None)
+def scan_groups_worker(fs, groups, base_digests=None, with_stats=False):
+    with Ext4Image(fs, stats=Stats() if with_stats else None) as img:
+        sb = img.sb
+        results = list(iter_scan_groups(img, sb, [sb['Block groups'][group] for group in groups], base_digests))
+        return results, img.stats.to_dict() if with_stats else None
+
+# parts scanned or waiting for consumer, per worker; results of parts further ahead are not computed yet
+SCAN_PARTS_PER_JOB = 2
+
+# scan inodes in more processes, block groups are split by flex groups, results are in order of block groups
+def iter_scan_groups_parallel(fs, sb, jobs, bgs=None, base_digests=None):
+    if bgs is None:
+        bgs = get_block_groups(fs, sb)
+
+    # split block groups to parts, so that each flex group is scanned by one worker
+    part_size = sb['Flex block group size'] or 16
+    parts = {}
+    for bg in bgs:
+        parts.setdefault(bg['group'] // part_size, []).append(bg['group'])
+    parts = list(parts.values())
+
+    # each worker gets only digests of its block groups
+    if base_digests is None:
+        parts_digests = [None] * len(parts)
+    else:
+        parts_digests = [{group: base_digests.get(group) for group in groups} for groups in parts]
+
+    # statistics of workers are added to statistics of fs
+    stats = getattr(fs, 'stats', None)
+
+    worker = partial(scan_groups_worker, fs.path, with_stats=stats is not None)
+
+    # only limited number of parts is submitted, so that finished results do not pile up before consumer
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        pending = deque()
+        for groups, digests in zip(parts, parts_digests):
+            pending.append(executor.submit(worker, groups, digests))
+            if len(pending) < SCAN_PARTS_PER_JOB * jobs:
+                continue
+
+            yield from get_scanned_part(pending.popleft(), stats)
+
+        while pending:
+            yield from get_scanned_part(pending.popleft(), stats)
+
+# wait for part scanned by worker -> its results, statistics of worker are added to statistics of fs
+def get_scanned_part(future, stats):
+    part, part_stats = future.result()
+    if part_stats is not None:
+        stats.merge(part_stats)
+    return part
+
+# get state of block groups from base snapshot, if it can be used for given fs -> [{'descriptor': [...], 'digest': hex}, ...] or None
+def get_base_groups(sb, base):
+    if base is None or base.get('uuid') != sb['Filesystem UUID']:
+        return None
+
+    # fs might have been resized
+    groups = base.get('groups')
+    if not groups or len(groups) != sb['Block groups count']:
+        return None
+
+    return groups
+
+# get function reading regular files of one block group from base snapshot -> [(inode_id, (size, chunks)), ...]
+def get_base_files_reader(sb, base):
+    inodes_per_group = sb['Inodes per group']
+    inodes = base['inodes']
+
+    # binary snapshot and snapshot store read range of inode ids
+    if hasattr(inodes, 'items_in_range'):
+        return lambda group: inodes.items_in_range(group * inodes_per_group + 1, (group + 1) * inodes_per_group + 1)
+
+    # JSON snapshot is loaded in memory, its files are split by block groups at once
+    groups = {}
+    for inode_id in sorted(inodes):
+        groups.setdefault((inode_id - 1) // inodes_per_group, []).append((inode_id, inodes[inode_id]))
+
+    return lambda group: groups.get(group, [])
+
+# types of entries in listings of base snapshot
+LISTING_LISTED = 0
+LISTING_FILE = 1
+LISTING_DIR = 2
+
+# parent inode id, type, inode id + name; big endian, so that records are sorted by parent inode id
+LISTING_STRUCT = struct.Struct('>IBI')
+
+# get listings of directories from base snapshot, that were fully traversed -> KeyedSpool {inode_id: records}
+# each listed directory has LISTING_LISTED record, even if it is empty
+def get_base_listings(base, memory_limit=SNAPSHOT_MEMORY_LIMIT, tmp_dir=None):
+    # directories in last level of traversal were found, but not listed
+    listed = {}
+    for path, inode_id in base['directories'].items():
+        if path.count('/') - 1 < base['dirs_max_depth']:
+            listed[path] = inode_id
+
+    records = Spool(memory_limit, tmp_dir, sort=True)
+    for inode_id in listed.values():
+        records.add(LISTING_STRUCT.pack(inode_id, LISTING_LISTED, 0))
+
+    for path, inode_id in base['dirs'].items():
+        parent, name = path.rsplit('/', 1)
+        parent_inode_id = listed.get(parent + '/')
+        if parent_inode_id is not None:
+            records.add(LISTING_STRUCT.pack(parent_inode_id, LISTING_FILE, inode_id) + name.encode('utf-8'))
+
+    for path, inode_id in base['directories'].items():
+        if path == '/':
             continue
 
+        parent, name = path[:-1].rsplit('/', 1)
+        parent_inode_id = listed.get(parent + '/')
+        if parent_inode_id is not None:
+            records.add(LISTING_STRUCT.pack(parent_inode_id, LISTING_DIR, inode_id) + name.encode('utf-8'))
+
+    listings = KeyedSpool(tmp_dir)
+    for key, group in itertools.groupby(records, key=lambda record: record[:4]):
+        listings.add(int.from_bytes(key, 'big'), list(group))
+    records.close()
+
+    return listings
+
+# unpack record of directory to be read -> ((prefix, inode_id), size, chunks, i_flags)
+def unpack_dir_read_record(record):
+    addr, inode_id, i_flags, length = DIR_READ_STRUCT.unpack_from(record)
+    offset = DIR_READ_STRUCT.size
+    size, chunks = unpack_chunks(record[offset + length:])
+
+    return (record[offset:offset + length].decode('utf-8'), inode_id), size, chunks, i_flags
+
+# traverse directories from root and write paths of regular files and found directories to writer
+# directories from reused block groups are unchanged, they are listed from base snapshot or read on demand
+# directories of each level of traversal are spooled, so that memory is bounded; blocks of all directories
+# of one level are read in physical order
+def resolve_paths(fs, sb, dirs_chunks, writer, dirs_max_depth=100, base=None, reused_groups=(), memory_limit=SNAPSHOT_MEMORY_LIMIT, tmp_dir=None):
+    stats = get_stats(fs)
+
+    with stats.phase('base_snapshot'):
+        base_listings = get_base_listings(base, memory_limit // 4, tmp_dir) if base is not None and reused_groups else None
+
+    # one bit for each inode
+    visited = bytearray(sb['Inode count'] // 8 + 1)
+
     # root inode is 2
-    inodes = [ { 'prefix': '/', 'inode': 2 } ]
-    entries = {}
+    inodes = Spool(memory_limit // 8, tmp_dir)
+    inodes.add(pack_path_record(b'/', 2))
+    writer.add_directory('/', 2)
+
+    # add found directory to writer and to next level
+    def add_directory(next_inodes, path, inode_id):
+        writer.add_directory(path, inode_id)
+        next_inodes.add(pack_path_record(path.encode('utf-8'), inode_id))
 
     # loop through dirs
     for depth in range(dirs_max_depth):
         if len(inodes) == 0:
             break
 
-        last_inodes, inodes = inodes, []
-        for entry in last_inodes:
-            prefix = entry['prefix']
-            inode = entry['inode']
+        last_inodes, inodes = inodes, Spool(memory_limit // 8, tmp_dir)
+
+        # directories, that must be read, sorted by physical address
+        dirs_to_read = Spool(memory_limit // 8, tmp_dir, sort=True)
+
+        # found entries of this level
+        found_files = found_dirs = 0
+
+        for record in last_inodes:
+            prefix, inode = unpack_path_record(record)
 
-            if not inode in dirs_chunks:
+            if inode > sb['Inode count'] or visited[inode >> 3] & (1 << (inode & 7)):
                 continue
+            visited[inode >> 3] |= 1 << (inode & 7)
+
+            reused = (inode - 1) // sb['Inodes per group'] in reused_groups
+
+            # unchanged directory listed in base snapshot
+            listing = base_listings.get(inode) if reused and base_listings is not None else None
+            if listing is not None:
+                stats.count('directories.from_base')
+                prefix = prefix.decode('utf-8')
+                for entry in listing:
+                    parent_inode, entry_type, inode_id = LISTING_STRUCT.unpack_from(entry)
+                    name = entry[LISTING_STRUCT.size:].decode('utf-8')
+
+                    if entry_type == LISTING_FILE:
+                        writer.add_path(prefix + name, inode_id)
+                        found_files += 1
+                    elif entry_type == LISTING_DIR:
+                        add_directory(inodes, prefix + name + '/', inode_id)
+                        found_dirs += 1
+                continue
+
+            records = dirs_chunks.get(inode)
+            if records is not None:
+                size, chunks = unpack_chunks(records[0])
+                i_flags = DIR_FLAGS_STRUCT.unpack(records[1])[0]
+            elif reused:
+                # directory from unchanged block group, that was not listed in base snapshot
+                i_mode, size, i_links_count, i_flags, i_block = read_inode(fs, sb, inode)
+                if i_mode & S_IFMT != S_IFDIR or i_links_count == 0:
+                    continue
+                chunks = i_block_to_chunks(fs, sb, i_flags, i_block)
+            else:
+                continue
+
+            stats.count('directories.read')
+            if i_flags & EXT4_INDEX_FL:
+                stats.count('directories.htree')
 
-            # pop from dict
-            size, chunks = dirs_chunks[inode]
-            del dirs_chunks[inode]
+            addr = min((chunk['addr'] for chunk in chunks), default=0)
+            dirs_to_read.add(DIR_READ_STRUCT.pack(addr, inode, i_flags, len(prefix)) + prefix + pack_chunks(size, chunks))
 
-            for entry in readdir_from_chunks(fs, sb, chunks, size):
-                if entry['name'] == '.' or entry['name'] == '..':
+        last_inodes.close()
+
+        dirs = map(unpack_dir_read_record, dirs_to_read)
+        for (prefix, inode), entries in iter_dirs_entries(fs, sb, dirs):
+            for inode_id, file_type, name in entries:
+                if name == '.' or name == '..':
                     continue
 
                 # only regular files
-                if entry['filetype'] == 'S_IFREG':
-                    entries[prefix + entry['name']] = entry['inode']
+                if file_type == DIR_FILETYPE_REG:
+                    writer.add_path(prefix + name, inode_id)
+                    found_files += 1
                     continue
 
                 # add dir to next iteration
-                if entry['filetype'] == 'S_IFDIR':
-                    inodes.append({
-                        'prefix': prefix + entry['name'] + '/',
-                        'inode': entry['inode']
-                    })
-
-    save_snapshot(snapshot_file, {
-        'dirs': entries,
-        'inodes': files_chunks
-    })
+                if file_type == DIR_FILETYPE_DIR:
+                    add_directory(inodes, prefix + name + '/', inode_id)
+                    found_dirs += 1
+
+        dirs_to_read.close()
+
+        stats.count('paths.files', found_files)
+        stats.count('paths.directories', found_dirs)
+        stats.count_histogram('directories found per depth', {depth + 1: found_dirs})
+
+    inodes.close()
+    if base_listings is not None:
+        base_listings.close()
+
+# write snapshot of already opened fs image to writer -> result of writer
+# inodes are written in order of inode ids, while block groups are scanned; paths are written while directories are traversed
+# with base snapshot, block groups with same digest of used inodes are reused; with trust_descriptors, block groups
+# with same group descriptor are reused without reading their inode tables, which needs metadata_csum and can miss
+# files, whose new blocks were allocated in other block groups
+def write_snapshot_from_image(fs, writer, dirs_max_depth=100, jobs=1, base=None, trust_descriptors=False, memory_limit=SNAPSHOT_MEMORY_LIMIT, tmp_dir=None):
+    stats = get_stats(fs)
+
+    with stats.phase('superblock'):
+        sb = fs.sb
+        bgs = get_block_groups(fs, sb)
+
+    base_groups = get_base_groups(sb, base)
+
+    # block groups with unchanged group descriptors
+    skipped = set()
+    if base_groups is not None and trust_descriptors and 'metadata_csum' in sb['Filesystem features']:
+        skipped = {bg['group'] for bg in bgs if get_descriptor_state(bg) == base_groups[bg['group']]['descriptor']}
+        stats.count('groups.skipped', len(skipped))
+
+    scan_bgs = [bg for bg in bgs if bg['group'] not in skipped]
+    base_digests = {group: state['digest'] for group, state in enumerate(base_groups)} if base_groups is not None else None
+    base_files = get_base_files_reader(sb, base) if base_groups is not None else None
+
+    if jobs > 1:
+        scanned = iter_scan_groups_parallel(fs, sb, jobs, scan_bgs, base_digests)
+    else:
+        scanned = iter_scan_groups(fs, sb, scan_bgs, base_digests)
+
+    # chunks of directories are spooled until traversal
+    dirs_chunks = KeyedSpool(tmp_dir)
+    digests = []
+    reused_groups = set()
+    for bg in bgs:
+        if bg['group'] in skipped:
+            group, files_chunks, group_dirs_chunks, digest = bg['group'], {}, {}, base_digests[bg['group']]
+        else:
+            # with more jobs, this is time of waiting for workers
+            with stats.phase('scan'):
+                group, files_chunks, group_dirs_chunks, digest = next(scanned)
+            assert group == bg['group']
+
+        digests.append(digest)
+
+        # reuse files of unchanged block groups
+        with stats.phase('snapshot_write'):
+            if base_groups is not None and digest == base_digests[group]:
+                reused_groups.add(group)
+                files = base_files(group)
+            else:
+                files = files_chunks.items()
+
+            for inode_id, (size, chunks) in files:
+                writer.add_inode(inode_id, size, chunks)
+
+            for inode_id, (size, chunks, i_flags) in group_dirs_chunks.items():
+                dirs_chunks.add(inode_id, [pack_chunks(size, chunks), DIR_FLAGS_STRUCT.pack(i_flags)])
+
+    stats.count('groups.reused', len(reused_groups))
+
+    with stats.phase('directories'):
+        resolve_paths(fs, sb, dirs_chunks, writer, dirs_max_depth, base, reused_groups, memory_limit, tmp_dir)
+    dirs_chunks.close()
+
+    with stats.phase('snapshot_write'):
+        return writer.finish({
+            'groups': [{'descriptor': get_descriptor_state(bg), 'digest': digest} for bg, digest in zip(bgs, digests)],
+            'uuid': sb['Filesystem UUID'],
+            'dirs_max_depth': dirs_max_depth
+        })
+
+# generate snapshot dict from already opened fs image
+def generate_snapshot_from_image(fs, dirs_max_depth=100, jobs=1, base=None, trust_descriptors=False):
+    return write_snapshot_from_image(fs, DictSnapshotWriter(), dirs_max_depth, jobs, base, trust_descriptors)
 
 # recover file from fs using supplied metdata
-def recover_file(fs, snapshot_file, file_path, output_file, verify_checksum=True):
-    snapshot = load_snapshot(snapshot_file)
+def recover_file(fs, snapshot_file, file_path, output_file, verify_checksum=True, stats=None):
+    with Ext4Image(fs, stats=stats) as img:
+        stats = get_stats(img)
+
+        with stats.phase('snapshot_load'):
+            snapshot = load_snapshot(snapshot_file)
+
+        try:
+            with stats.phase('snapshot_load'):
+                inode_id = snapshot['dirs'].get(file_path)
+                if inode_id is None:
+                    raise Exception('File was not found.')
+
+                assert inode_id in snapshot['inodes']
+                size, chunks = snapshot['inodes'][inode_id]
+
+            # check, whether file can be recovered
+            if verify_checksum:
+                sb = img.sb
+                with stats.phase('bitmaps'):
+                    if not is_inode_deleted(img, sb, inode_id):
+                        raise Exception('File is not deleted.')
+
+                    # get used blocks from bbitmap
+                    used_blocks = get_used_blocks(img, sb)
+
+                # check whethter file has conflicting chunks
+                if has_conflicting_chunks(img, sb, used_blocks, chunks):
+                    raise Exception('File cannot be fully recovered. Some of its blocks are alreay in use.')
+
+            with stats.phase('copy'):
+                get_file_from_chunks(img, chunks, output_file, size)
+        finally:
+            if hasattr(snapshot, 'close'):
+                snapshot.close()
+
+# recover more files from fs using supplied metdata, their paths are recreated in output directory
+# returns {path: error or None}; copy_stats dict gets copied bytes and time
+def recover_files(fs, snapshot_file, patterns, output_dir, verify_checksum=True, jobs=1, stats=None, copy_stats=None):
+    with Ext4Image(fs, stats=stats) as img:
+        with get_stats(img).phase('snapshot_load'):
+            snapshot = load_snapshot(snapshot_file)
+
+        try:
+            return recover_files_from_image(img, snapshot, patterns, output_dir, verify_checksum, jobs, copy_stats=copy_stats)
+        finally:
+            if hasattr(snapshot, 'close'):
+                snapshot.close()
+
+# recover files found in loaded snapshot from already opened fs image -> {path: error or None}
+# deleted inodes and used blocks are read from bitmaps, unless they are given; copy_stats dict gets copied bytes and time
+def recover_files_from_image(fs, snapshot, patterns, output_dir, verify_checksum=True, jobs=1, deleted_inodes=None, used_blocks=None, copy_stats=None):
+    sb = fs.sb
+    stats = get_stats(fs)
+    results = {}
+    files = {}
+
+    with stats.phase('snapshot_load'):
+        paths = find_snapshot_paths(snapshot, patterns)
+
+    # allocation bitmaps are read only once for all files
+    if verify_checksum:
+        with stats.phase('bitmaps'):
+            if deleted_inodes is None:
+                deleted_inodes = get_deleted_inodes(fs, sb, paths.values())
+            if used_blocks is None:
+                used_blocks = get_used_blocks(fs, sb)
 
-    if file_path not in snapshot['dirs']:
-        raise Exception('File was not found.')
+    for path, inode_id in sorted(paths.items()):
+        assert inode_id in snapshot['inodes']
+        size, chunks = snapshot['inodes'][inode_id]
 
-    inode_id = snapshot['dirs'][file_path]
-    assert inode_id in snapshot['inodes']
-    size, chunks = snapshot['inodes'][inode_id]
+        # check, whether file can be recovered
+        if verify_checksum:
+            if inode_id not in deleted_inodes:
+                results[path] = 'File is not deleted.'
+                continue
 
-    # check, whether file can be recovered
-    if verify_checksum:
-        sb = get_super(fs)
-        if not is_inode_deleted(fs, sb, inode_id):
-            raise Exception('File is not deleted.')
+            if has_conflicting_chunks(fs, sb, used_blocks, chunks):
+                results[path] = 'File cannot be fully recovered. Some of its blocks are alreay in use.'
+                continue
 
-        # get used blocks from bbitmap
-        used_blocks = get_used_blocks(fs, sb)
+        dst_path = os.path.join(output_dir, path.lstrip('/'))
+        os.makedirs(os.path.dirname(dst_path), exist_ok=True)
 
-        # check whethter file has conflicting chunks
-        if has_conflicting_chunks(fs, sb, used_blocks, chunks):
-            raise Exception('File cannot be fully recovered. Some of its blocks are alreay in use.')
+        files[dst_path] = size, chunks
+        results[path] = None
 
-    get_file_from_chunks(fs, chunks, output_file, size)
+    start = time.monotonic()
+    with stats.phase('copy'):
+        copied = get_files_from_chunks(fs, files, jobs)
 
-# list all deleted files from filesystem, that are present in snapshot
-def list_deleted(fs, snapshot_file):
-    snapshot = load_snapshot(snapshot_file)
-    sb = get_super(fs)
+    if copy_stats is not None:
+        copy_stats['bytes'] = copied
+        copy_stats['seconds'] = time.monotonic() - start
 
-    # get all inodes of directories
-    inode_ids = snapshot['dirs'].values()
+    return results
 
-    # get only those inodes, that have been deleted
-    deleted_inodes = check_if_deleted_inodes(fs, sb, inode_ids)
+# list all deleted files from filesystem, that are present in snapshot
+def list_deleted(fs, snapshot_file, stats=None):
+    return dict(iter_deleted(fs, snapshot_file, stats=stats))
+
+# iterate deleted files from filesystem, that are present in snapshot and match filters, see iter_deleted_from_image
+def iter_deleted(fs, snapshot_file, patterns=None, min_size=None, max_size=None, can_be_recovered=None, stats=None):
+    with Ext4Image(fs, stats=stats) as img:
+        with get_stats(img).phase('snapshot_load'):
+            snapshot = load_snapshot(snapshot_file)
+
+        try:
+            yield from iter_deleted_from_image(img, snapshot, patterns, min_size, max_size, can_be_recovered)
+        finally:
+            if hasattr(snapshot, 'close'):
+                snapshot.close()
+
+# list all deleted files from already opened fs image, that are present in loaded snapshot and match filters
+def list_deleted_from_image(fs, snapshot, patterns=None, min_size=None, max_size=None, can_be_recovered=None, deleted_inodes=None, used_blocks=None):
+    return dict(iter_deleted_from_image(fs, snapshot, patterns, min_size, max_size, can_be_recovered, deleted_inodes, used_blocks))
+
+# iterate (path, {inode_id, size, can_be_recovered}) of deleted files from already opened fs image, that are present
+# in loaded snapshot, in order of paths; only paths matching patterns (see find_snapshot_paths), with size in
+# [min_size, max_size] and given recoverability are listed
+# filters are checked before used blocks, so excluded files are not checked against bbitmap; with patterns, only
+# bitmaps of block groups of matched files are read, without them all bitmaps are read at once
+# deleted inodes and used blocks are read from bitmaps, unless they are given
+def iter_deleted_from_image(fs, snapshot, patterns=None, min_size=None, max_size=None, can_be_recovered=None, deleted_inodes=None, used_blocks=None):
+    sb = fs.sb
+    stats = get_stats(fs)
+
+    with stats.phase('bitmaps'):
+        if deleted_inodes is None:
+            deleted_inodes = FreeInodes(fs, sb, preload=not patterns)
+
+        if used_blocks is None:
+            used_blocks = get_used_blocks(fs, sb) if not patterns else LazyUsedBlocks(fs, sb)
+
+    for path, inode_id in iter_snapshot_paths(snapshot, patterns):
+        with stats.phase('check'):
+            if inode_id not in deleted_inodes:
+                continue
 
-    # get all blocks, that are used by fs
-    used_blocks = get_used_blocks(fs, sb)
+            assert inode_id in snapshot['inodes']
+            size, chunks = snapshot['inodes'][inode_id]
 
-    deleted_files = {}
-    for path, inode_id in snapshot['dirs'].items():
-        if inode_id not in deleted_inodes:
-            continue
+            if (min_size is not None and size < min_size) or (max_size is not None and size > max_size):
+                continue
 
-        assert inode_id in snapshot['inodes']
-        size, chunks = snapshot['inodes'][inode_id]
+            # check chunks against used blocks
+            recoverable = not has_conflicting_chunks(fs, sb, used_blocks, chunks)
+            if can_be_recovered is not None and recoverable != can_be_recovered:
+                continue
 
-        # get conflicting chunks
-        deleted_files[path] = {
+        stats.count('files.deleted')
+        stats.count('files.recoverable', recoverable)
+
+        yield path, {
             'inode_id': inode_id,
             'size': size,
-            'can_be_recovered': not has_conflicting_chunks(fs, sb, used_blocks, chunks),
+            'can_be_recovered': recoverable,
         }
-
-    return deleted_files
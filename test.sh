@@ -190,12 +190,230 @@ restore() {
 	fi
 }
 
+#
+# OFFLINE TESTS
+#
+# no root is needed, image is built by "mke2fs -d" and changed by debugfs
+#
+
+# create image of test tree in temporary directory, tree is kept for comparing recovered files
+offline_image() {
+	TMP="$(mktemp -d)"
+	CATCH "[OK] Created temporary directory $TMP."
+
+	# nested directories, names sorted around '/' and sparse file
+	mkdir -p "$TMP/root/a/b/c" "$TMP/root/a-b" "$TMP/root/empty"
+	for i in $(seq 1 50); do
+		head -c $(($i * 1000)) /dev/urandom > "$TMP/root/a/b/file_$i.txt"
+	done
+	head -c 70000 /dev/urandom > "$TMP/root/a/b/c/big.bin"
+	echo "x" > "$TMP/root/a.txt"
+	echo "y" > "$TMP/root/a-b/f"
+	head -c 5000 /dev/urandom > "$TMP/root/sparse"
+	truncate -s 10M "$TMP/root/sparse"
+	echo "end" >> "$TMP/root/sparse"
+
+	# few inodes in each of many small flex groups, so that files are in more of them
+	mke2fs -q -F -t ext4 -b 1024 -G 2 -N 512 -d "$TMP/root" "$TMP/fs.img" 256M
+	CATCH "[OK] Created filesystem image."
+}
+
+# run debugfs commands on image
+offline_debugfs() {
+	debugfs -w -f - "$TMP/fs.img" > /dev/null 2>&1
+}
+
+offline_clear() {
+	rm -rf "$TMP"
+	CATCH "[OK] Removed temporary directory."
+}
+
+#
+# SNAPSHOT FORMATS ROUND TRIP
+#
+roundtrip() {
+	offline_image
+
+	python3 -m src create -i "$TMP/fs.img" -o "$TMP/snapshot.json" -f json && \
+		python3 -m src create -i "$TMP/fs.img" -o "$TMP/snapshot.out" -f binary && \
+		python3 -m src create -i "$TMP/fs.img" --store "$TMP/store"
+	CATCH "[OK] Created JSON, binary and store snapshots."
+
+	# all formats have to give the same inodes, paths and paths found by patterns
+	python3 - "$TMP" <<'PY'
+import sys
+from src.utils import find_snapshot_paths, load_snapshot
+
+tmp = sys.argv[1]
+patterns = (['/a.txt', '/sparse'], ['/'], ['/a/'], ['/a/b/c/'], ['/a*'], ['/a/b/file_1*.txt'], ['/nope*'])
+
+results = {}
+for name in ('snapshot.json', 'snapshot.out', 'store'):
+    snapshot = load_snapshot(tmp + '/' + name)
+    results[name] = (
+        # JSON has [size, chunks] as list
+        {inode_id: tuple(inode) for inode_id, inode in snapshot['inodes'].items()},
+        list(snapshot['dirs'].items()),
+        [sorted(find_snapshot_paths(snapshot, p).items()) for p in patterns]
+    )
+
+expected = results['snapshot.json']
+if len(expected[1]) != 54:
+    sys.exit('JSON snapshot has {} paths instead of 54.'.format(len(expected[1])))
+
+for name, result in results.items():
+    for part, a, b in zip(('inodes', 'paths', 'found paths'), expected, result):
+        if a != b:
+            sys.exit('{} of {} differ from JSON snapshot.'.format(part, name))
+PY
+	CATCH "[OK] Snapshots have the same inodes and paths."
+
+	offline_clear
+}
+
+#
+# INCREMENTAL SNAPSHOT
+#
+incremental() {
+	offline_image
+
+	python3 -m src create -i "$TMP/fs.img" -o "$TMP/base.out"
+	CATCH "[OK] Created base snapshot."
+
+	head -c 300000 /dev/urandom > "$TMP/new_file"
+	offline_debugfs <<-EOF
+		mkdir /new_dir
+		write $TMP/new_file /new_dir/new_file
+		rm /a/b/file_7.txt
+		rm /a-b/f
+	EOF
+	CATCH "[OK] Changed filesystem image."
+
+	python3 -m src create -i "$TMP/fs.img" -o "$TMP/full.out" && \
+		python3 -m src create -i "$TMP/fs.img" -b "$TMP/base.out" -o "$TMP/incremental.out"
+	CATCH "[OK] Created full and incremental snapshot."
+
+	# incremental snapshot has to be the same as full one
+	python3 - "$TMP" <<'PY'
+import sys
+from src.utils import load_snapshot
+
+tmp = sys.argv[1]
+full = load_snapshot(tmp + '/full.out')
+incremental = load_snapshot(tmp + '/incremental.out')
+
+for part in ('inodes', 'dirs', 'directories'):
+    if dict(full[part].items()) != dict(incremental[part].items()):
+        sys.exit('{} of incremental snapshot differ from full snapshot.'.format(part))
+
+if '/new_dir/new_file' not in incremental['dirs'] or '/a/b/file_7.txt' in incremental['dirs']:
+    sys.exit('Incremental snapshot does not have changes of image.')
+PY
+	CATCH "[OK] Incremental snapshot is the same as full snapshot."
+
+	offline_debugfs <<< "rm /new_dir/new_file"
+	python3 -m src recover -i "$TMP/fs.img" -s "$TMP/incremental.out" /new_dir/new_file -o "$TMP/recovered" && \
+		cmp "$TMP/recovered" "$TMP/new_file"
+	CATCH "[OK] Recovered file from incremental snapshot."
+
+	offline_clear
+}
+
+#
+# SNAPSHOT BY MORE PROCESSES
+#
+parallel() {
+	offline_image
+
+	python3 -m src create -i "$TMP/fs.img" -o "$TMP/snapshot_1.json" -f json -j 1 && \
+		python3 -m src create -i "$TMP/fs.img" -o "$TMP/snapshot_4.json" -f json -j 4 && \
+		python3 -m src create -i "$TMP/fs.img" -o "$TMP/snapshot_4.out" -j 4
+	CATCH "[OK] Created snapshots by 1 and 4 processes."
+
+	cmp "$TMP/snapshot_1.json" "$TMP/snapshot_4.json"
+	CATCH "[OK] Snapshots are the same."
+
+	offline_debugfs <<< "rm /a/b/c/big.bin"
+	python3 -m src recover -i "$TMP/fs.img" -s "$TMP/snapshot_4.out" /a/b/c/big.bin -o "$TMP/recovered" && \
+		cmp "$TMP/recovered" "$TMP/root/a/b/c/big.bin"
+	CATCH "[OK] Recovered file from snapshot created by 4 processes."
+
+	offline_clear
+}
+
+#
+# SPARSE FILE RECOVERY
+#
+sparse() {
+	offline_image
+
+	python3 -m src create -i "$TMP/fs.img" -o "$TMP/snapshot.out"
+	CATCH "[OK] Created snapshot."
+
+	offline_debugfs <<< "rm /sparse"
+	python3 -m src recover -i "$TMP/fs.img" -s "$TMP/snapshot.out" /sparse -o "$TMP/recovered" && \
+		cmp "$TMP/recovered" "$TMP/root/sparse"
+	CATCH "[OK] Recovered sparse file."
+
+	# hole is not written
+	[ $(stat -c '%b' "$TMP/recovered") -lt 1024 ]
+	CATCH "[OK] Recovered file is sparse."
+
+	offline_clear
+}
+
+#
+# RECOVERY OF MORE FILES
+#
+batch() {
+	offline_image
+
+	python3 -m src create -i "$TMP/fs.img" -o "$TMP/snapshot.out"
+	CATCH "[OK] Created snapshot."
+
+	offline_debugfs <<-EOF
+		rm /a/b/file_1.txt
+		$(for i in $(seq 10 19); do echo "rm /a/b/file_$i.txt"; done)
+		rm /a/b/c/big.bin
+		rm /a.txt
+	EOF
+	CATCH "[OK] Removed files."
+
+	[ $(python3 -m src ls -i "$TMP/fs.img" -s "$TMP/snapshot.out" '/a/b/file_1*.txt' --ndjson | wc -l) -eq 11 ]
+	CATCH "[OK] Listed removed files matching pattern."
+
+	python3 -m src recover -i "$TMP/fs.img" -s "$TMP/snapshot.out" '/a/b/file_1*.txt' /a/b/c/ /a.txt -o "$TMP/recovered" && \
+		diff -r "$TMP/recovered/a/b" "$TMP/root/a/b" -x 'file_[2-9]*' -x 'file_?.txt' && \
+		cmp "$TMP/recovered/a/b/file_1.txt" "$TMP/root/a/b/file_1.txt" && \
+		cmp "$TMP/recovered/a.txt" "$TMP/root/a.txt"
+	CATCH "[OK] Recovered files matching patterns."
+
+	# file, that is not deleted, is reported
+	! python3 -m src recover -i "$TMP/fs.img" -s "$TMP/snapshot.out" '/a/b/file_2*.txt' -o "$TMP/recovered_2" > /dev/null
+	CATCH "[OK] Files, that are not deleted, were not recovered."
+
+	offline_clear
+}
+
 case $1 in
 	install) install;;
 	create_file) create_file;;
 	remove_file) remove_file;;
 	snapshot) snapshot;;
 	restore) restore;;
+	roundtrip|incremental|parallel|sparse|batch)
+		$1
+		echo -e "\n\e[92mSUCCESS\e[39m"
+		;;
+
+	offline)
+		roundtrip
+		incremental
+		parallel
+		sparse
+		batch
+		echo -e "\n\e[92mSUCCESS\e[39m"
+		;;
 
 	full)
 		install
@@ -266,5 +484,14 @@ case $1 in
 		echo './test.sh remove_file    # remove test file.'
 		echo './test.sh restore        # restore removed file from snapshot.'
 		echo ''
+		echo '-- offline tests, no root needed, image is built by "mke2fs -d" --'
+		echo ''
+		echo './test.sh offline        # run all offline tests.'
+		echo './test.sh roundtrip      # compare JSON, binary and store snapshots of image.'
+		echo './test.sh incremental    # compare incremental snapshot with full one.'
+		echo './test.sh parallel       # compare snapshots created by 1 and 4 processes.'
+		echo './test.sh sparse         # recover sparse file.'
+		echo './test.sh batch          # recover files matching patterns.'
+		echo ''
 		;;
 esac